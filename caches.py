@@ -0,0 +1,140 @@
+"""
+LRU Caches
+SelectionEngine 的 metrics_cache / scan_cache 使用的有界快取:
+可設定最大筆數與最大位元組數 (估計值)，超過時淘汰最久未使用的項目，
+並記錄 hits / misses / evictions 供參數掃描時調整快取大小
+"""
+import sys
+from collections import OrderedDict
+
+import numpy as np
+
+
+def estimate_size(obj, _depth=0):
+    """
+    物件的近似記憶體用量 (bytes)
+    dict / list / tuple 遞迴計算內容 (最多 3 層)，numpy 陣列使用 nbytes
+    """
+    if isinstance(obj, np.ndarray):
+        # view 不擁有資料，只計算物件本身
+        return sys.getsizeof(obj) + (obj.nbytes if obj.base is None else 0)
+    size = sys.getsizeof(obj)
+    if _depth >= 3:
+        return size
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += estimate_size(k, _depth + 1) + estimate_size(v, _depth + 1)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            size += estimate_size(v, _depth + 1)
+    return size
+
+
+class LRUCache:
+    """
+    dict 介面的 LRU 快取 (OrderedDict，最近使用的在尾端)
+    max_items / max_bytes 為 None 表示不限制
+    get() 與 [] 讀取會更新使用順序並計入 hits / misses；`in` 不影響統計
+    """
+
+    def __init__(self, max_items=None, max_bytes=None, sizeof=estimate_size):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._data = OrderedDict()  # key → (value, size)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.inserts = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def keys(self):
+        return self._data.keys()
+
+    def items(self):
+        return ((k, v) for k, (v, _) in self._data.items())
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data.move_to_end(key)
+        return entry[0]
+
+    def __getitem__(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        self._data.move_to_end(key)
+        return entry[0]
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(key) + self.sizeof(value)
+        old = self._data.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        self._data[key] = (value, size)
+        self.bytes += size
+        self.inserts += 1
+        self._evict()
+
+    def setdefault(self, key, value):
+        if key in self._data:
+            return self._data[key][0]
+        self[key] = value
+        return value
+
+    def __delitem__(self, key):
+        _, size = self._data.pop(key)
+        self.bytes -= size
+
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
+
+    def resize(self, max_items=None, max_bytes=None):
+        """更改上限 (立即淘汰超出的項目)"""
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def _evict(self):
+        # 至少保留最新的一筆 (單筆超過 max_bytes 時仍可使用)
+        while len(self._data) > 1 and (
+                (self.max_items is not None and len(self._data) > self.max_items)
+                or (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            _, (_, size) = self._data.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+        if self.max_items == 0 and self._data:
+            self.evictions += len(self._data)
+            self.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'items': len(self._data),
+            'bytes': self.bytes,
+            'max_items': self.max_items,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = 0
@@ -35,3 +35,12 @@ CONST_FILE = 'sp500_constituents_daily_2015_2026.xlsx'
 # 預設回測時間範圍 (None 表示全部)
 START_DATE = '2020-01-01'
 END_DATE = '2025-12-31'
+
+# SelectionEngine 快取上限 (None 表示不限制；bytes 為估計值)
+METRICS_CACHE_MAX_ITEMS = None
+METRICS_CACHE_MAX_BYTES = None
+SCAN_CACHE_MAX_ITEMS = None
+SCAN_CACHE_MAX_BYTES = None
+
+# compact 模式: data_cache 以 float32 保存價格並共用日期 index (排名與 float64 在容許誤差內一致)
+COMPACT_PRICE_CACHE = False
@@ -56,6 +56,8 @@ CORR_FILTER_ENABLED = True      # 是否啟用殘差相關性過濾
 CORR_THRESHOLD = 0.6            # 殘差相關係數門檻（超過此值視為同質）
 CORR_LOOKBACK = 60              # 計算殘差的回看天數
 CORR_CANDIDATE_COUNT = 20       # 進入相關性過濾的候選股數量
+CORR_ROLLING = False            # 使用滾動殘差共變異數引擎 (視窗移動時增量更新)
+CORR_SHRINKAGE = None           # 滾動模式的相關係數收縮: None / 0~1 / 'ledoit-wolf'
 
 # ======================================
 # BLACKLIST: 特定日期後不持有的股票
@@ -0,0 +1,219 @@
+"""
+Constituents Membership
+S&P 500 成分股歷史 (Excel 每日一列) 的精簡結構:
+成分股列表只在變動日改變，因此只保存「變動點」與每段期間的成分股 (ticker 編號)，
+而不是每日一列 × 500 個字串
+另建立每檔 ticker 的 [加入, 移出) 區間 (依起點排序)，
+「某日成分股」與「某期間出現過的 ticker」皆為 O(log n + k) 查詢，並可輸出對齊 PricePanel 的布林遮罩
+第一次讀取 Excel 後存成 NPZ (data/_store/<檔名>.npz)，Excel 的 size / mtime 改變時自動重建
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+import utils
+
+
+class ConstituentsMembership:
+    def __init__(self, dates, tickers, change_rows, member_offsets, member_ids):
+        self.dates = pd.DatetimeIndex(dates)       # Excel 中的每個日期 (已排序)
+        self.tickers = list(tickers)               # ticker 名稱表 (已去除 .txt)
+        self.change_rows = np.asarray(change_rows, dtype=np.int64)        # 每段期間的起始列
+        self.member_offsets = np.asarray(member_offsets, dtype=np.int64)  # 段 k 的成分股為 member_ids[offsets[k]:offsets[k+1]]
+        self.member_ids = np.asarray(member_ids, dtype=np.int32)          # 依 Excel 原始欄位順序
+        self._dates_ns = self.dates.values
+        self._build_intervals()
+        self._panel_map = None  # (panel, ticker id → panel column)
+
+    def _build_intervals(self):
+        """
+        由各段成分股推導每檔 ticker 的 [start_row, end_row) 區間，依 start_row 排序
+        """
+        n_rows = len(self.dates)
+        open_since = {}  # ticker id → 加入列
+        intervals = []
+        for k in range(len(self.change_rows)):
+            row = int(self.change_rows[k])
+            members = set(self._segment_members(k).tolist())
+            for i in list(open_since):
+                if i not in members:
+                    intervals.append((open_since.pop(i), row, i))
+            for i in members:
+                open_since.setdefault(i, row)
+        intervals.extend((start, n_rows, i) for i, start in open_since.items())
+        intervals.sort()
+
+        arr = np.array(intervals, dtype=np.int64).reshape(-1, 3)
+        self.interval_starts = arr[:, 0]
+        self.interval_ends = arr[:, 1]
+        self.interval_ids = arr[:, 2]
+
+    @property
+    def empty(self):
+        return len(self.dates) == 0
+
+    @classmethod
+    def from_frame(cls, df):
+        """由每日一列的成分股 DataFrame (Date index) 建立"""
+        df = df[~df.index.duplicated(keep='last')].sort_index()
+        ticker_ids = {}
+        change_rows, member_offsets, member_ids = [], [0], []
+        prev = None
+        for i, values in enumerate(df.values):
+            members = tuple(t.replace('.txt', '').strip() for t in values if isinstance(t, str))
+            if members == prev:
+                continue
+            prev = members
+            change_rows.append(i)
+            for t in members:
+                member_ids.append(ticker_ids.setdefault(t, len(ticker_ids)))
+            member_offsets.append(len(member_ids))
+        tickers = sorted(ticker_ids, key=ticker_ids.get)
+        return cls(df.index, tickers, change_rows, member_offsets, member_ids)
+
+    @classmethod
+    def from_workbook(cls, path):
+        """讀取 Excel (數字名稱的工作表，每日一列)"""
+        # 使用 openpyxl engine
+        xl = pd.ExcelFile(path, engine='openpyxl')
+        valid_sheets = [s for s in xl.sheet_names if s.isdigit()]
+        all_data = []
+        for sheet in valid_sheets:
+            df = pd.read_excel(xl, sheet_name=sheet)
+            if 'Date' in df.columns:
+                df['Date'] = pd.to_datetime(df['Date'])
+                df.set_index('Date', inplace=True)
+                all_data.append(df)
+        if not all_data:
+            return None
+        return cls.from_frame(pd.concat(all_data))
+
+    @classmethod
+    def empty_membership(cls):
+        return cls([], [], [], [0], [])
+
+    def save(self, path, src_stat):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f,
+                     dates=self._dates_ns,
+                     tickers=np.array(self.tickers, dtype=str),
+                     change_rows=self.change_rows,
+                     member_offsets=self.member_offsets,
+                     member_ids=self.member_ids,
+                     src_stat=np.array([src_stat.st_size, src_stat.st_mtime_ns], dtype=np.int64))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, src_stat):
+        """讀取快取，不存在或與 Excel 的 size / mtime 不符時回傳 None"""
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                size, mtime_ns = npz['src_stat']
+                if size != src_stat.st_size or mtime_ns != src_stat.st_mtime_ns:
+                    return None
+                return cls(npz['dates'], npz['tickers'].tolist(), npz['change_rows'],
+                           npz['member_offsets'], npz['member_ids'])
+        except Exception:
+            return None
+
+    def _segment_members(self, k):
+        return self.member_ids[self.member_offsets[k]:self.member_offsets[k + 1]]
+
+    def _segment_of_row(self, row):
+        return int(np.searchsorted(self.change_rows, row, side='right')) - 1
+
+    def members_on(self, date):
+        """date 當日 (或之前最近一個日期) 的成分股，依 Excel 欄位順序；早於第一個日期回傳 []"""
+        tickers = self.tickers
+        return [tickers[i] for i in self.member_ids_on(date).tolist()]
+
+    def _row_of(self, date):
+        """date 當日或之前最近一個日期的列號 (早於第一個日期為 -1)"""
+        return int(np.searchsorted(self._dates_ns, np.datetime64(pd.Timestamp(date)), side='right')) - 1
+
+    def member_ids_on(self, date):
+        """date 當日成分股的 ticker 編號 (依 Excel 欄位順序)"""
+        row = self._row_of(date)
+        if row < 0:
+            return self.member_ids[:0]
+        return self._segment_members(self._segment_of_row(row))
+
+    def ids_between(self, start_date=None, end_date=None):
+        """
+        Excel 中日期落在 [start_date, end_date] 的列出現過的 ticker 編號 (已排序、不重複)
+        區間依起點排序: 起點 < r1 的前綴以二分搜尋取得，再過濾終點 > r0
+        """
+        if start_date is None or end_date is None:
+            return np.arange(len(self.tickers))
+        r0 = int(np.searchsorted(self._dates_ns, np.datetime64(pd.Timestamp(start_date)), side='left'))
+        r1 = int(np.searchsorted(self._dates_ns, np.datetime64(pd.Timestamp(end_date)), side='right'))
+        if r1 <= r0:
+            return np.arange(0)
+        n = int(np.searchsorted(self.interval_starts, r1, side='left'))
+        hit = self.interval_ends[:n] > r0
+        return np.unique(self.interval_ids[:n][hit])
+
+    def tickers_between(self, start_date=None, end_date=None):
+        """Excel 中日期落在 [start_date, end_date] 的所有列出現過的 ticker (未指定則為全部)"""
+        return {self.tickers[i] for i in self.ids_between(start_date, end_date)}
+
+    def _panel_columns(self, panel):
+        """ticker 編號 → panel 欄位 (不在 panel 中為 -1)，panel 不變時重複使用"""
+        if self._panel_map is None or self._panel_map[0] is not panel:
+            cols = panel.cols(self.tickers) if self.tickers else np.zeros(0, dtype=np.int64)
+            self._panel_map = (panel, cols)
+        return self._panel_map[1]
+
+    def _ids_to_mask(self, ids, panel):
+        mask = np.zeros(len(panel.tickers), dtype=bool)
+        cols = self._panel_columns(panel)[ids]
+        mask[cols[cols >= 0]] = True
+        return mask
+
+    def members_mask(self, date, panel):
+        """date 當日成分股的布林遮罩，對齊 panel.tickers"""
+        return self._ids_to_mask(self.member_ids_on(date), panel)
+
+    def between_mask(self, panel, start_date=None, end_date=None):
+        """[start_date, end_date] 期間出現過的 ticker 的布林遮罩，對齊 panel.tickers"""
+        return self._ids_to_mask(self.ids_between(start_date, end_date), panel)
+
+    def to_frame(self):
+        """還原為每日一列的 DataFrame (欄位 0..n-1，與原始 Excel 讀入格式相同)"""
+        rows = []
+        for row in range(len(self.dates)):
+            rows.append([self.tickers[i] for i in self._segment_members(self._segment_of_row(row))])
+        df = pd.DataFrame(rows, index=self.dates)
+        df.index.name = 'Date'
+        return df
+
+
+def load_membership(path):
+    """
+    讀取成分股歷史: 優先使用 NPZ 快取，Excel 變動 (或快取不存在) 時重新解析並回寫
+    失敗時回傳空的 ConstituentsMembership
+    """
+    try:
+        src_stat = os.stat(path)
+        store_path = utils.get_store_path(path)
+        membership = ConstituentsMembership.load(store_path, src_stat)
+        if membership is not None:
+            return membership
+
+        membership = ConstituentsMembership.from_workbook(path)
+        if membership is None:
+            print("No valid daily constituent data found in Excel.")
+            return ConstituentsMembership.empty_membership()
+        try:
+            membership.save(store_path, src_stat)
+        except Exception as e:
+            print(f"Warning: could not write constituents cache: {e}")
+        return membership
+    except Exception as e:
+        print(f"Error loading constituents: {e}")
+        return ConstituentsMembership.empty_membership()
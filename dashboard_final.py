@@ -28,6 +28,7 @@ from matplotlib.figure import Figure
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import config_final as config
 from selection import SelectionEngine
+from strategy_params import StrategyParams
 
 import sys as _sys
 _BASE = (os.path.dirname(_sys.executable)
@@ -648,7 +649,14 @@ class UnifiedDashboard:
 
             self.root.after(0, lambda: self.status_lbl.config(
                 text="正在下載最新數據..."))
-            update_data.main()
+
+            def on_progress(done, total, ticker, status):
+                pct = done / total * 100 if total else 100
+                self.root.after(0, lambda: self.progress_var.set(pct))
+                self.root.after(0, lambda: self.status_lbl.config(
+                    text=f"正在下載最新數據... {done}/{total} ({ticker})"))
+
+            update_data.main(progress_callback=on_progress)
 
             self.selector = None
             self.root.after(0, lambda: self.status_lbl.config(
@@ -747,10 +755,16 @@ class UnifiedDashboard:
 
             latest_date = spy_data.index[-1]
 
+            # 以目前 (可能剛重新載入的) config_final 建立本次計算的參數
+            params = StrategyParams.from_config(config)
+
             entry_scan = self.selector.scan_market(latest_date,
-                                                    lookback=config.LOOKBACK)
+                                                    lookback=params.LOOKBACK,
+                                                    params=params)
             exit_scan = self.selector.scan_market(latest_date,
-                                                   lookback=config.LOOKBACK)
+                                                   lookback=params.LOOKBACK,
+                                                   params=params)
+            self.selector.save_scan_cache()
 
             # ── 結構化輸出（tag, text）──
             out = []  # list of (tag, text)
@@ -760,12 +774,8 @@ class UnifiedDashboard:
                 if td is None or latest_date not in td.index:
                     return None, None, None
                 price = float(td.loc[latest_date, 'Close'])
-                ema_col = f'_EMA{config.EXIT_EMA}'
-                if ema_col not in td.columns:
-                    pc = 'Adj Close' if 'Adj Close' in td.columns else 'Close'
-                    td[ema_col] = td[pc].ewm(span=config.EXIT_EMA,
-                                             adjust=False).mean()
-                ema = float(td.loc[latest_date, ema_col])
+                ema = float(self.selector.get_indicator(
+                    ticker, 'EMA', params.EXIT_EMA).loc[latest_date])
                 return td, price, ema
 
             def get_rank(ticker, scan_list):
@@ -778,7 +788,8 @@ class UnifiedDashboard:
                 items = []
                 for t in ticker_list:
                     m = self.selector.calculate_metrics(t, latest_date,
-                                                        config.LOOKBACK)
+                                                        params.LOOKBACK,
+                                                        params=params)
                     if m and m.get('atr_pct', 0) > 0:
                         items.append(m)
                 if not items:
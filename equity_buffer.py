@@ -0,0 +1,96 @@
+"""
+Equity Buffer
+回測每日權益紀錄: 依交易日曆預先配置的 NumPy 緩衝區 (日期 + float64 欄位矩陣)，
+每日寫入一列，不建立 dict；frame() 回傳共用記憶體的 DataFrame (不複製資料)
+除權益與現金外另記錄每日曝險: 持倉總市值 / 權益、SSO 市值 / 權益、持股檔數
+"""
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['Equity', 'Cash', 'Gross_Exposure', 'SSO_Exposure', 'Positions']
+EQUITY, CASH, GROSS, SSO, POSITIONS = range(len(COLUMNS))
+
+
+class EquityBuffer:
+    INITIAL_CAPACITY = 256
+
+    def __init__(self, capacity=None):
+        capacity = capacity or self.INITIAL_CAPACITY
+        self._dates = np.empty(capacity, dtype='datetime64[ns]')
+        # 單一 float64 矩陣 (Positions 亦以 float 儲存)，frame() 才能不複製資料
+        self._values = np.empty((capacity, len(COLUMNS)), dtype=np.float64)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __bool__(self):
+        return self._size > 0
+
+    def reserve(self, capacity):
+        """確保至少可存 capacity 列 (回測開始時以交易日數呼叫一次)"""
+        if capacity <= len(self._dates):
+            return
+        dates = np.empty(capacity, dtype='datetime64[ns]')
+        values = np.empty((capacity, len(COLUMNS)), dtype=np.float64)
+        dates[:self._size] = self._dates[:self._size]
+        values[:self._size] = self._values[:self._size]
+        self._dates, self._values = dates, values
+
+    def _grow(self, extra):
+        need = self._size + extra
+        if need > len(self._dates):
+            self.reserve(max(need, 2 * len(self._dates)))
+
+    @staticmethod
+    def _exposures(equity, gross_value, sso_value):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.divide(gross_value, equity), np.divide(sso_value, equity)
+
+    def append(self, date, equity, cash, gross_value=0.0, sso_value=0.0, positions=0):
+        """記錄一日；gross_value / sso_value 為持倉總市值 / SSO 市值"""
+        self._grow(1)
+        k = self._size
+        gross, sso = self._exposures(equity, gross_value, sso_value)
+        self._dates[k] = np.datetime64(date, 'ns')
+        self._values[k] = (equity, cash, gross, sso, positions)
+        self._size += 1
+
+    def extend(self, dates, equity, cash, gross_value, sso_value, positions):
+        """一次記錄多日 (equity / gross_value / sso_value 為陣列，cash / positions 可為純量)"""
+        n = len(dates)
+        self._grow(n)
+        k = self._size
+        gross, sso = self._exposures(np.asarray(equity), gross_value, sso_value)
+        self._dates[k:k + n] = np.asarray(dates, dtype='datetime64[ns]')
+        block = self._values[k:k + n]
+        block[:, EQUITY] = equity
+        block[:, CASH] = cash
+        block[:, GROSS] = gross
+        block[:, SSO] = sso
+        block[:, POSITIONS] = positions
+        self._size += n
+
+    @property
+    def dates(self):
+        return pd.DatetimeIndex(self._dates[:self._size], name='Date', copy=False)
+
+    def column(self, name):
+        """單一欄位的 NumPy view"""
+        return self._values[:self._size, COLUMNS.index(name)]
+
+    def frame(self):
+        """
+        DataFrame view (index = Date)，與緩衝區共用記憶體
+        之後再 append 可能重新配置緩衝區，需要長期保存時請 .copy()
+        """
+        return pd.DataFrame(self._values[:self._size], index=self.dates, columns=COLUMNS, copy=False)
+
+    def curve(self):
+        """權益曲線 Series"""
+        return pd.Series(self.column('Equity'), index=self.dates, name='Equity', copy=False)
+
+    def to_records(self):
+        """舊版 list-of-dicts 格式 ({'Date', 'Equity', 'Cash'})"""
+        return [{'Date': d, 'Equity': e, 'Cash': c}
+                for d, e, c in zip(self.dates, self.column('Equity').tolist(), self.column('Cash').tolist())]
@@ -2,12 +2,16 @@ import pandas as pd
 import numpy as np
 
 class MarketRegime:
+    # SSO 抄底層級 (距 ATH 跌幅)
+    DIP_LEVELS = (0.15, 0.20, 0.25)
+
     def __init__(self, spy_df, sso_df):
         self.spy = spy_df.sort_index()
         self.sso = sso_df.sort_index()
         
         # 計算 SPY 指標
         self._calculate_indicators()
+        self._build_arrays()
     
     def _calculate_indicators(self):
         # 1. 200MA
@@ -20,27 +24,78 @@ class MarketRegime:
         # 計算目前價格距離 ATH 的跌幅 (Drawdown from ATH)
         self.spy['DD_ATH'] = (self.spy['Close'] - self.spy['ATH']) / self.spy['ATH']
 
+    def _build_arrays(self):
+        """
+        [OPTIMIZATION] 將指標存成對齊 SPY 日曆的 NumPy 陣列
+        查詢只需日期 → 列號 (dict / 二分搜尋)，之後皆為整數索引 O(1)
+        """
+        self.dates = self.spy.index
+        self._dates_ns = self.dates.values
+        self._row_index = {d: i for i, d in enumerate(self.dates)}
+
+        self.close = self.spy['Close'].values.astype(np.float64)
+        self.ma200 = self.spy['MA200'].values
+        self.ath = self.spy['ATH'].values
+        self.dd = self.spy['DD_ATH'].values
+        # MA200 不足 200 日為 NaN，兩個旗標皆為 False (與逐筆比較相同)
+        self.above_ma = self.close > self.ma200
+        self.below_ma = self.close < self.ma200
+        # 各抄底層級: |距 ATH 跌幅| >= level
+        self.dip_triggers = {level: np.abs(self.dd) >= level for level in self.DIP_LEVELS}
+
+    def row_of(self, date):
+        """date 當日 (或之前最近一個交易日) 的列號，早於資料起點回傳 -1"""
+        row = self._row_index.get(date)
+        if row is not None:
+            return row
+        try:
+            return int(np.searchsorted(self._dates_ns, np.datetime64(pd.Timestamp(date)), side='right')) - 1
+        except (TypeError, ValueError):
+            return -1
+
+    def rows_of(self, dates):
+        """一次取得多個日期的列號 (規則同 row_of)"""
+        dates = pd.DatetimeIndex(dates)
+        return np.searchsorted(self._dates_ns, dates.values, side='right') - 1
+
+    def state_at(self, row):
+        """第 row 列的市場狀態 (row < 0 回傳 None)"""
+        if row < 0:
+            return None
+        return {
+            'SPY_Close': self.close[row],
+            'SPY_MA200': self.ma200[row],
+            'SPY_ATH': self.ath[row],
+            'SPY_DD': self.dd[row]
+        }
+
     def get_state(self, date):
         """
         獲取指定日期的市場狀態
         """
         # 找到該日期或之前的最近一個交易日
-        if date not in self.spy.index:
-            try:
-                # 使用 asof 尋找最近的日期 (index 必須是 sorted)
-                idx = self.spy.index.get_indexer([date], method='pad')[0]
-                if idx == -1: return None # date is before start
-                row = self.spy.iloc[idx]
-            except:
-                return None
-        else:
-            row = self.spy.loc[date]
-            
+        return self.state_at(self.row_of(date))
+
+    def states(self, dates):
+        """
+        多個日期的市場狀態 (向量化版 get_state)
+        回傳 {'SPY_Close', 'SPY_MA200', 'SPY_ATH', 'SPY_DD': float 陣列 (無資料為 NaN),
+              'Above_MA200', 'Below_MA200': bool 陣列 (無資料為 False)}
+        """
+        rows = self.rows_of(dates)
+        found = rows >= 0
+        safe = np.where(found, rows, 0)
+
+        def take(arr, fill):
+            return np.where(found, arr[safe], fill)
+
         return {
-            'SPY_Close': row['Close'],
-            'SPY_MA200': row['MA200'],
-            'SPY_ATH': row['ATH'],
-            'SPY_DD': row['DD_ATH']
+            'SPY_Close': take(self.close, np.nan),
+            'SPY_MA200': take(self.ma200, np.nan),
+            'SPY_ATH': take(self.ath, np.nan),
+            'SPY_DD': take(self.dd, np.nan),
+            'Above_MA200': take(self.above_ma, False),
+            'Below_MA200': take(self.below_ma, False),
         }
 
     def is_bull_market(self, date):
@@ -48,14 +103,14 @@ class MarketRegime:
         判斷是否為牛市：
         條件：本周 (date) > 200MA  AND  上一周 (date - 7) > 200MA
         """
-        state_now = self.get_state(date)
-        if not state_now: return False
-        bull_now = state_now['SPY_Close'] > state_now['SPY_MA200']
+        row_now = self.row_of(date)
+        if row_now < 0: return False
+        bull_now = self.above_ma[row_now]
         
         # Check 7 days ago
         prev_date = date - pd.Timedelta(days=7)
-        state_prev = self.get_state(prev_date)
-        if not state_prev: return False # 如果數據不足，保守起見回傳 False
-        bull_prev = state_prev['SPY_Close'] > state_prev['SPY_MA200']
+        row_prev = self.row_of(prev_date)
+        if row_prev < 0: return False # 如果數據不足，保守起見回傳 False
+        bull_prev = self.above_ma[row_prev]
         
-        return bull_now and bull_prev
+        return bool(bull_now and bull_prev)
@@ -0,0 +1,255 @@
+"""
+Parameter Sweep
+以多個 process 平行執行 PortfolioBacktesterFinal (write_reports=False)，
+每組參數以 StrategyParams 傳入 (不修改 config 全域變數)，彙整 CAGR / Sharpe / MDD 成結果表
+股票資料與 panel 只在父程序載入一次: fork 時 copy-on-write 繼承，spawn 時寫成 memory-mapped 檔案由 worker attach
+
+用法:
+    space = {'LOOKBACK': [60, 90, 120], 'EXIT_EMA': [40, 50]}
+    df = run_sweep(grid(space), start_date='2020-01-01')
+"""
+import itertools
+import multiprocessing as mp
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import pandas as pd
+
+import config_final as config
+import utils
+from portfolio_backtester_final import PortfolioBacktesterFinal
+from selection import SelectionEngine
+from shared_data import attach_engine, export_engine
+from strategy_params import StrategyParams
+
+# 各 worker 共用的預載資料 (fork 時由父程序繼承 copy-on-write，spawn 時由 initializer attach memory-map)
+_SHARED = {}
+
+
+def grid(space):
+    """
+    網格展開: {'LOOKBACK': [60, 90], 'EXIT_EMA': [40, 50]} → 4 組 overrides dict
+    """
+    names = list(space.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*(space[n] for n in names))]
+
+
+def random_samples(space, n, seed=None):
+    """
+    從網格中隨機抽樣 n 組不重複的參數
+    """
+    rng = random.Random(seed)
+    all_sets = grid(space)
+    if n >= len(all_sets):
+        return all_sets
+    return rng.sample(all_sets, n)
+
+
+def performance_metrics(equity):
+    """
+    由權益曲線 (DatetimeIndex 的 Series) 計算績效，公式與 report_generator_final 相同
+    回傳 dict: Total Return %, CAGR %, Sharpe, MDD %
+    """
+    result = {'Final Equity': 0.0, 'Total Return %': 0.0, 'CAGR %': 0.0, 'Sharpe': 0.0, 'MDD %': 0.0}
+    if equity is None or equity.empty:
+        return result
+
+    initial_cap = equity.iloc[0]
+    final_cap = equity.iloc[-1]
+    result['Final Equity'] = final_cap
+    if initial_cap > 0:
+        result['Total Return %'] = (final_cap - initial_cap) / initial_cap * 100
+
+    # CAGR
+    days = (equity.index[-1] - equity.index[0]).days
+    if days > 0 and initial_cap > 0:
+        years = days / 365.25
+        result['CAGR %'] = ((final_cap / initial_cap) ** (1 / years) - 1) * 100
+
+    # Sharpe (日報酬年化)
+    daily_returns = equity.pct_change().dropna()
+    std_ret = daily_returns.std()
+    if std_ret and std_ret != 0:
+        result['Sharpe'] = daily_returns.mean() / std_ret * (252 ** 0.5)
+
+    # Max Drawdown
+    rolling_max = equity.cummax()
+    result['MDD %'] = ((equity - rolling_max) / rolling_max * 100).min()
+    return result
+
+
+def _load_benchmarks():
+    spy_df = utils.load_benchmark_data(os.path.join(config.DATA_DIR, 'SPY.csv'))
+    sso_df = utils.load_benchmark_data(os.path.join(config.DATA_DIR, 'SSO.csv'))
+    return spy_df, sso_df
+
+
+def _preload_shared():
+    """載入 SPY/SSO 與所有股票資料到 _SHARED (每個程序只做一次)"""
+    if _SHARED:
+        return
+    spy_df, sso_df = _load_benchmarks()
+    selector = SelectionEngine()
+    selector.preload_all_data()
+    _SHARED.update(selector=selector, spy_df=spy_df, sso_df=sso_df)
+
+
+def shared_context():
+    """
+    本程序共用的預載資料 (第一次呼叫時載入): {'selector', 'spy_df', 'sso_df'}
+    walk_forward 等模組用來取得交易日曆，與 worker 使用同一份 SelectionEngine
+    """
+    _preload_shared()
+    return dict(_SHARED)
+
+
+def _warm_shared(param_sets):
+    """在父程序預先建立所有參數組合需要的指標 (worker 共用，不必各自計算)"""
+    selector = _SHARED['selector']
+    for overrides in param_sets:
+        selector.warm_indicators(StrategyParams.from_config(config, **overrides))
+
+
+def _attach_shared(directory):
+    """spawn worker 的 initializer: attach 父程序寫出的 memory-mapped 資料"""
+    if _SHARED:
+        return
+    spy_df, sso_df = _load_benchmarks()
+    _SHARED.update(selector=attach_engine(directory), spy_df=spy_df, sso_df=sso_df)
+
+
+def _run_one(job):
+    """
+    Worker: 執行單一參數組合，回傳一列結果 (含參數與績效)
+    job: (overrides, start_date, end_date, initial_capital, compounding, keep_curve)；
+    keep_curve 為 True 時附上權益曲線 (row['Equity Curve'])
+    """
+    overrides, start_date, end_date, initial_capital, compounding, keep_curve = job
+    _preload_shared()
+
+    row = dict(overrides)
+    t0 = time.time()
+    try:
+        params = StrategyParams.from_config(config, **overrides)
+        bt = PortfolioBacktesterFinal(
+            start_date=start_date,
+            end_date=end_date,
+            initial_capital=initial_capital,
+            compounding=compounding,
+            selector=_SHARED['selector'],
+            spy_df=_SHARED['spy_df'],
+            sso_df=_SHARED['sso_df'],
+            write_reports=False,
+            params=params,
+        )
+        bt.run()
+        curve = bt.equity_history.curve()
+        row.update(performance_metrics(curve))
+        if keep_curve:
+            row['Equity Curve'] = curve.copy()
+        row['Trades'] = len(bt.ledger)
+        row['Error'] = ''
+    except Exception as e:
+        row['Error'] = f"{type(e).__name__}: {e}"
+    row['Seconds'] = round(time.time() - t0, 2)
+    return row
+
+
+def _run_indexed(item):
+    k, job = item
+    return k, _run_one(job)
+
+
+def run_jobs(jobs, processes=None, progress_callback=None, start_method=None):
+    """
+    平行執行 _run_one 的 job 列表，回傳與 jobs 同順序的結果列
+    processes: worker 數量 (預設 CPU 數，1 = 在目前程序中依序執行)
+    progress_callback: 選用，callback(done, total)
+    start_method: 'fork' / 'spawn' (預設: 平台支援 fork 時使用 fork)
+    """
+    total = len(jobs)
+    processes = processes or os.cpu_count() or 1
+    processes = max(1, min(processes, total or 1))
+
+    rows = [None] * total
+    done = 0
+    if processes == 1:
+        for k, job in enumerate(jobs):
+            rows[k] = _run_one(job)
+            done += 1
+            if progress_callback:
+                progress_callback(done, total)
+        return rows
+
+    # 父程序預載一次並預先建立所有組合的指標
+    _preload_shared()
+    unique_sets = {repr(sorted(job[0].items())): job[0] for job in jobs}
+    _warm_shared(list(unique_sets.values()))
+    if start_method is None:
+        start_method = 'fork' if 'fork' in mp.get_all_start_methods() else 'spawn'
+    ctx = mp.get_context(start_method)
+    shared_dir = None
+    if start_method == 'fork':
+        # [OPTIMIZATION] fork: worker 共享同一份記憶體頁面 (copy-on-write)
+        initializer, initargs = None, ()
+    else:
+        # [OPTIMIZATION] spawn: 資料與 panel 寫成 memory-mapped 檔案，worker attach (zero-copy)
+        shared_dir = tempfile.mkdtemp(prefix='sweep_shared_')
+        export_engine(_SHARED['selector'], shared_dir)
+        initializer, initargs = _attach_shared, (shared_dir,)
+    try:
+        with ctx.Pool(processes=processes, initializer=initializer, initargs=initargs) as pool:
+            for k, row in pool.imap_unordered(_run_indexed, enumerate(jobs)):
+                rows[k] = row
+                done += 1
+                if progress_callback:
+                    progress_callback(done, total)
+    finally:
+        if shared_dir is not None:
+            shutil.rmtree(shared_dir, ignore_errors=True)
+    return rows
+
+
+def run_sweep(param_sets, start_date=None, end_date=None, initial_capital=None,
+              compounding=True, processes=None, sort_by='Sharpe', progress_callback=None,
+              start_method=None):
+    """
+    平行執行參數掃描
+    param_sets: overrides dict 列表 (grid / random_samples 產生)
+    processes: worker 數量 (預設 CPU 數，1 = 在目前程序中依序執行)
+    progress_callback: 選用，callback(done, total)
+    start_method: 'fork' / 'spawn' (預設: 平台支援 fork 時使用 fork)
+    回傳 DataFrame (每組參數一列，依 sort_by 由大到小排序)
+    """
+    start_date = start_date if start_date is not None else config.START_DATE
+    end_date = end_date if end_date is not None else config.END_DATE
+    initial_capital = initial_capital if initial_capital is not None else config.INITIAL_CASH
+
+    # 先驗證參數名稱，避免在 worker 中才失敗
+    for overrides in param_sets:
+        StrategyParams.from_config(config, **overrides)
+
+    jobs = [(dict(o), start_date, end_date, initial_capital, compounding, False) for o in param_sets]
+    rows = run_jobs(jobs, processes=processes, progress_callback=progress_callback, start_method=start_method)
+
+    results = pd.DataFrame(rows)
+    if sort_by in results.columns:
+        results = results.sort_values(sort_by, ascending=False).reset_index(drop=True)
+    return results
+
+
+if __name__ == "__main__":
+    space = {
+        'LOOKBACK': [60, 90, 120],
+        'EXIT_EMA': [40, 50],
+        'TARGET_HOLDINGS': [4, 6],
+    }
+    param_sets = grid(space)
+    print(f"Running {len(param_sets)} parameter sets...")
+    results = run_sweep(param_sets, progress_callback=lambda d, t: print(f"  {d}/{t} done"))
+    results.to_csv('param_sweep_results.csv', index=False)
+    print(results.to_string())
+    print("Saved to param_sweep_results.csv")
@@ -7,18 +7,31 @@ import pandas as pd
 import config_final as config
 from selection import SelectionEngine
 from market_regime import MarketRegime
+from equity_buffer import EquityBuffer
+from trade_ledger import TradeLedger, BUY, SELL, format_holdings
+from strategy_params import StrategyParams
 import utils
 import os
+import numpy as np
 
 class PortfolioBacktesterFinal:
-    def __init__(self, start_date, end_date, initial_capital=100000, compounding=False, report_suffix="", selector=None, spy_df=None, sso_df=None, write_reports=True):
+    def __init__(self, start_date, end_date, initial_capital=100000, compounding=False, report_suffix="", selector=None, spy_df=None, sso_df=None, write_reports=True, params=None, event_driven=True):
+        # 策略參數: StrategyParams、覆寫欄位的 dict、或 None (使用 config_final)
+        if isinstance(params, StrategyParams):
+            self.params = params
+        else:
+            self.params = StrategyParams.from_config(config, **(params or {}))
+        
         self.initial_capital = initial_capital
         self.cash = initial_capital
         self.holdings = {}      # {ticker: quantity}
         self.avg_costs = {}     # {ticker: avg_cost_per_share}
         self.target_weights = {}  # V3: {ticker: target_weight} 目標權重追蹤
-        self.history = []       # 記錄每日權益
-        self.trades = []        # 記錄交易
+        self.equity_history = EquityBuffer()  # 記錄每日權益與曝險
+        self.ledger = TradeLedger()  # 記錄交易 (持倉快照於輸出報表時才產生)
+        # trades / history 相容屬性的快取: (產生時的筆數, list-of-dicts)
+        self._trade_records = None
+        self._history_records = None
         
         self.compounding = compounding
         self.report_suffix = report_suffix
@@ -28,8 +41,11 @@ class PortfolioBacktesterFinal:
         self.preloaded_spy = spy_df
         self.preloaded_sso = sso_df
         self.write_reports = write_reports
+        # 事件驅動迴圈 (只在調倉/停損/跳空/熊市事件日執行完整流程)；False 則逐日執行
+        self.event_driven = event_driven
         
         # Dip Buying State
+        self.dip_ticker = config.DIP_BUY_TICKER  # 抄底標的 (迴圈中不再讀取 config)
         self.dip_state = {0.15: False, 0.20: False, 0.25: False}
         
         # [NEW] Bull Market Confirmation - 需連續兩周 SPY > 200MA
@@ -69,7 +85,7 @@ class PortfolioBacktesterFinal:
         if self.selector_instance:
             self.selector = self.selector_instance
         else:
-            self.selector = SelectionEngine()
+            self.selector = SelectionEngine(params=self.params)
         
         # === 預載入所有股票資料到記憶體 (Performance Optimization) ===
         if self.write_reports:
@@ -79,6 +95,23 @@ class PortfolioBacktesterFinal:
         # 建立全局交易日曆 (以 SPY 為準)
         self.calendar = self.spy_df.index
         
+        # === 價格存取層 (Performance Optimization) ===
+        # 日期 → 日曆列號只建一次，各股票 Open/Close 對齊日曆存成 NumPy 陣列
+        self._date_rows = {d: i for i, d in enumerate(self.calendar)}
+        self._price_arrays = {}  # {ticker: (opens, closes) or None}
+        self._gap_cache = {}     # {(ticker, GAP_EXIT_PCT): 各日曆列是否跳空超過門檻}
+        self._cur_date = None    # 目前回測日 (run 迴圈每日設定一次)
+        self._cur_row = -1
+        # 日曆列 → MarketRegime 陣列列號 (熊市/SSO 判斷以整數索引讀取)
+        self._regime_rows = self.market_regime.rows_of(self.calendar)
+        
+        # === 每日估值快取 ===
+        # 每個日期只 mark-to-market 一次，之後交易以增量更新持倉市值
+        self._val_date = None
+        self._marks = {}           # {ticker: 估值日收盤價}
+        self._holdings_value = 0.0
+        self._val_exact = True     # _holdings_value 是否為完整估值 (當日有交易時為增量結果)
+        
     def run(self):
         mode_str = "Compound" if self.compounding else "Simple"
         if self.write_reports:
@@ -88,42 +121,19 @@ class PortfolioBacktesterFinal:
         # 建立交易日曆
         trading_days = self.calendar[(self.calendar >= self.start_date) & (self.calendar <= self.end_date)]
         
+        # 權益紀錄依交易日數預先配置 (LIVE_MODE 結束時多記一筆)
+        self.equity_history.reserve(len(self.equity_history) + len(trading_days) + 1)
+        
         # 追蹤 SSO 觸發狀態
         self.dip_state = {0.15: False, 0.20: False, 0.25: False}
         
-        total_days = len(trading_days)
-        for i, date in enumerate(trading_days):
-            # Progress Reporting
-            if self.write_reports and (i % 500 == 0 or i == total_days - 1):
-                progress = int((i + 1) / total_days * 100)
-                print(f"[PROGRESS] {progress}", flush=True)
-            
-            # 1. Stop Loss Check (Prior to updating equity)
-            if i > 0:
-                prev_date = trading_days[i-1]
-                self._check_stop_loss(date, prev_date)
-                self._check_gap_exit(date, prev_date)
-
-            # 每日更新淨值
-            self._update_equity(date)
-            
-            # --- Daily Checks (Bear Flow & SSO) ---
-            self._check_bear_sso_logic(date)
-            
-            # --- 統一換股/再平衡日 (使用 REBALANCE_WEEKDAY) ---
-            iso_week = date.isocalendar()[1]
-            is_rebalance_day = (date.weekday() == config.REBALANCE_WEEKDAY)
-            is_rotation_week = (iso_week % config.REBALANCE_WEEKS == 0)
-            
-            if is_rebalance_day:
-                prev_idx = i - 1
-                signal_date = trading_days[prev_idx] if prev_idx >= 0 else date
-                
-                # === V3 核心：統一先賣後買流程 ===
-                self._unified_rebalance(date, signal_date, is_rotation_week)
+        if self.event_driven:
+            self._run_events(trading_days)
+        else:
+            self._run_daily(trading_days)
             
         # End of Backtest: LIVE_MODE keeps holdings, otherwise close all
-        live_mode = getattr(config, 'LIVE_MODE', False)
+        live_mode = self.params.LIVE_MODE
         if not live_mode:
             self._force_close_all(self.end_date)
         else:
@@ -134,6 +144,161 @@ class PortfolioBacktesterFinal:
         if self.write_reports:
             self._generate_report()
 
+    def _report_progress(self, i, total_days):
+        if self.write_reports and (i % 500 == 0 or i == total_days - 1):
+            progress = int((i + 1) / total_days * 100)
+            print(f"[PROGRESS] {progress}", flush=True)
+
+    def _process_day(self, i, trading_days):
+        """第 i 個交易日的完整每日流程 (停損/跳空 → 淨值 → 熊市/SSO → 調倉)"""
+        date = trading_days[i]
+        self._cur_date = date
+        self._cur_row = self._date_rows[date]
+        
+        # 1. Stop Loss Check (Prior to updating equity)
+        if i > 0:
+            prev_date = trading_days[i-1]
+            self._check_stop_loss(date, prev_date)
+            self._check_gap_exit(date, prev_date)
+
+        # 每日更新淨值
+        self._update_equity(date)
+        
+        # --- Daily Checks (Bear Flow & SSO) ---
+        self._check_bear_sso_logic(date)
+        
+        # --- 統一換股/再平衡日 (使用 REBALANCE_WEEKDAY) ---
+        iso_week = date.isocalendar()[1]
+        is_rebalance_day = (date.weekday() == self.params.REBALANCE_WEEKDAY)
+        is_rotation_week = (iso_week % self.params.REBALANCE_WEEKS == 0)
+        
+        if is_rebalance_day:
+            prev_idx = i - 1
+            signal_date = trading_days[prev_idx] if prev_idx >= 0 else date
+            
+            # === V3 核心：統一先賣後買流程 ===
+            self._unified_rebalance(date, signal_date, is_rotation_week)
+
+    def _run_daily(self, trading_days):
+        """逐日迴圈: 每個交易日都執行完整流程"""
+        total_days = len(trading_days)
+        for i in range(total_days):
+            self._report_progress(i, total_days)
+            self._process_day(i, trading_days)
+
+    def _run_events(self, trading_days):
+        """
+        [OPTIMIZATION] 事件驅動迴圈: 只在需要處理的日期執行完整的每日流程
+        事件日 = 調倉日、持股前一日收盤低於停損價或前一日跳空超過 GAP_EXIT_PCT 的日期、
+                 熊市中需要清倉個股或尚有未觸發抄底層級的日期
+        兩個事件日之間持倉與現金不變，淨值以收盤價矩陣一次算出 (與逐日計算相同)
+        """
+        total_days = len(trading_days)
+        if total_days == 0:
+            return
+        rows = self.calendar.get_indexer(trading_days)
+        rebalance_days = np.nonzero(trading_days.weekday == self.params.REBALANCE_WEEKDAY)[0]
+        spy_below, spy_dd = self._regime_arrays(trading_days)
+        
+        i = 0
+        while i < total_days:
+            self._report_progress(i, total_days)
+            self._process_day(i, trading_days)
+            j = self._next_event(i, total_days, rows, rebalance_days, spy_below, spy_dd)
+            if j > i + 1:
+                for k in range(i + 1, j):
+                    self._report_progress(k, total_days)
+                self._fill_equity(trading_days, rows, i + 1, j)
+            i = j
+
+    def _regime_arrays(self, trading_days):
+        """交易日對應的 (SPY < 200MA, |距 ATH 跌幅|) 陣列 (無資料為 False / NaN)"""
+        states = self.market_regime.states(trading_days)
+        return states['Below_MA200'], np.abs(states['SPY_DD'])
+
+    def _gap_flags(self, ticker):
+        """
+        ticker 在每個日曆列 p 是否出現 |Open[p] / Close[p-1] - 1| >= GAP_EXIT_PCT 的跳空 (與 _check_gap_exit 相同)
+        第一次使用時建立
+        """
+        key = (ticker, self.params.GAP_EXIT_PCT)
+        flags = self._gap_cache.get(key)
+        if flags is None:
+            arrays = self._get_price_arrays(ticker)
+            flags = np.zeros(len(self.calendar), dtype=bool)
+            if arrays is not None:
+                opens, closes = arrays
+                prev_close = closes[:-1]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    gap = (opens[1:] - prev_close) / prev_close
+                    flags[1:] = (prev_close > 0) & (opens[1:] > 0) & (np.abs(gap) >= self.params.GAP_EXIT_PCT)
+            self._gap_cache[key] = flags
+        return flags
+
+    def _next_event(self, i, total_days, rows, rebalance_days, spy_below, spy_dd):
+        """第 i 日之後的下一個事件日 (無則為 total_days)；持倉、現金、牛市計數在此之前皆不變"""
+        k = np.searchsorted(rebalance_days, i, side='right')
+        end = int(rebalance_days[k]) if k < len(rebalance_days) else total_days
+        lo = i + 1
+        if end <= lo:
+            return end
+        
+        # 熊市: 未確認牛市、SPY < 200MA，且有個股要清倉或有尚未觸發的抄底層級
+        hit = np.zeros(end - lo, dtype=bool)
+        if self.bull_weeks_counter < 2:
+            if any(t != self.dip_ticker for t in self.holdings):
+                hit |= spy_below[lo:end]
+            else:
+                pending = [level for level, done in self.dip_state.items() if not done]
+                if pending:
+                    hit |= spy_below[lo:end] & (spy_dd[lo:end] >= min(pending))
+        
+        # 個股停損 / 跳空出場: 以前一個交易日 (日曆前一列) 判斷
+        prev_rows = rows[lo:end] - 1
+        for ticker in self.holdings:
+            if ticker == self.dip_ticker:
+                continue
+            arrays = self._get_price_arrays(ticker)
+            if arrays is None:
+                continue
+            avg_cost = self.avg_costs.get(ticker, 0)
+            if avg_cost > 0:
+                prev_close = arrays[1][prev_rows]
+                hit |= (prev_close > 0) & (prev_close < avg_cost * (1 - self.params.STOP_LOSS_PCT))
+            hit |= self._gap_flags(ticker)[prev_rows]
+        
+        if hit.any():
+            return lo + int(np.argmax(hit))
+        return end
+
+    def _fill_equity(self, trading_days, rows, start, end):
+        """
+        [start, end) 之間沒有事件的交易日: 持倉不變，淨值 = 現金 + Σ 持股數 × 收盤價 (無資料以 0 計)
+        累加順序與 _mark_to_market 相同，結果逐位元一致
+        """
+        r = rows[start:end]
+        value = np.zeros(end - start)
+        sso_value = np.zeros(end - start)
+        for ticker, qty in self.holdings.items():
+            arrays = self._get_price_arrays(ticker)
+            if arrays is None:
+                continue
+            closes = arrays[1][r]
+            position_value = np.where(np.isnan(closes), 0.0, closes) * qty
+            value += position_value
+            if ticker == self.dip_ticker:
+                sso_value += position_value
+        self.equity_history.extend(trading_days[start:end].values, self.cash + value, self.cash,
+                                   value, sso_value, len(self.holdings))
+
+    def _scan_market(self, date):
+        """以本次回測的參數呼叫 selector.scan_market"""
+        return self.selector.scan_market(date, lookback=self.params.LOOKBACK, params=self.params)
+
+    def _calculate_metrics(self, ticker, date):
+        """以本次回測的參數呼叫 selector.calculate_metrics"""
+        return self.selector.calculate_metrics(ticker, date, self.params.LOOKBACK, params=self.params)
+
     def _calculate_atr_weights(self, candidates_with_atr):
         """
         V3: 計算基於 ATR 的反比例權重
@@ -171,7 +336,7 @@ class PortfolioBacktesterFinal:
         bull_confirmed = (self.bull_weeks_counter >= 2)
         
         if not bull_confirmed:
-            current_stocks = [t for t in self.holdings if t != config.DIP_BUY_TICKER]
+            current_stocks = [t for t in self.holdings if t != self.dip_ticker]
             if current_stocks:
                 self._close_positions(date, target_type='STOCK')
                 self.target_weights.clear()
@@ -200,12 +365,12 @@ class PortfolioBacktesterFinal:
         
         if not full_weights:
             # 非輪動週或無候選：用當前持股算權重
-            current_stocks = [t for t in self.holdings if t != config.DIP_BUY_TICKER and t != 'SPY'
+            current_stocks = [t for t in self.holdings if t != self.dip_ticker and t != 'SPY'
                               and t not in rotation_sell_tickers]
             if current_stocks:
                 holdings_with_atr = []
                 for ticker in current_stocks:
-                    metrics = self.selector.calculate_metrics(ticker, date, config.LOOKBACK)
+                    metrics = self._calculate_metrics(ticker, date)
                     if metrics and metrics.get('atr_pct', 0) > 0:
                         holdings_with_atr.append(metrics)
                 if holdings_with_atr:
@@ -237,8 +402,8 @@ class PortfolioBacktesterFinal:
                     continue
                 alloc_amount = curr_equity * full_weight
                 buy_amount = min(alloc_amount, self.cash)
-                qty = int(buy_amount / (exec_price * (1 + config.COMMISSION)))
-                if qty > 0 and self.cash >= exec_price * qty * (1 + config.COMMISSION):
+                qty = int(buy_amount / (exec_price * (1 + self.params.COMMISSION)))
+                if qty > 0 and self.cash >= exec_price * qty * (1 + self.params.COMMISSION):
                     reason = f"V3 ATR Buy (W:{full_weight*100:.1f}%)"
                     self._buy(ticker, date, exec_price, qty, reason, target_weight=full_weight)
                     newly_bought_tickers.add(ticker)
@@ -262,7 +427,7 @@ class PortfolioBacktesterFinal:
         if exclude_tickers is None:
             exclude_tickers = set()
         
-        current_stocks = [t for t in self.holdings if t != config.DIP_BUY_TICKER and t != 'SPY']
+        current_stocks = [t for t in self.holdings if t != self.dip_ticker and t != 'SPY']
         current_stocks = [t for t in current_stocks if t not in exclude_tickers]
         
         if not current_stocks:
@@ -284,7 +449,7 @@ class PortfolioBacktesterFinal:
         else:
             holdings_with_atr = []
             for ticker in current_stocks:
-                metrics = self.selector.calculate_metrics(ticker, date, config.LOOKBACK)
+                metrics = self._calculate_metrics(ticker, date)
                 if metrics and metrics.get('atr_pct', 0) > 0:
                     holdings_with_atr.append(metrics)
             if not holdings_with_atr:
@@ -293,7 +458,7 @@ class PortfolioBacktesterFinal:
             self.target_weights = dynamic_target_weights.copy()
         
         # 檢查超重並賣出
-        rebalance_threshold = config.REBALANCE_THRESHOLD
+        rebalance_threshold = self.params.REBALANCE_THRESHOLD
         if rebalance_threshold < 0.01:
             rebalance_threshold = 0.03
         
@@ -335,7 +500,7 @@ class PortfolioBacktesterFinal:
         if exclude_tickers is None:
             exclude_tickers = set()
         
-        current_stocks = [t for t in self.holdings if t != config.DIP_BUY_TICKER and t != 'SPY']
+        current_stocks = [t for t in self.holdings if t != self.dip_ticker and t != 'SPY']
         
         if not current_stocks or self.cash <= 0:
             return
@@ -365,7 +530,7 @@ class PortfolioBacktesterFinal:
             shortfall = target_w - current_w  # 低配程度 (正值表示低配)
             
             # 只有低配超過門檻 (3%) 才補足
-            rebalance_threshold = config.REBALANCE_THRESHOLD
+            rebalance_threshold = self.params.REBALANCE_THRESHOLD
             if rebalance_threshold < 0.01:
                 rebalance_threshold = 0.03
             
@@ -388,7 +553,7 @@ class PortfolioBacktesterFinal:
         available_cash = self.cash * 0.99  # 保留 1% buffer
         
         # 最小買入金額門檻 (總權益的百分比，例如 3%)
-        min_buy_pct = getattr(config, 'MIN_BUY_AMOUNT_PCT', 0.03)
+        min_buy_pct = self.params.MIN_BUY_AMOUNT_PCT
         min_buy_amount = total_equity * min_buy_pct
         
         for stock in underweight_stocks:
@@ -396,11 +561,11 @@ class PortfolioBacktesterFinal:
             alloc_ratio = stock['shortfall'] / total_shortfall
             alloc_amount = available_cash * alloc_ratio
             
-            qty = int(alloc_amount / (stock['price'] * (1 + config.COMMISSION)))
+            qty = int(alloc_amount / (stock['price'] * (1 + self.params.COMMISSION)))
             buy_amount = stock['price'] * qty
             
             # 檢查：買入金額需 >= 總權益的 MIN_BUY_AMOUNT_PCT，且有足夠現金
-            if buy_amount >= min_buy_amount and self.cash >= buy_amount * (1 + config.COMMISSION):
+            if buy_amount >= min_buy_amount and self.cash >= buy_amount * (1 + self.params.COMMISSION):
                 reason = f"V3 低配補足 (目標:{stock['target_w']*100:.1f}%)"
                 self._buy(stock['ticker'], date, stock['price'], qty, reason, target_weight=stock['target_w'])
 
@@ -411,13 +576,13 @@ class PortfolioBacktesterFinal:
         """
         sells = []
         
-        exit_ranked_list = self.selector.scan_market(signal_date, lookback=config.LOOKBACK)
+        exit_ranked_list = self._scan_market(signal_date)
         exit_candidate_tickers = [x['ticker'] for x in exit_ranked_list]
         
-        top_n_threshold = config.SELL_RANK_THRESHOLD
+        top_n_threshold = self.params.SELL_RANK_THRESHOLD
         top_for_exit = exit_candidate_tickers[:top_n_threshold]
         
-        current_stocks = [t for t in self.holdings if t != config.DIP_BUY_TICKER and t != 'SPY']
+        current_stocks = [t for t in self.holdings if t != self.dip_ticker and t != 'SPY']
         
         for ticker in current_stocks:
             should_sell = False
@@ -434,7 +599,7 @@ class PortfolioBacktesterFinal:
                     exit_ema = metrics['exit_ema']
                     if price < exit_ema:
                         should_sell = True
-                        reason = f"股價跌破EMA{config.EXIT_EMA}"
+                        reason = f"股價跌破EMA{self.params.EXIT_EMA}"
             
             if should_sell:
                 exec_price = self._get_price(ticker, date, use_open=True)
@@ -451,24 +616,24 @@ class PortfolioBacktesterFinal:
             buy_candidates_info: [(ticker, exec_price), ...]
             full_weights: {ticker: weight, ...} 包含保留持股 + 新候選的完整權重
         """
-        entry_ranked_list = self.selector.scan_market(signal_date, lookback=config.LOOKBACK)
+        entry_ranked_list = self._scan_market(signal_date)
         initial_count = len(entry_ranked_list)
         
         # Filter by MAX_ADJ_SLOPE (過熱保護機制)
-        max_adj_slope = getattr(config, 'MAX_ADJ_SLOPE', None)
+        max_adj_slope = self.params.MAX_ADJ_SLOPE
         if max_adj_slope is not None:
             entry_ranked_list = [x for x in entry_ranked_list if x.get('adj_slope', 999) < max_adj_slope]
         after_slope_filter = len(entry_ranked_list)
         
         # Filter by SKIP_MAX_GAP_PCT (跳空缺口過濾)
-        skip_max_gap = getattr(config, 'SKIP_MAX_GAP_PCT', 0.20)
+        skip_max_gap = self.params.SKIP_MAX_GAP_PCT
         entry_ranked_list = [x for x in entry_ranked_list if x.get('max_gap', 0) < skip_max_gap]
         after_gap_filter = len(entry_ranked_list)
         
         entry_candidate_tickers = [x['ticker'] for x in entry_ranked_list]
         
-        current_stocks = [t for t in self.holdings if t != config.DIP_BUY_TICKER and t != 'SPY']
-        target_count = config.TARGET_HOLDINGS
+        current_stocks = [t for t in self.holdings if t != self.dip_ticker and t != 'SPY']
+        target_count = self.params.TARGET_HOLDINGS
         needed = target_count - len(current_stocks)
         
         if self.write_reports and needed > 0:
@@ -483,26 +648,28 @@ class PortfolioBacktesterFinal:
         if needed > 0:
             buy_candidates = [t for t in entry_candidate_tickers if t not in current_stocks]
 
-            if getattr(config, 'CORR_FILTER_ENABLED', False) and needed > 0:
+            if self.params.CORR_FILTER_ENABLED and needed > 0:
                 # 殘差相關性過濾
                 candidate_metrics = [x for x in entry_ranked_list if x['ticker'] in buy_candidates]
                 to_buy_tickers = self.selector.filter_by_residual_correlation(
                     ranked_candidates=candidate_metrics,
                     date=signal_date,
                     spy_df=self.spy_df,
-                    threshold=config.CORR_THRESHOLD,
-                    lookback=config.CORR_LOOKBACK,
-                    max_candidates=config.CORR_CANDIDATE_COUNT,
+                    threshold=self.params.CORR_THRESHOLD,
+                    lookback=self.params.CORR_LOOKBACK,
+                    max_candidates=self.params.CORR_CANDIDATE_COUNT,
                     needed=needed,
-                    existing_tickers=current_stocks
+                    existing_tickers=current_stocks,
+                    rolling=self.params.CORR_ROLLING,
+                    shrinkage=self.params.CORR_SHRINKAGE
                 )
             else:
                 to_buy_tickers = buy_candidates[:needed]
             
             if self.write_reports:
                 print(f"  [ROTATION] Buy candidates available: {len(buy_candidates)}")
-                if getattr(config, 'CORR_FILTER_ENABLED', False):
-                    print(f"  [CORR] Residual correlation filter: threshold={config.CORR_THRESHOLD}, lookback={config.CORR_LOOKBACK}")
+                if self.params.CORR_FILTER_ENABLED:
+                    print(f"  [CORR] Residual correlation filter: threshold={self.params.CORR_THRESHOLD}, lookback={self.params.CORR_LOOKBACK}")
                 print(f"  [ROTATION] Selected to buy: {to_buy_tickers}")
             
             # 獲取候選股票的執行價格
@@ -517,7 +684,7 @@ class PortfolioBacktesterFinal:
             for ticker in all_tickers:
                 metrics = next((x for x in entry_ranked_list if x['ticker'] == ticker), None)
                 if metrics is None:
-                    metrics = self.selector.calculate_metrics(ticker, date, config.LOOKBACK)
+                    metrics = self._calculate_metrics(ticker, date)
                 if metrics and metrics.get('atr_pct', 0) > 0:
                     all_with_atr.append(metrics)
             
@@ -528,7 +695,7 @@ class PortfolioBacktesterFinal:
             for ticker in current_stocks:
                 metrics = next((x for x in entry_ranked_list if x['ticker'] == ticker), None)
                 if metrics is None:
-                    metrics = self.selector.calculate_metrics(ticker, date, config.LOOKBACK)
+                    metrics = self._calculate_metrics(ticker, date)
                 if metrics and metrics.get('atr_pct', 0) > 0:
                     all_with_atr.append(metrics)
             full_weights = self._calculate_atr_weights(all_with_atr)
@@ -547,7 +714,7 @@ class PortfolioBacktesterFinal:
         current_holdings = list(self.holdings.keys())
         
         for ticker in current_holdings:
-            if ticker == config.DIP_BUY_TICKER:
+            if ticker == self.dip_ticker:
                 continue
                 
             price_close_prev = self._get_price(ticker, prev_date, use_open=False)
@@ -555,7 +722,7 @@ class PortfolioBacktesterFinal:
             
             avg_cost = self.avg_costs.get(ticker, 0)
             if avg_cost > 0:
-                threshold = avg_cost * (1 - config.STOP_LOSS_PCT)
+                threshold = avg_cost * (1 - self.params.STOP_LOSS_PCT)
                 
                 if price_close_prev < threshold:
                     price_open_curr = self._get_price(ticker, date, use_open=True)
@@ -573,16 +740,16 @@ class PortfolioBacktesterFinal:
         則於今日開盤出場
         """
         current_holdings = list(self.holdings.keys())
-        gap_threshold = getattr(config, 'GAP_EXIT_PCT', 0.15)
+        gap_threshold = self.params.GAP_EXIT_PCT
         
         for ticker in current_holdings:
-            if ticker == config.DIP_BUY_TICKER:
+            if ticker == self.dip_ticker:
                 continue
             
             price_open_prev = self._get_price(ticker, prev_date, use_open=True)
             
             try:
-                prev_idx = self.calendar.get_loc(prev_date)
+                prev_idx = self._date_rows[prev_date]
                 if prev_idx > 0:
                     day_before_prev = self.calendar[prev_idx - 1]
                     price_close_before = self._get_price(ticker, day_before_prev, use_open=False)
@@ -609,18 +776,18 @@ class PortfolioBacktesterFinal:
         2. [NEW] SPY > 200MA 連續兩周 → 清倉 SSO，啟動牛市策略
         3. SSO 分批抄底: -15%, -20%, -25%
         """
-        state = self.market_regime.get_state(date)
-        if not state: return
-        
-        spy_close = state['SPY_Close']
-        spy_ma200 = state['SPY_MA200']
-        spy_dd = abs(state['SPY_DD'])
+        regime = self.market_regime
+        if date is self._cur_date:
+            r = int(self._regime_rows[self._cur_row])
+        else:
+            r = regime.row_of(date)
+        if r < 0: return
         
-        is_rebalance_day = (date.weekday() == config.REBALANCE_WEEKDAY)
+        is_rebalance_day = (date.weekday() == self.params.REBALANCE_WEEKDAY)
         
         # === 市場狀態判斷（每周更新） ===
         if is_rebalance_day:
-            if spy_close > spy_ma200:
+            if regime.above_ma[r]:
                 # SPY > 200MA: 增加牛市計數器
                 self.bull_weeks_counter += 1
             else:
@@ -632,7 +799,7 @@ class PortfolioBacktesterFinal:
         
         if bull_confirmed:
             # [牛市確認] 清倉 SSO，允許個股交易
-            if is_rebalance_day and config.DIP_BUY_TICKER in self.holdings:
+            if is_rebalance_day and self.dip_ticker in self.holdings:
                 self._close_positions(date, target_type='DIP')
                 for k in self.dip_state: 
                     self.dip_state[k] = False
@@ -640,9 +807,9 @@ class PortfolioBacktesterFinal:
             return
 
         # === 熊市邏輯：SPY < 200MA ===
-        if spy_close < spy_ma200:
+        if regime.below_ma[r]:
             # 清倉所有個股（如果有的話）
-            current_stocks = [t for t in self.holdings if t != config.DIP_BUY_TICKER]
+            current_stocks = [t for t in self.holdings if t != self.dip_ticker]
             if current_stocks:
                 self._close_positions(date, target_type='STOCK')
                 # V3: 清除所有目標權重
@@ -652,7 +819,7 @@ class PortfolioBacktesterFinal:
             dip_allocations = {0.15: 0.30, 0.20: 0.30, 0.25: 0.40}
             
             for level in [0.15, 0.20, 0.25]:
-                if spy_dd >= level and not self.dip_state[level]:
+                if regime.dip_triggers[level][r] and not self.dip_state[level]:
                     alloc_pct = dip_allocations[level]
                     if self.compounding:
                         curr_equity = self._get_total_equity(date)
@@ -661,24 +828,67 @@ class PortfolioBacktesterFinal:
                         target_amt = self.initial_capital * alloc_pct
                     
                     buy_amt = min(target_amt, self.cash)
-                    price = self._get_price(config.DIP_BUY_TICKER, date)
+                    price = self._get_price(self.dip_ticker, date)
                     
                     if price > 0 and buy_amt > 0:
-                        qty = int(buy_amt / (price * (1 + config.COMMISSION)))
+                        qty = int(buy_amt / (price * (1 + self.params.COMMISSION)))
                         if qty > 0:
-                            self._buy(config.DIP_BUY_TICKER, date, price, qty, f"Bear Dip Buy -{level*100:.0f}%")
+                            self._buy(self.dip_ticker, date, price, qty, f"Bear Dip Buy -{level*100:.0f}%")
                             self.dip_state[level] = True
 
 
 
 
-    def _get_price(self, ticker, date, use_open=False):
-        if ticker == config.DIP_BUY_TICKER:
-            df = self.sso_df
+    def _get_price_source(self, ticker):
+        if ticker == self.dip_ticker:
+            return self.sso_df
         elif ticker == 'SPY':
-            df = self.spy_df
+            return self.spy_df
+        return self.selector._get_ticker_data(ticker)
+
+    def _get_price_arrays(self, ticker):
+        """
+        回傳 ticker 對齊日曆的 (opens, closes) NumPy 陣列 (缺資料為 NaN)，第一次使用時建立
+        無 Open 欄位 (SPY/SSO benchmark) 時 opens 即 closes
+        """
+        if ticker in self._price_arrays:
+            return self._price_arrays[ticker]
+        
+        df = self._get_price_source(ticker)
+        arrays = None
+        if df is not None and not df.empty:
+            pos = self.calendar.get_indexer(df.index)
+            valid = pos >= 0
+            closes = np.full(len(self.calendar), np.nan)
+            closes[pos[valid]] = df['Close'].values[valid]
+            if 'Open' in df.columns:
+                opens = np.full(len(self.calendar), np.nan)
+                opens[pos[valid]] = df['Open'].values[valid]
+            else:
+                opens = closes
+            arrays = (opens, closes)
+        self._price_arrays[ticker] = arrays
+        return arrays
+
+    def _get_price(self, ticker, date, use_open=False):
+        # 目前回測日直接使用已對應的列號，其他日期查表 (不在日曆上則退回 label 查詢)
+        if date is self._cur_date:
+            row = self._cur_row
         else:
-            df = self.selector._get_ticker_data(ticker)
+            row = self._date_rows.get(date, -1)
+        if row < 0:
+            return self._get_price_by_label(ticker, date, use_open)
+        
+        arrays = self._get_price_arrays(ticker)
+        if arrays is None:
+            return 0.0
+        val = arrays[0][row] if use_open else arrays[1][row]
+        if val != val:  # NaN: 當日無資料
+            return 0.0
+        return float(val)
+
+    def _get_price_by_label(self, ticker, date, use_open=False):
+        df = self._get_price_source(ticker)
             
         if df is not None and not df.empty:
             if date in df.index:
@@ -693,7 +903,7 @@ class PortfolioBacktesterFinal:
     def _close_positions(self, date, target_type='ALL'):
         holdings_list = list(self.holdings.keys())
         for ticker in holdings_list:
-            is_dip = (ticker == config.DIP_BUY_TICKER)
+            is_dip = (ticker == self.dip_ticker)
             
             should_sell = False
             if target_type == 'ALL': should_sell = True
@@ -717,7 +927,7 @@ class PortfolioBacktesterFinal:
         old_qty = self.holdings.get(ticker, 0)
         weight_before = (price * old_qty / total_equity_before * 100) if total_equity_before > 0 and old_qty > 0 else 0
         
-        cost = price * qty * (1 + config.COMMISSION)
+        cost = price * qty * (1 + self.params.COMMISSION)
         self.cash -= cost
         
         if ticker not in self.holdings:
@@ -727,6 +937,7 @@ class PortfolioBacktesterFinal:
             total_val = (self.avg_costs[ticker] * old_qty) + (price * qty)
             self.holdings[ticker] += qty
             self.avg_costs[ticker] = total_val / self.holdings[ticker]
+        self._apply_trade_to_valuation(ticker, date, qty)
         
         # V3: 計算買入後該股的權重
         total_equity_after = self._get_total_equity(date)
@@ -739,24 +950,9 @@ class PortfolioBacktesterFinal:
         if self.write_reports:
             target_str = f" | Target: {target_w_pct:.1f}%" if target_w_pct else ""
             print(f"  BUY {ticker}: {qty} @ {price:.2f} ({reason}) | Weight: {weight_before:.1f}% -> {weight_after:.1f}%{target_str}")
-        holdings_snapshot = self._get_holdings_snapshot(date)  # [NEW]
-        self.trades.append({
-            'Date': date,
-            'Ticker': ticker,
-            'Action': 'BUY',
-            'Price': price,
-            'Quantity': qty,
-            'Cost': cost,
-            'Reason': reason,
-            'Revenue': '',
-            'PnL': '',
-            'PnL_Pct': '',
-            'Weight_Before': weight_before,
-            'Weight_After': weight_after,
-            'Target_Weight': target_w_pct,  # V3: ATR 目標權重 (只在再平衡時有值)
-            'Total_Equity': total_equity_after,
-            'Holdings_After': holdings_snapshot  # [NEW] 交易後完整持倉
-        })
+        self.ledger.append(date, ticker, BUY, price, qty, reason, total_equity_after, self.cash,
+                           weight_before=weight_before, weight_after=weight_after,
+                           target_weight=target_w_pct, cost=cost)
         
     def _sell(self, ticker, date, price, qty, reason, target_weight=None, weight_before=None):
         # V3: 使用傳入的 weight_before，若無則計算
@@ -768,10 +964,10 @@ class PortfolioBacktesterFinal:
         current_qty = self.holdings.get(ticker, 0)
         remaining_qty = current_qty - qty
         
-        revenue = price * qty * (1 - config.COMMISSION)
+        revenue = price * qty * (1 - self.params.COMMISSION)
         self.cash += revenue
         
-        cost_basis = self.avg_costs[ticker] * qty * (1 + config.COMMISSION)
+        cost_basis = self.avg_costs[ticker] * qty * (1 + self.params.COMMISSION)
         pnl = revenue - cost_basis
         pnl_pct = (pnl / cost_basis) * 100 if cost_basis > 0 else 0
         
@@ -780,6 +976,7 @@ class PortfolioBacktesterFinal:
             if self.holdings[ticker] <= 0:
                 del self.holdings[ticker]
                 del self.avg_costs[ticker]
+            self._apply_trade_to_valuation(ticker, date, -qty)
         
         # V3: 賣出後計算權重
         total_equity_after = self._get_total_equity(date)
@@ -793,62 +990,91 @@ class PortfolioBacktesterFinal:
         if self.write_reports:
             target_str = f" | Target: {target_w_pct:.1f}%" if target_w_pct else ""
             print(f"  SELL {ticker}: {qty} @ {price:.2f} ({reason}) | Weight: {weight_before:.1f}% -> {weight_after:.1f}%{target_str} | PnL: {pnl:.2f}")
-        holdings_snapshot = self._get_holdings_snapshot(date)  # [NEW]
-        self.trades.append({
-            'Date': date,
-            'Ticker': ticker,
-            'Action': 'SELL',
-            'Price': price,
-            'Quantity': qty,
-            'Cost': '',
-            'Reason': reason,
-            'Revenue': revenue,
-            'PnL': pnl,
-            'PnL_Pct': pnl_pct,
-            'Weight_Before': weight_before,
-            'Weight_After': weight_after,
-            'Target_Weight': target_w_pct,  # V3: ATR 目標權重 (只在再平衡時有值)
-            'Total_Equity': total_equity_after,
-            'Holdings_After': holdings_snapshot  # [NEW] 交易後完整持倉
-        })
+        self.ledger.append(date, ticker, SELL, price, qty, reason, total_equity_after, self.cash,
+                           weight_before=weight_before, weight_after=weight_after,
+                           target_weight=target_w_pct, revenue=revenue, pnl=pnl, pnl_pct=pnl_pct)
 
     def _update_equity(self, date):
-        total_equity = self._get_total_equity(date)
-        self.history.append({'Date': date, 'Equity': total_equity, 'Cash': self.cash})
+        # 權益紀錄一律由持倉完整估值 (當日已有交易時重新估值，結果與逐日重估逐位元相同)
+        if date != self._val_date or not self._val_exact:
+            self._mark_to_market(date)
+        total_equity = self.cash + self._holdings_value
+        sso_value = 0.0
+        if self.dip_ticker in self.holdings:
+            sso_value = float(self._get_mark(self.dip_ticker, date)) * self.holdings[self.dip_ticker]
+        self.equity_history.append(date, total_equity, self.cash, self._holdings_value, sso_value,
+                                   len(self.holdings))
+
+    @property
+    def history(self):
+        """
+        舊版 list-of-dicts 權益紀錄 ({'Date', 'Equity', 'Cash'})
+        快取至 equity_history 再新增列為止 (回傳的 list 為共用物件，請勿修改)
+        """
+        n = len(self.equity_history)
+        if self._history_records is None or self._history_records[0] != n:
+            self._history_records = (n, self.equity_history.to_records())
+        return self._history_records[1]
 
     def _get_total_equity(self, date):
+        if date != self._val_date:
+            self._mark_to_market(date)
+        return self.cash + self._holdings_value
+
+    def _mark_to_market(self, date):
+        """以 date 收盤價重新估值所有持倉 (每個估值日一次)"""
+        self._val_date = date
+        self._val_exact = True
+        self._marks = {}
         val = 0.0
         for t, q in self.holdings.items():
             price = self._get_price(t, date, use_open=False)
+            self._marks[t] = price
             val += float(price) * q
-        return self.cash + val
+        self._holdings_value = val
+
+    def _get_mark(self, ticker, date):
+        """估值日使用快取的收盤價，其他日期即時查詢"""
+        if date == self._val_date:
+            if ticker not in self._marks:
+                self._marks[ticker] = self._get_price(ticker, date, use_open=False)
+            return self._marks[ticker]
+        return self._get_price(ticker, date, use_open=False)
+
+    def _apply_trade_to_valuation(self, ticker, date, qty_delta):
+        """
+        交易後增量更新估值 (現金由 self.cash 直接反映)
+        增量累加與完整重估的加總順序不同，相對誤差約 1e-15 (測試要求 < 1e-9)；
+        只影響當日後續交易的權重/金額計算，權益紀錄 (_update_equity) 一律重新估值
+        """
+        if date != self._val_date:
+            self._val_date = None  # 非估值日的交易：下次查詢時重新估值
+            return
+        self._holdings_value += float(self._get_mark(ticker, date)) * qty_delta
+        self._val_exact = False
 
     def _get_holdings_snapshot(self, date):
         """
-        生成當前持倉快照字串（用於交易記錄）
+        生成當前持倉快照字串
         格式: AAPL:25%, MSFT:30%, CASH:45%
         """
         total_equity = self._get_total_equity(date)
-        if total_equity <= 0:
-            return "CASH:100%"
-        
-        holdings_parts = []
-        for ticker, qty in sorted(self.holdings.items()):
-            if qty <= 0:
-                continue
-            price = self._get_price(ticker, date, use_open=False)
-            value = price * qty
-            weight = (value / total_equity * 100)
-            holdings_parts.append(f"{ticker}:{weight:.1f}%")
-        
-        # 添加現金比例
-        cash_weight = (self.cash / total_equity * 100) if total_equity > 0 else 100
-        if cash_weight > 0.1:  # 只顯示 > 0.1% 的現金
-            holdings_parts.append(f"CASH:{cash_weight:.1f}%")
-        
-        return ", ".join(holdings_parts) if holdings_parts else "CASH:100%"
+        return format_holdings(self.holdings, lambda t: self._get_mark(t, date), self.cash, total_equity)
 
+    def _close_price(self, ticker, date):
+        """date 的收盤估值價 (交易紀錄重建持倉快照用)"""
+        return self._get_price(ticker, date, use_open=False)
 
+    @property
+    def trades(self):
+        """
+        舊版 list-of-dicts 交易紀錄 (含 Holdings_After)
+        快取至 ledger 再新增交易為止 (回傳的 list 為共用物件，請勿修改)
+        """
+        n = len(self.ledger)
+        if self._trade_records is None or self._trade_records[0] != n:
+            self._trade_records = (n, self.ledger.to_records(self._close_price))
+        return self._trade_records[1]
 
     def get_current_holdings(self, date=None):
         """Get current holdings status for live tracking"""
@@ -862,7 +1088,7 @@ class PortfolioBacktesterFinal:
             if qty <= 0:
                 continue
             
-            current_price = self._get_price(ticker, date, use_open=False)
+            current_price = self._get_mark(ticker, date)
             avg_cost = self.avg_costs.get(ticker, 0)
             value = current_price * qty
             cost_basis = avg_cost * qty
@@ -904,17 +1130,16 @@ class PortfolioBacktesterFinal:
         if not suffix.startswith("_final"):
             suffix = "_final" + suffix
         
-        if self.trades:
+        if self.ledger:
             trades_df = pd.DataFrame(self.trades)
             trades_df.to_csv(f'backtest_trades{suffix}.csv')
             
-        if self.history:
-            history_df = pd.DataFrame(self.history)
-            history_df.set_index('Date', inplace=True)
+        if self.equity_history:
+            history_df = self.equity_history.frame().astype({'Positions': np.int64})
             history_df.to_csv(f'equity_curve{suffix}.csv')
         
         # LIVE_MODE: Export current holdings to JSON
-        if getattr(config, 'LIVE_MODE', False):
+        if self.params.LIVE_MODE:
             import json
             holdings_info = self.get_current_holdings()
             holdings_info['date'] = str(holdings_info['date'].date())
@@ -933,20 +1158,20 @@ class PortfolioBacktesterFinal:
         holdings_snapshot = {}
         for ticker, qty in self.holdings.items():
             if qty > 0:
-                price = self._get_price(ticker, date, use_open=False)
+                price = self._get_mark(ticker, date)
                 value = price * qty
                 weight = (value / total_equity * 100) if total_equity > 0 else 0
                 holdings_snapshot[ticker] = weight
         
         # ?脣? Top 20 ??
-        entry_ranked_list = self.selector.scan_market(signal_date, lookback=config.LOOKBACK)
+        entry_ranked_list = self._scan_market(signal_date)
         
         # ??蕪璇辣嚗? _get_rotation_buys ?詨?嚗?
-        max_adj_slope = getattr(config, 'MAX_ADJ_SLOPE', None)
+        max_adj_slope = self.params.MAX_ADJ_SLOPE
         if max_adj_slope is not None:
             entry_ranked_list = [x for x in entry_ranked_list if x.get('adj_slope', 999) < max_adj_slope]
         
-        skip_max_gap = getattr(config, 'SKIP_MAX_GAP_PCT', 0.20)
+        skip_max_gap = self.params.SKIP_MAX_GAP_PCT
         entry_ranked_list = [x for x in entry_ranked_list if x.get('max_gap', 0) < skip_max_gap]
         
         top20_tickers = [x['ticker'] for x in entry_ranked_list[:20]]
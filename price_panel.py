@@ -0,0 +1,131 @@
+"""
+Price Panel
+將所有股票資料對齊到同一交易日曆 (SPY) 的 2-D NumPy 矩陣 (dates × tickers)
+讓排名、ATR、缺口、EMA 等計算可以對整個股票池一次切片，而不是逐檔 pandas mask
+可寫成 .npy 目錄 (save)，其他 process 以 memory-map 方式 attach (zero-copy、共用 OS page cache)
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class PricePanel:
+    # 對齊到日曆的價格欄位 (缺資料為 NaN)
+    FIELDS = ['Open', 'High', 'Low', 'Close', 'Adj Close']
+
+    def __init__(self, dates, tickers, arrays, off_calendar=None):
+        self.dates = pd.DatetimeIndex(dates)
+        self.tickers = list(tickers)
+        self.arrays = arrays  # {field: np.ndarray (len(dates), len(tickers)) float64}
+
+        # ticker → column / date → row
+        self.ticker_index = {t: j for j, t in enumerate(self.tickers)}
+        self.date_index = {d: i for i, d in enumerate(self.dates)}
+        self._dates_ns = self.dates.values
+
+        # 有交易日不在日曆上的股票 (該日資料未進入 panel，逐檔計算時需回退)
+        if off_calendar is None:
+            off_calendar = np.zeros(len(self.tickers), dtype=bool)
+        self.off_calendar = off_calendar
+
+    @property
+    def dtype(self):
+        return self.arrays['Close'].dtype
+
+    @classmethod
+    def from_frames(cls, frames, calendar, dtype=np.float64):
+        """
+        frames: {ticker: DataFrame} (DatetimeIndex, 已排序)
+        calendar: 交易日曆 (通常為 SPY index)
+        dtype: 矩陣型別 (compact 模式為 float32)
+        """
+        calendar = pd.DatetimeIndex(calendar)
+        tickers = [t for t, df in frames.items() if df is not None and not df.empty]
+        n_rows, n_cols = len(calendar), len(tickers)
+
+        # 所有股票都沒有 Adj Close 時 (compact 模式會移除與 Close 相同的欄位)，直接共用 Close 矩陣
+        has_adj = any('Adj Close' in frames[t].columns for t in tickers)
+        fields = cls.FIELDS if has_adj else [f for f in cls.FIELDS if f != 'Adj Close']
+        arrays = {f: np.full((n_rows, n_cols), np.nan, dtype=dtype) for f in fields}
+        if not has_adj:
+            arrays['Adj Close'] = arrays['Close']
+        off_calendar = np.zeros(n_cols, dtype=bool)
+
+        for j, ticker in enumerate(tickers):
+            df = frames[ticker]
+            pos = calendar.get_indexer(df.index)
+            valid = pos >= 0
+            off_calendar[j] = not valid.all()
+            rows = pos[valid]
+            for field in fields:
+                # 無 Adj Close 時與 calculate_metrics 相同，退回使用 Close
+                src = field if field in df.columns else 'Close'
+                arrays[field][rows, j] = df[src].values[valid]
+
+        return cls(calendar, tickers, arrays, off_calendar)
+
+    def save(self, directory):
+        """
+        將所有陣列寫成 directory 下的 .npy 檔 (供 attach 以 memory-map 讀取)
+        同一個陣列物件 (例如共用 Close 的 Adj Close) 只寫一次；meta.json 最後寫入，存在即代表完整
+        """
+        os.makedirs(directory, exist_ok=True)
+        files, written = {}, {}
+        for name, arr in self.arrays.items():
+            if id(arr) not in written:
+                fname = f'array_{len(written)}.npy'
+                np.save(os.path.join(directory, fname), np.ascontiguousarray(arr))
+                written[id(arr)] = fname
+            files[name] = written[id(arr)]
+        np.save(os.path.join(directory, 'dates.npy'), self._dates_ns)
+        np.save(os.path.join(directory, 'off_calendar.npy'), self.off_calendar)
+        with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'tickers': self.tickers, 'arrays': files}, f)
+
+    @classmethod
+    def attach(cls, directory):
+        """
+        以唯讀 memory-map 開啟 save() 寫出的 panel (不複製資料)
+        之後新增的欄位 (例如 asof: 指標) 為該 process 私有的一般陣列
+        """
+        with open(os.path.join(directory, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        arrays, mapped = {}, {}
+        for name, fname in meta['arrays'].items():
+            if fname not in mapped:
+                mapped[fname] = np.load(os.path.join(directory, fname), mmap_mode='r')
+            arrays[name] = mapped[fname]
+        dates = np.load(os.path.join(directory, 'dates.npy'))
+        off_calendar = np.load(os.path.join(directory, 'off_calendar.npy'))
+        return cls(dates, meta['tickers'], arrays, off_calendar)
+
+    def field(self, name):
+        return self.arrays[name]
+
+    def row(self, date):
+        """date 在日曆上的列號，不在日曆上回傳 -1"""
+        return self.date_index.get(date, -1)
+
+    def row_asof(self, date):
+        """date 當日或之前最近一個交易日的列號，早於日曆起點回傳 -1"""
+        return int(np.searchsorted(self._dates_ns, np.datetime64(pd.Timestamp(date)), side='right')) - 1
+
+    def col(self, ticker):
+        return self.ticker_index.get(ticker, -1)
+
+    def cols(self, tickers):
+        """tickers → column 陣列 (不在 panel 中為 -1)"""
+        return np.array([self.ticker_index.get(t, -1) for t in tickers], dtype=np.int64)
+
+    def window(self, name, row, length, cols=None):
+        """
+        取 [row - length + 1, row] 的視窗切片 (length × k)
+        起點不足時回傳 None
+        """
+        start = row - length + 1
+        if row < 0 or start < 0:
+            return None
+        block = self.arrays[name][start:row + 1]
+        return block if cols is None else block[:, cols]
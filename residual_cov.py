@@ -0,0 +1,237 @@
+"""
+Rolling Residual Covariance
+殘差相關性過濾用的滾動共變異數引擎:
+每檔股票的日報酬在建立時對齊到 SPY 交易日曆 (T 日 × n 檔)，
+視窗 (最後 lookback 個 SPY 報酬日) 內只維護原始乘積和，視窗移動時只加入新進、扣除移出的日期 (rank-k 更新)，
+查詢任意日期、任意候選集合的殘差相關係數只需 O(k²)，不必重新讀取價格歷史
+
+殘差 e_a = s_a - alpha_a - beta_a * m (beta 以該股自身所有有效日估計，與 stats.linregress 相同)，
+兩檔在共同有效日上的殘差共變異數可由原始和展開:
+    cov(e_a, e_b) = cov(s_a, s_b) - beta_b cov(s_a, m) - beta_a cov(m, s_b) + beta_a beta_b var(m)
+維護的 n × n 矩陣 (皆為兩檔共同有效日上的和):
+    N   = Σ 1          M1 = Σ m         M2 = Σ m²
+    A1  = Σ s_a        A2 = Σ s_a²      AM = Σ s_a m        P = Σ s_a s_b
+對角線即為各股自身有效日的和 (用於 beta)
+"""
+import numpy as np
+import pandas as pd
+
+
+class RollingResidualCovariance:
+    # 累積的增量更新列數超過此值時由頭重建，避免加減誤差累積
+    REBUILD_EVERY = 250
+
+    SUM_NAMES = ['N', 'M1', 'M2', 'A1', 'A2', 'AM', 'P']
+
+    def __init__(self, dates, tickers, returns, market_returns, lookback, supported=None,
+                 off_calendar=None, source=None):
+        """
+        dates: 交易日曆 (SPY index)
+        returns: (T, n) 日報酬 (對齊日曆，缺資料為 NaN)
+        market_returns: (T,) SPY 日報酬 (第一列為 NaN)
+        supported: (n,) 可用滾動和精確計算的股票 (其餘查詢時回傳 None，由呼叫端改用逐檔計算)
+        off_calendar: {column: 不在日曆上的交易日 (datetime64[ns] 陣列)}
+        source: 建立時使用的 SPY DataFrame (呼叫端用來判斷引擎是否對應同一份基準資料)
+        """
+        self.dates = pd.DatetimeIndex(dates)
+        self.tickers = list(tickers)
+        self.ticker_index = {t: j for j, t in enumerate(self.tickers)}
+        self.lookback = lookback
+        self.min_data = int(lookback * 0.8)
+        self.source = source
+        self._dates_ns = self.dates.values
+
+        market_valid = ~np.isnan(market_returns)
+        valid = ~np.isnan(returns) & market_valid[:, None]
+        self._valid = valid.astype(np.float64)
+        self._returns = np.where(valid, returns, 0.0)
+        self._market = np.where(market_valid, market_returns, 0.0)
+        self._market_count = np.concatenate([[0], np.cumsum(market_valid)])
+        if supported is None:
+            supported = np.ones(len(self.tickers), dtype=bool)
+        self.supported = supported
+        self.off_calendar = off_calendar or {}
+
+        self._window = None  # 目前累加的列範圍 [lo, hi)
+        self._sums = None
+        self._updates = 0
+
+    @classmethod
+    def from_frames(cls, frames, spy_df, lookback):
+        """
+        frames: {ticker: DataFrame}；報酬以各股自身的前一筆價格計算 (與逐檔計算相同)，
+        不在 SPY 日曆上的交易日只用作下一日報酬的基準，並記錄下來 (視窗包含該日時不支援)
+        報酬出現 inf 的股票標記為不支援
+        """
+        spy_close = spy_df['Close']
+        dates = spy_close.index
+        spy_values = spy_close.values.astype(np.float64)
+        market_returns = np.full(len(dates), np.nan)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            market_returns[1:] = spy_values[1:] / spy_values[:-1] - 1
+
+        tickers = [t for t, df in frames.items() if df is not None and not df.empty]
+        returns = np.full((len(dates), len(tickers)), np.nan)
+        supported = np.ones(len(tickers), dtype=bool)
+        off_calendar = {}
+        for j, ticker in enumerate(tickers):
+            df = frames[ticker]
+            price_col = 'Adj Close' if 'Adj Close' in df.columns else 'Close'
+            prices = df[price_col].values.astype(np.float64)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                r = prices[1:] / prices[:-1] - 1
+            if np.isinf(r).any():
+                supported[j] = False
+                continue
+            pos = dates.get_indexer(df.index)
+            if (pos < 0).any():
+                off_calendar[j] = df.index.values[pos < 0].astype('datetime64[ns]')
+            on = pos[1:] >= 0
+            returns[pos[1:][on], j] = r[on]
+        return cls(dates, tickers, returns, market_returns, lookback, supported, off_calendar, source=spy_df)
+
+    def _block_sums(self, lo, hi):
+        """日曆列 [lo, hi) 的各項和"""
+        V = self._valid[lo:hi]
+        R = self._returns[lo:hi]
+        m = self._market[lo:hi, None]
+        Vm = V * m
+        Rm = R * m
+        return {
+            'N': V.T @ V,
+            'M1': Vm.T @ V,
+            'M2': (Vm * m).T @ V,
+            'A1': R.T @ V,
+            'A2': (R * R).T @ V,
+            'AM': Rm.T @ V,
+            'P': R.T @ R,
+        }
+
+    def _move_to(self, lo, hi):
+        """將累加視窗移到 [lo, hi)：只前進且與目前視窗重疊時做增量更新，否則重建"""
+        if self._window == (lo, hi):
+            return
+        if self._window is not None:
+            old_lo, old_hi = self._window
+            step = (hi - old_hi) + (lo - old_lo)
+            if (lo >= old_lo and hi >= old_hi and lo < old_hi
+                    and self._updates + step <= self.REBUILD_EVERY):
+                if hi > old_hi:
+                    added = self._block_sums(old_hi, hi)
+                    for name in self.SUM_NAMES:
+                        self._sums[name] += added[name]
+                if lo > old_lo:
+                    removed = self._block_sums(old_lo, lo)
+                    for name in self.SUM_NAMES:
+                        self._sums[name] -= removed[name]
+                self._updates += step
+                self._window = (lo, hi)
+                return
+        self._sums = self._block_sums(lo, hi)
+        self._updates = 0
+        self._window = (lo, hi)
+
+    def _window_rows(self, date):
+        """date 當日或之前最後 lookback 個報酬日的日曆列範圍 [lo, hi)"""
+        hi = int(np.searchsorted(self._dates_ns, np.datetime64(pd.Timestamp(date)), side='right'))
+        return max(0, hi - self.lookback), hi
+
+    def covariance(self, tickers, date):
+        """
+        tickers 在 date 視窗中的殘差共變異數 (兩兩共同有效日)
+        回傳 (kept, cov, var_a, var_b, counts)；有效日少於 lookback * 0.8 的股票不列入
+        有任何 ticker 不在引擎中、不支援，或視窗內有不在日曆上的交易日時回傳 None
+        (該日會讓逐檔計算的「最後 lookback + 1 筆」視窗與日曆視窗不同)
+        """
+        lo, hi = self._window_rows(date)
+        first_ns = self._dates_ns[lo - 1] if lo > 0 else np.datetime64(np.iinfo(np.int64).min + 1, 'ns')
+        date_ns = np.datetime64(pd.Timestamp(date), 'ns')
+        cols = []
+        for t in tickers:
+            j = self.ticker_index.get(t, -1)
+            if j < 0 or not self.supported[j]:
+                return None
+            off = self.off_calendar.get(j)
+            if off is not None and ((off > first_ns) & (off <= date_ns)).any():
+                return None
+            cols.append(j)
+
+        empty = ([], np.empty((0, 0)), np.empty((0, 0)), np.empty((0, 0)), np.empty((0, 0)))
+        if self._market_count[hi] - self._market_count[lo] < self.min_data:
+            return empty
+        self._move_to(lo, hi)
+
+        cols = np.array(cols, dtype=np.int64)
+        own_n = self._sums['N'][cols, cols]
+        keep = own_n >= self.min_data
+        kept = [t for t, k in zip(tickers, keep) if k]
+        if not kept:
+            return empty
+        ix = np.ix_(cols[keep], cols[keep])
+        N, M1, M2, A1, A2, AM, P = (self._sums[name][ix] for name in self.SUM_NAMES)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # beta: 對角線 = 各股自身有效日
+            n, sa, ma = np.diag(N), np.diag(A1), np.diag(M1)
+            cov_sm = np.diag(AM) - sa * ma / n
+            var_m_own = np.diag(M2) - ma * ma / n
+            beta = cov_sm / var_m_own
+            beta_a, beta_b = beta[:, None], beta[None, :]
+
+            # 共同有效日上的二階動差
+            cov_ss = P - A1 * A1.T / N
+            cov_am = AM - A1 * M1 / N
+            cov_bm = cov_am.T
+            var_m = M2 - M1 * M1 / N
+            var_sa = A2 - A1 * A1 / N
+            var_sb = var_sa.T
+
+            cov = cov_ss - beta_b * cov_am - beta_a * cov_bm + beta_a * beta_b * var_m
+            var_a = var_sa - 2 * beta_a * cov_am + beta_a * beta_a * var_m
+            var_b = var_sb - 2 * beta_b * cov_bm + beta_b * beta_b * var_m
+        return kept, cov, var_a, var_b, N
+
+    def correlation(self, tickers, date, shrinkage=None):
+        """
+        tickers 在 date 視窗中的殘差相關係數
+        shrinkage: None (樣本相關係數) / 0~1 的固定強度 / 'ledoit-wolf' (由資料估計強度)，
+                   非對角線向 0 收縮 (目標為單位矩陣)
+        回傳 (kept, corr, counts)；不支援時回傳 None
+        """
+        result = self.covariance(tickers, date)
+        if result is None:
+            return None
+        kept, cov, var_a, var_b, counts = result
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = cov / np.sqrt(var_a * var_b)
+        if shrinkage is not None and len(kept) > 1:
+            corr = shrink_correlation(corr, counts, shrinkage)
+        return kept, corr, counts
+
+
+def ledoit_wolf_intensity(corr, counts):
+    """
+    相關係數矩陣向單位矩陣收縮的最佳強度 (Ledoit-Wolf / Schäfer-Strimmer):
+        delta = Σ Var(r_ab) / Σ r_ab²  (a ≠ b)
+    Var(r_ab) 以樣本相關係數的漸近變異數 (1 - r²)² / (n_ab - 1) 估計，只需二階動差
+    """
+    off = ~np.eye(len(corr), dtype=bool) & np.isfinite(corr) & (counts > 1)
+    if not off.any():
+        return 0.0
+    r = corr[off]
+    denom = (r * r).sum()
+    if denom <= 0:
+        return 1.0
+    var_r = (1 - r * r) ** 2 / (counts[off] - 1)
+    return float(np.clip(var_r.sum() / denom, 0.0, 1.0))
+
+
+def shrink_correlation(corr, counts, shrinkage):
+    """非對角線乘上 (1 - delta)；shrinkage 為 'ledoit-wolf' 時由資料估計 delta"""
+    if shrinkage == 'ledoit-wolf':
+        delta = ledoit_wolf_intensity(corr, counts)
+    else:
+        delta = float(shrinkage)
+    shrunk = corr * (1 - delta)
+    np.fill_diagonal(shrunk, np.diag(corr))
+    return shrunk
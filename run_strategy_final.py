@@ -47,6 +47,9 @@ def main():
     )
     bt_compound.run()
     
+    # [OPTIMIZATION] 保存排名快取，下次執行只需計算新資料的日期
+    shared_selector.save_scan_cache()
+    
     # Export Rebalance Snapshots to Excel
     print("\n[Bonus] Exporting rebalance day snapshots to Excel...")
     bt_compound.export_rebalance_excel('rebalance_holdings_final.xlsx')
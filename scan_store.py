@@ -0,0 +1,158 @@
+"""
+Scan Store
+scan_market 排名結果的持久化快取 (NPZ 欄式儲存，data/_store/scan_cache.npz)
+鍵為 (date, lookback, params.scan_key)，並記錄每檔股票的資料指紋:
+  - 成分股檔 / 黑名單 / 版本改變 → 整個快取失效
+  - 股票資料只在尾端新增 K 棒 → 只失效該股票舊資料最後一日之後、且為成分股的日期
+  - 股票資料被改寫 (例如除權息重算 Adj Close) → 失效所有包含該股票的日期
+"""
+import json
+import os
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from price_panel import PricePanel
+
+# 排名計算方式改變時遞增，讓舊快取自動失效
+SCAN_STORE_VERSION = 1
+
+# 每筆排名結果儲存的欄位 (ticker 另存索引)
+METRIC_FIELDS = ['adj_slope', 'max_gap', 'price', 'exit_ema', 'atr', 'atr_pct']
+
+
+def frame_fingerprint(df, n_rows=None):
+    """
+    股票資料指紋 (first_ns, last_ns, nrows, crc32)
+    crc32 涵蓋前 n_rows 列的日期與價格欄位 (不含衍生指標欄位)
+    """
+    if df is None or df.empty:
+        return (0, 0, 0, 0)
+    n = len(df) if n_rows is None else min(n_rows, len(df))
+    dates = df.index.values[:n].astype('datetime64[ns]').astype(np.int64)
+    crc = zlib.crc32(np.ascontiguousarray(dates).tobytes())
+    for col in PricePanel.FIELDS:
+        if col in df.columns:
+            values = np.ascontiguousarray(df[col].values[:n], dtype=np.float64)
+            crc = zlib.crc32(values.tobytes(), crc)
+    return (int(dates[0]), int(dates[n - 1]), n, crc)
+
+
+class ScanStore:
+    def __init__(self, path):
+        self.path = path
+
+    def save(self, scan_cache, fingerprints, meta):
+        """
+        scan_cache: {(date, lookback, scan_key): [metrics dict]}
+        fingerprints: {ticker: frame_fingerprint}
+        meta: 影響全部結果的設定 (成分股檔、黑名單等)，不符時整個快取失效
+        """
+        tickers = sorted(fingerprints)
+        ticker_ids = {t: i for i, t in enumerate(tickers)}
+
+        keys = list(scan_cache.keys())
+        n_entries = len(keys)
+        key_width = 1 + max((len(k[2]) for k in keys), default=0)
+        entry_dates = np.empty(n_entries, dtype=np.int64)
+        entry_keys = np.zeros((n_entries, key_width), dtype=np.float64)
+        entry_counts = np.empty(n_entries, dtype=np.int64)
+
+        flat_ids = []
+        flat_values = {f: [] for f in METRIC_FIELDS}
+        for i, (date, lookback, scan_key) in enumerate(keys):
+            ranked = scan_cache[(date, lookback, scan_key)]
+            entry_dates[i] = pd.Timestamp(date).as_unit('ns').value
+            entry_keys[i] = (lookback,) + tuple(scan_key)
+            entry_counts[i] = len(ranked)
+            for m in ranked:
+                flat_ids.append(ticker_ids[m['ticker']])
+                for f in METRIC_FIELDS:
+                    flat_values[f].append(m[f])
+
+        arrays = {
+            'version': np.array([SCAN_STORE_VERSION], dtype=np.int64),
+            'meta': np.array([json.dumps(meta, sort_keys=True)]),
+            'tickers': np.array(tickers, dtype=str),
+            'fingerprints': np.array([fingerprints[t] for t in tickers], dtype=np.int64).reshape(len(tickers), 4),
+            'entry_dates': entry_dates,
+            'entry_keys': entry_keys,
+            'entry_counts': entry_counts,
+            'ticker_ids': np.array(flat_ids, dtype=np.int32),
+        }
+        for f in METRIC_FIELDS:
+            arrays[f] = np.array(flat_values[f], dtype=np.float64)
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # 先寫暫存檔再替換 (平行執行時以 pid 區分暫存檔)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as fh:
+                np.savez(fh, **arrays)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"Warning: could not write scan cache {self.path}: {e}")
+
+    def load(self, meta, get_frame, get_constituents):
+        """
+        讀取快取並依目前資料失效過期的日期
+        get_frame(ticker) → 目前的 DataFrame (或 None)
+        get_constituents(date) → 該日成分股列表
+        回傳 {(date, lookback, scan_key): [metrics dict]}，檔案不存在或 meta 不符回傳 {}
+        """
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with np.load(self.path, allow_pickle=False) as npz:
+                if int(npz['version'][0]) != SCAN_STORE_VERSION:
+                    return {}
+                if str(npz['meta'][0]) != json.dumps(meta, sort_keys=True):
+                    return {}
+                data = {k: npz[k] for k in npz.files}
+        except Exception as e:
+            print(f"Warning: could not read scan cache {self.path}: {e}")
+            return {}
+
+        tickers = data['tickers'].tolist()
+        entry_dates = data['entry_dates']
+        n_entries = len(entry_dates)
+        keep = np.ones(n_entries, dtype=bool)
+
+        # 每檔股票: 未變動 → 略過；尾端新增 → 舊最後一日之後失效；其他變動 → 全部失效
+        constituents = {}
+        for t, (first_ns, last_ns, n_rows, crc) in zip(tickers, data['fingerprints'].tolist()):
+            df = get_frame(t)
+            current = frame_fingerprint(df, n_rows) if n_rows else (0, 0, 0, 0)
+            total_rows = 0 if df is None else len(df)
+            if current == (first_ns, last_ns, n_rows, crc):
+                if total_rows == n_rows:
+                    continue
+                cutoff = last_ns
+            else:
+                cutoff = np.iinfo(np.int64).min
+
+            for i in np.nonzero(keep & (entry_dates > cutoff))[0]:
+                d = int(entry_dates[i])
+                if d not in constituents:
+                    constituents[d] = set(get_constituents(pd.Timestamp(d)))
+                if t in constituents[d]:
+                    keep[i] = False
+
+        # 還原為 scan_cache 結構
+        offsets = np.concatenate([[0], np.cumsum(data['entry_counts'])])
+        ticker_ids = data['ticker_ids']
+        values = {f: data[f].tolist() for f in METRIC_FIELDS}
+        entry_keys = data['entry_keys'].tolist()
+
+        cache = {}
+        for i in np.nonzero(keep)[0]:
+            lookback, *scan_key = entry_keys[i]
+            ranked = []
+            for k in range(offsets[i], offsets[i + 1]):
+                m = {'ticker': tickers[ticker_ids[k]]}
+                for f in METRIC_FIELDS:
+                    m[f] = values[f][k]
+                ranked.append(m)
+            cache[(pd.Timestamp(int(entry_dates[i])), int(lookback), tuple(scan_key))] = ranked
+        return cache
@@ -1,44 +1,55 @@
 import pandas as pd
 import numpy as np
-import scipy.stats as stats
 import config
 import os
 import utils
+from price_panel import PricePanel
+from strategy_params import StrategyParams
+from scan_store import ScanStore, frame_fingerprint
+from constituents import load_membership
+from residual_cov import RollingResidualCovariance
+from caches import LRUCache, estimate_size
 
 
 class SelectionEngine:
-    def __init__(self, data_cache=None):
+    # 持久化排名快取檔名 (位於 data/_store/)
+    SCAN_STORE_FILE = 'scan_cache.npz'
+
+    def __init__(self, data_cache=None, vectorized_scan=True, params=None, persistent_cache=True, compact=None):
         self.data_cache = data_cache if data_cache else {}
-        self.scan_cache = {}  # Cache for scan_market results {(date, lookback): sorted_list}
-        self.metrics_cache = {}  # Cache for calculation results {(ticker, date, lookback): stats_dict}
-        self.constituents_df = self._load_constituents()
+        # compact 模式: float32 價格、共用日期 index、不保留 Volume / 重複的 Adj Close (預設取 config)
+        self.compact = compact if compact is not None else getattr(config, 'COMPACT_PRICE_CACHE', False)
+        self.vectorized_scan = vectorized_scan  # scan_market 使用整個股票池一次計算的批次模式
+        # 預設策略參數 (未指定時取 config_final)；每次呼叫可另外傳入 params 覆寫
+        self.params = params if params is not None else StrategyParams.from_config()
+        # 有界 LRU 快取 (上限取自 config，可用 configure_caches 調整；cache_stats 查詢命中率)
+        self.scan_cache = LRUCache(getattr(config, 'SCAN_CACHE_MAX_ITEMS', None),
+                                   getattr(config, 'SCAN_CACHE_MAX_BYTES', None),
+                                   sizeof=self._ranked_size)  # {(date, lookback, params.scan_key): sorted_list}
+        self.metrics_cache = LRUCache(getattr(config, 'METRICS_CACHE_MAX_ITEMS', None),
+                                      getattr(config, 'METRICS_CACHE_MAX_BYTES', None))  # {(ticker, date, lookback, params.metrics_key): stats_dict}
+        self.persistent_cache = persistent_cache  # scan_cache 跨程序保存到 data/_store/scan_cache.npz
+        self._scan_store_inserts = 0  # 上次載入/儲存時的 scan_cache 寫入次數 (判斷是否需要重新寫入)
+        self.membership = self._load_constituents()  # ConstituentsMembership (變動點 + 各期成分股 + 區間索引)
+        # 黑名單只解析一次: [(生效日, TICKER)]
+        self._blacklist = [(pd.to_datetime(d), t.upper()) for d, t in self._get_blacklist()]
+        self._constituents_df = None
         self._all_tickers_loaded = False
+        self.panel = None  # PricePanel: dates × tickers 對齊矩陣 (preload 後建立)
+        self.residual_engines = {}  # {lookback: RollingResidualCovariance} (殘差相關性滾動模式，第一次使用時建立)
         
     def _load_constituents(self):
-        """讀取 S&P 500 成分股歷史資料 (Excel)"""
+        """讀取 S&P 500 成分股歷史資料 (Excel，解析結果快取於 data/_store/)"""
         path = os.path.join(config.DATA_DIR, config.CONST_FILE)
         print(f"Loading constituents from {path}...")
-        try:
-            # 使用 openpyxl engine
-            xl = pd.ExcelFile(path, engine='openpyxl')
-            sheets = xl.sheet_names
-            valid_sheets = [s for s in sheets if s.isdigit()]
-            all_data = []
-            for sheet in valid_sheets:
-                df = pd.read_excel(xl, sheet_name=sheet)
-                if 'Date' in df.columns:
-                    df['Date'] = pd.to_datetime(df['Date'])
-                    df.set_index('Date', inplace=True)
-                    all_data.append(df)
-            if not all_data:
-                print("No valid daily constituent data found in Excel.")
-                return pd.DataFrame()
-            full_df = pd.concat(all_data)
-            full_df.sort_index(inplace=True)
-            return full_df
-        except Exception as e:
-            print(f"Error loading constituents: {e}")
-            return pd.DataFrame()
+        return load_membership(path)
+
+    @property
+    def constituents_df(self):
+        """每日一列的成分股 DataFrame (相容舊介面，第一次使用時由 membership 還原)"""
+        if self._constituents_df is None:
+            self._constituents_df = self.membership.to_frame()
+        return self._constituents_df
 
     def preload_all_data(self, start_date=None, end_date=None):
         """
@@ -48,25 +59,14 @@ class SelectionEngine:
         if self._all_tickers_loaded:
             return  # 已經載入過
             
-        if self.constituents_df.empty:
+        if self.membership.empty:
             return
             
-        # 收集所有可能的 ticker
-        all_tickers = set()
-        
-        # 如果有指定時間範圍，只收集該範圍內的 ticker
+        # 收集所有可能的 ticker (有指定時間範圍時，只收集該範圍內的 ticker)
         if start_date and end_date:
-            start_dt = pd.to_datetime(start_date)
-            end_dt = pd.to_datetime(end_date)
-            mask = (self.constituents_df.index >= start_dt) & (self.constituents_df.index <= end_dt)
-            subset = self.constituents_df[mask]
+            all_tickers = self.membership.tickers_between(start_date, end_date)
         else:
-            subset = self.constituents_df
-            
-        for idx in subset.index:
-            row = subset.loc[idx]
-            tickers = [t for t in row.values if isinstance(t, str)]
-            all_tickers.update(t.replace('.txt', '').strip() for t in tickers)
+            all_tickers = self.membership.tickers_between()
         
         print(f"Preloading {len(all_tickers)} tickers into memory...")
         loaded = 0
@@ -75,26 +75,130 @@ class SelectionEngine:
                 loaded += 1
         print(f"Loaded {loaded} tickers successfully.")
         self._all_tickers_loaded = True
+        self.build_panel()
+        self.load_scan_cache()
+
+    def _scan_store(self):
+        return ScanStore(os.path.join(config.DATA_DIR, utils.STORE_DIR_NAME, self.SCAN_STORE_FILE))
+
+    def _scan_store_meta(self):
+        """影響所有排名的設定: 成分股檔案 (size/mtime) 與黑名單"""
+        path = os.path.join(config.DATA_DIR, config.CONST_FILE)
+        const_stat = [0, 0]
+        if os.path.exists(path):
+            st = os.stat(path)
+            const_stat = [st.st_size, st.st_mtime_ns]
+        meta = {
+            'constituents': const_stat,
+            'blacklist': [[str(d), str(t)] for d, t in self._get_blacklist()],
+        }
+        if self.compact:
+            meta['compact'] = True  # float32 排名與一般模式分開快取
+        return meta
+
+    def load_scan_cache(self):
+        """
+        從磁碟載入先前的 scan_market 排名 (資料有更新的日期自動失效)
+        回傳載入的筆數
+        """
+        if not self.persistent_cache:
+            return 0
+        loaded = self._scan_store().load(self._scan_store_meta(), self._get_ticker_data, self.get_constituents)
+        for key, ranked in loaded.items():
+            self.scan_cache.setdefault(key, ranked)
+        self._scan_store_inserts = self.scan_cache.inserts
+        return len(loaded)
+
+    def save_scan_cache(self):
+        """
+        將 scan_cache 寫回磁碟 (沒有新排名時略過)
+        指紋涵蓋所有快取日期的成分股，供下次載入時判斷哪些日期需要重算
+        """
+        if not self.persistent_cache or self.scan_cache.inserts == self._scan_store_inserts:
+            return
+        tickers = set()
+        for date in {key[0] for key in self.scan_cache}:
+            tickers.update(self.get_constituents(date))
+        fingerprints = {t: frame_fingerprint(self._get_ticker_data(t)) for t in tickers}
+        # 以一般 dict 傳入 (逐筆讀取不計入 LRU 統計與使用順序)
+        self._scan_store().save(dict(self.scan_cache.items()), fingerprints, self._scan_store_meta())
+        self._scan_store_inserts = self.scan_cache.inserts
+
+    @staticmethod
+    def _ranked_size(obj):
+        """scan_cache 值 (同結構 metrics dict 的列表) 的估計大小：以第一筆推算，避免逐筆遞迴"""
+        if isinstance(obj, list) and obj:
+            return estimate_size([]) + len(obj) * (8 + estimate_size(obj[0]))
+        return estimate_size(obj)
+
+    def configure_caches(self, metrics_items=None, metrics_bytes=None, scan_items=None, scan_bytes=None):
+        """設定 metrics_cache / scan_cache 的筆數與位元組上限 (None 表示不限制)，超出的項目立即淘汰"""
+        self.metrics_cache.resize(metrics_items, metrics_bytes)
+        self.scan_cache.resize(scan_items, scan_bytes)
+
+    def cache_stats(self):
+        """
+        各快取的筆數 / 估計位元組 / hits / misses / evictions / hit_rate
+        回傳 {'metrics': {...}, 'scan': {...}}
+        """
+        return {'metrics': self.metrics_cache.stats(), 'scan': self.scan_cache.stats()}
+
+    def build_panel(self, calendar=None):
+        """
+        將 data_cache 對齊到交易日曆 (預設 SPY) 建立 PricePanel
+        """
+        if calendar is None:
+            spy = self._get_ticker_data(getattr(config, 'BENCHMARK_TICKER', 'SPY'))
+            if spy is None or spy.empty:
+                return None
+            calendar = spy.index
+        self.panel = PricePanel.from_frames(self.data_cache, calendar,
+                                            dtype=np.float32 if self.compact else np.float64)
+        return self.panel
+
+    def get_panel(self):
+        """取得 PricePanel (尚未建立則以目前 data_cache 建立)"""
+        if self.panel is None:
+            self.build_panel()
+        return self.panel
+
+    @staticmethod
+    def _history(df, date):
+        """df[df.index <= date] 的位置切片版本 (index 已排序，免建立 boolean mask)"""
+        return df.iloc[:df.index.searchsorted(date, side='right')]
 
     def get_constituents(self, date):
         """獲取特定日期的成分股列表 (自動過濾黑名單)"""
-        if self.constituents_df.empty:
+        if self.membership.empty:
             return []
-        if date not in self.constituents_df.index:
-            try:
-                loc = self.constituents_df.index.get_indexer([date], method='pad')[0]
-                if loc == -1:
-                    return []
-                target_date = self.constituents_df.index[loc]
-            except:
-                return []
-        else:
-            target_date = date
-        row = self.constituents_df.loc[target_date]
-        tickers = [t for t in row.values if isinstance(t, str)]
-        tickers = [t.replace('.txt', '').strip() for t in tickers]
+        tickers = self.membership.members_on(date)
         
-        # Filter out blacklisted stocks (check config_final first, then config)
+        # Filter out blacklisted stocks
+        for bl_date, bl_ticker in self._blacklist:
+            if date > bl_date and bl_ticker in tickers:
+                tickers.remove(bl_ticker)
+        
+        return tickers
+
+    def constituents_mask(self, date):
+        """
+        get_constituents 的 NumPy 版本: 對齊 PricePanel.tickers 的布林遮罩 (已過濾黑名單)
+        不在 panel 中的成分股 (無價格資料) 不會出現在遮罩中
+        """
+        panel = self.get_panel()
+        if panel is None:
+            return None
+        mask = self.membership.members_mask(date, panel)
+        for bl_date, bl_ticker in self._blacklist:
+            if date > bl_date:
+                col = panel.col(bl_ticker)
+                if col >= 0:
+                    mask[col] = False
+        return mask
+
+    @staticmethod
+    def _get_blacklist():
+        """黑名單 (check config first, then config_final)"""
         blacklist = getattr(config, 'BLACKLIST', None)
         if blacklist is None:
             try:
@@ -102,18 +206,18 @@ class SelectionEngine:
                 blacklist = getattr(config_final, 'BLACKLIST', [])
             except ImportError:
                 blacklist = []
-        
-        if blacklist:
-            for bl_date_str, bl_ticker in blacklist:
-                bl_date = pd.to_datetime(bl_date_str)
-                bl_ticker = bl_ticker.upper()
-                if date > bl_date and bl_ticker in tickers:
-                    tickers.remove(bl_ticker)
-        
-        return tickers
+        return blacklist
 
     # 預計算的 EMA 週期列表 (涵蓋優化常用範圍 20-60)
     PRECOMPUTED_EMA_PERIODS = [20, 30, 40, 50, 60]
+
+    # 指標註冊表: 名稱 → 建構方法，欄位 _{NAME}{period} 於第一次使用時建立並保留在 data_cache
+    INDICATORS = {
+        'EMA': '_indicator_ema',
+        'ATR': '_indicator_atr',
+        'MAXGAP': '_indicator_max_gap',
+        'ADJSLOPE': '_indicator_adj_slope',
+    }
     
     def _get_ticker_data(self, ticker):
         """從 cache 或 disk 讀取股票資料，並預計算多個常用 EMA 週期"""
@@ -127,95 +231,233 @@ class SelectionEngine:
         if os.path.exists(p):
             df = utils.load_data(p)
             if df is not None and not df.empty:
-                # === 預計算多個常用 EMA 週期 (20, 30, 40, 50, 60) ===
-                price_col = 'Adj Close' if 'Adj Close' in df.columns else 'Close'
-                for period in self.PRECOMPUTED_EMA_PERIODS:
-                    df[f'_EMA{period}'] = df[price_col].ewm(span=period, adjust=False).mean()
+                if self.compact:
+                    # compact 模式: 指標欄位只在使用時建立
+                    df = utils.compact_price_frame(df, self._compact_calendar(ticker))
+                else:
+                    # === 預計算多個常用 EMA 週期 (20, 30, 40, 50, 60) ===
+                    for period in self.PRECOMPUTED_EMA_PERIODS:
+                        self._ensure_indicator(df, 'EMA', period)
                 self.data_cache[ticker] = df
                 return df
         return None
 
-    def calculate_metrics(self, ticker, current_date, lookback=60):
+    def _ensure_indicator(self, df, name, period):
+        """確保 df 有 _{name}{period} 欄位 (不存在時依註冊表建立)，回傳欄位名稱"""
+        col = f'_{name}{period}'
+        if col not in df.columns:
+            values = getattr(self, self.INDICATORS[name])(df, period)
+            df[col] = np.asarray(values, dtype=np.float32) if self.compact else values
+        return col
+
+    def warm_indicators(self, params=None):
+        """
+        預先建立 params 使用的指標欄位與對齊到 panel 的 asof 陣列
+        (例如在 export 共用資料或 fork worker 之前呼叫，讓 worker 不必各自計算)
+        """
+        p = params if params is not None else self.params
+        if self.get_panel() is None:
+            return
+        for ind in self._metric_indicators(p.LOOKBACK, p.EXIT_EMA, p.ATR_PERIOD):
+            if ind is None:
+                continue
+            name, period = ind
+            self._panel_field(f'_{name}{period}',
+                              ensure=lambda df, name=name, period=period: self._ensure_indicator(df, name, period))
+        self._panel_field('_ROWS')
+        self._panel_field('Close')
+
+    def _compact_calendar(self, ticker):
+        """compact 模式共用的日期 index (基準 SPY 的 index；載入基準本身時為 None)"""
+        benchmark = getattr(config, 'BENCHMARK_TICKER', 'SPY')
+        if ticker == benchmark:
+            return None
+        spy = self._get_ticker_data(benchmark)
+        return None if spy is None else spy.index
+
+    def memory_usage(self):
+        """
+        data_cache 與 panel 的記憶體用量 (bytes)，共用的 index 只計算一次
+        回傳 {'data_cache': ..., 'index': ..., 'panel': ...}
+        """
+        columns, seen = 0, {}
+        for df in self.data_cache.values():
+            if df is None:
+                continue
+            columns += int(df.memory_usage(index=False, deep=True).sum())
+            base = df.index.values.base if df.index.values.base is not None else df.index.values
+            seen[id(base)] = base.nbytes
+        panel = 0
+        if self.panel is not None:
+            panel = sum(a.nbytes for a in {id(a): a for a in self.panel.arrays.values()}.values())
+        return {'data_cache': columns, 'index': sum(seen.values()), 'panel': panel}
+
+    def get_indicator(self, ticker, name, period):
+        """取得股票的指標序列 (例如 get_indicator('AAPL', 'ATR', 20))"""
+        df = self._get_ticker_data(ticker)
+        if df is None or df.empty:
+            return None
+        return df[self._ensure_indicator(df, name, period)]
+
+    @staticmethod
+    def _indicator_ema(df, period):
+        """全歷史 EMA (Adj Close 優先)"""
+        price_col = 'Adj Close' if 'Adj Close' in df.columns else 'Close'
+        return df[price_col].ewm(span=period, adjust=False).mean().values
+
+    @staticmethod
+    def _indicator_atr(df, period):
+        """
+        第 i 天的 ATR = 最近 period 根 True Range 的平均
+        True Range = max(High-Low, |High-PrevClose|, |Low-PrevClose|)
+        """
+        high = df['High'].values
+        low = df['Low'].values
+        prev_close = np.r_[np.nan, df['Close'].values[:-1]]
+        tr = np.maximum(high - low,
+                        np.maximum(np.abs(high - prev_close),
+                                   np.abs(low - prev_close)))
+        return pd.Series(tr).rolling(period).mean().values
+
+    @staticmethod
+    def _indicator_max_gap(df, period):
+        """第 i 天的 max_gap = 最近 period 根 K 棒內 (period-1 個) 開盤跳空幅度的最大值"""
+        opens = df['Open'].values
+        prev_close = np.r_[np.nan, df['Close'].values[:-1]]
+        gaps = np.abs((opens - prev_close) / prev_close)
+        return pd.Series(gaps).rolling(period - 1).max().values
+
+    @staticmethod
+    def _indicator_adj_slope(df, period):
+        price_col = 'Adj Close' if 'Adj Close' in df.columns else 'Close'
+        return SelectionEngine._rolling_adj_slope(df[price_col].values, period)
+
+    @staticmethod
+    def _rolling_adj_slope(prices, lookback):
+        """
+        以累積和一次算出整段歷史每一天的 adj_slope (slope × r²)
+        第 i 天的值 = 以 [i-lookback+1, i] 視窗對 log 價格做線性迴歸 (與 scipy.stats.linregress 相同的中心化公式)
+        x 為視窗內 0..lookback-1，利用 Σy、Σy²、Σjy (j 為全域位置) 的差分取得各視窗的迴歸統計量
+        視窗不足或含非正價格的位置為 NaN
+        """
+        n = len(prices)
+        out = np.full(n, np.nan)
+        if n < lookback:
+            return out
+        with np.errstate(divide='ignore', invalid='ignore'):
+            y = np.log(np.asarray(prices, dtype=np.float64))
+        bad = ~np.isfinite(y)
+        y = np.where(bad, 0.0, y)
+        y = np.where(bad, 0.0, y - y[~bad].mean()) if (~bad).any() else y  # 置中以降低累積和的誤差
+        j = np.arange(n, dtype=np.float64)
+
+        def window_sum(v):
+            cs = np.concatenate(([0.0], np.cumsum(v)))
+            return cs[lookback:] - cs[:-lookback]
+
+        s_y = window_sum(y)
+        s_yy = window_sum(y * y)
+        s_jy = window_sum(j * y)
+        n_bad = window_sum(bad.astype(np.float64))
+        start = j[:n - lookback + 1]
+
+        L = float(lookback)
+        s_x = L * (L - 1) / 2
+        ss_x = L * (L * L - 1) / 12
+        ss_xy = (s_jy - start * s_y) - s_x * s_y / L
+        ss_y = np.maximum(s_yy - s_y * s_y / L, 0.0)
+
+        slope = ss_xy / ss_x
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r_value = np.where(ss_y > 0, ss_xy / np.sqrt(ss_x * ss_y), 0.0)
+        r_value = np.clip(r_value, -1.0, 1.0)
+        adj_slope = ((1 + slope) ** lookback - 1) * (r_value ** 2)
+        adj_slope[n_bad > 0] = np.nan
+        out[lookback - 1:] = adj_slope
+        return out
+
+    @staticmethod
+    def _metric_indicators(lookback, exit_ema_period, atr_period):
+        """
+        calculate_metrics 所需的預計算指標 [(name, period)]，順序為 adj_slope, max_gap, exit_ema, atr
+        max_gap / atr 的視窗超出 lookback 時 (與原本視窗內計算不同) 為 None，改為視窗內計算
+        """
+        return [
+            ('ADJSLOPE', lookback),
+            ('MAXGAP', lookback) if lookback >= 2 else None,
+            ('EMA', exit_ema_period),
+            ('ATR', atr_period) if atr_period < lookback else None,
+        ]
+
+    def calculate_metrics(self, ticker, current_date, lookback=60, params=None):
         """
         計算股票指標 (精簡版 - 只計算實際使用的指標)
         實際使用的指標: adj_slope, max_gap, price, ema50
+        所有指標皆為預計算欄位的 O(1) 查詢
+        params: StrategyParams (None 表示 self.params)
         """
         # 0. Check Metrics Cache (包含 EXIT_EMA 和 ATR_PERIOD 支援優化)
-        exit_ema_period = getattr(config, 'EXIT_EMA', 50)
+        p = params if params is not None else self.params
+        exit_ema_period, atr_period = p.EXIT_EMA, p.ATR_PERIOD
         
-        # 讀取 ATR_PERIOD (需與後續計算一致)
-        atr_period = getattr(config, 'ATR_PERIOD', None)
-        if atr_period is None:
-            try:
-                import config_final
-                atr_period = getattr(config_final, 'ATR_PERIOD', 14)
-            except:
-                atr_period = 14
-        
-        cache_key = (ticker, current_date, lookback, exit_ema_period, atr_period)
-        if cache_key in self.metrics_cache:
-            return self.metrics_cache[cache_key]
+        cache_key = (ticker, current_date, lookback, p.metrics_key)
+        cached = self.metrics_cache.get(cache_key)
+        if cached is not None:
+            return cached
 
         # 1. 獲取資料
         df = self._get_ticker_data(ticker)
         if df is None or df.empty:
             return None
         
-        mask = df.index <= current_date
-        hist_data = df[mask].tail(lookback + exit_ema_period)  # 動態計算所需額外天數
-        
-        if len(hist_data) < lookback:
+        adj_slope_col, gap_col, ema_col, atr_col = [
+            self._ensure_indicator(df, *ind) if ind else None
+            for ind in self._metric_indicators(lookback, exit_ema_period, atr_period)]
+
+        # current_date 當日或之前最近一筆的位置
+        pos = df.index.searchsorted(current_date, side='right') - 1
+        if pos + 1 < lookback:
             return None
-            
-        target_chunk = hist_data.iloc[-lookback:]
-        
-        # 優先使用 'Adj Close' 計算動能
-        price_col_for_trend = 'Adj Close' if 'Adj Close' in hist_data.columns else 'Close'
-        trend_series = target_chunk[price_col_for_trend].values
-        closes = target_chunk['Close'].values
-        
+
         # 2. Adjusted Slope (排序用)
-        try:
-            y_log = np.log(trend_series)
-            x_axis = np.arange(len(y_log))
-            slope, intercept, r_value, p_value, std_err = stats.linregress(x_axis, y_log)
-            adj_slope = ((1 + slope) ** lookback - 1) * (r_value ** 2)
-        except:
-            adj_slope = -999
-
-        # 3. Max Gap (過濾用 - 向量化計算)
-        opens = target_chunk['Open'].values
-        prev_closes = np.roll(closes, 1)
-        prev_closes[0] = opens[0]
-        gaps = np.abs((opens - prev_closes) / prev_closes)
-        max_gap = np.max(gaps[1:])
-        
-        # 4. EXIT_EMA - 優先使用預計算值，否則動態計算
-        ema_col = f'_EMA{exit_ema_period}'
-        if ema_col in hist_data.columns:
-            # 使用預計算的值 (O(1) 查詢)
-            exit_ema = hist_data[ema_col].iloc[-1] if len(hist_data) > 0 else 0.0
+        adj_slope = df[adj_slope_col].values[pos]
+        current_price = df['Close'].values[pos]
+
+        # 4. EXIT_EMA
+        exit_ema = df[ema_col].values[pos]
+
+        target_chunk = None
+        if gap_col is None or atr_col is None:
+            target_chunk = df.iloc[pos - lookback + 1:pos + 1]
+            closes = target_chunk['Close'].values
+
+        # 3. Max Gap (過濾用)
+        if gap_col is not None:
+            max_gap = df[gap_col].values[pos]
         else:
-            # 非常用週期，動態計算
-            price_col = 'Adj Close' if 'Adj Close' in hist_data.columns else 'Close'
-            ema_series = hist_data[price_col].ewm(span=exit_ema_period, adjust=False).mean()
-            exit_ema = ema_series.iloc[-1] if len(ema_series) > 0 else 0.0
-            
-        current_price = closes[-1]
+            opens = target_chunk['Open'].values
+            prev_closes = np.roll(closes, 1)
+            prev_closes[0] = opens[0]
+            gaps = np.abs((opens - prev_closes) / prev_closes)
+            max_gap = np.max(gaps[1:])
         
         # 5. ATR 計算 (Average True Range) - V3 風險評估用
-        high = target_chunk['High'].values
-        low = target_chunk['Low'].values
-        prev_close = np.roll(closes, 1)
-        prev_close[0] = closes[0]  # 處理第一個元素
-        
-        # True Range = max(High-Low, |High-PrevClose|, |Low-PrevClose|)
-        tr = np.maximum(high - low, 
-                        np.maximum(np.abs(high - prev_close), 
-                                   np.abs(low - prev_close)))
-        
-        # 使用已計算的 atr_period (from cache_key logic)
-        atr = np.mean(tr[-atr_period:]) if len(tr) >= atr_period else np.mean(tr)
+        if atr_col is not None:
+            atr = df[atr_col].values[pos]
+        else:
+            # ATR 週期 >= lookback: 視窗內計算 (第一根以自身收盤為前收)
+            high = target_chunk['High'].values
+            low = target_chunk['Low'].values
+            prev_close = np.roll(closes, 1)
+            prev_close[0] = closes[0]  # 處理第一個元素
+            tr = np.maximum(high - low, 
+                            np.maximum(np.abs(high - prev_close), 
+                                       np.abs(low - prev_close)))
+            atr = np.mean(tr[-atr_period:]) if len(tr) >= atr_period else np.mean(tr)
+        if self.compact:
+            # float32 欄位轉回 float64 純量 (與批次模式相同)
+            adj_slope, max_gap, current_price, exit_ema, atr = map(
+                np.float64, (adj_slope, max_gap, current_price, exit_ema, atr))
         atr_pct = (atr / current_price) if current_price > 0 else 0  # 標準化為百分比
         
         # 精簡的結果 - 只包含實際使用的欄位
@@ -234,55 +476,139 @@ class SelectionEngine:
         
         return result_dict
 
-    def _compute_residuals(self, tickers, date, spy_df, lookback=60):
+    @staticmethod
+    def _window_returns(values, index, date, lookback):
         """
-        計算每檔股票相對於 SPY 的迴歸殘差
-        回傳 {ticker: pd.Series(residuals)} 字典
+        date 當日或之前最後 lookback + 1 筆價格的日報酬 (與 tail(lookback + 1).pct_change().dropna() 相同)
+        回傳 (returns, dates)
+        """
+        end = index.searchsorted(date, side='right')
+        start = max(0, end - lookback - 1)
+        prices = values[start:end]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns = prices[1:] / prices[:-1] - 1
+        return returns, index.values[start + 1:end]
+
+    def _residual_matrix(self, tickers, date, spy_df, lookback=60):
+        """
+        [OPTIMIZATION] 一次計算所有股票相對於 SPY 的迴歸殘差
+        報酬對齊到 SPY 報酬日期 (m 日 × n 檔矩陣，缺資料為 NaN)，
+        以遮罩後的封閉解對每一欄同時做 R_stock = alpha + beta * R_spy 迴歸
+        回傳 (tickers, residuals, valid, dates)；residuals 在 valid 為 False 處為 NaN
+        共同交易日少於 lookback * 0.8 的股票不列入
         """
-        # SPY 日報酬率
         spy_close = spy_df['Close']
-        spy_mask = spy_close.index <= date
-        spy_hist = spy_close[spy_mask].tail(lookback + 1)
-        spy_returns = spy_hist.pct_change().dropna()
-        
-        if len(spy_returns) < int(lookback * 0.8):
-            return {}
+        spy_returns, spy_dates = self._window_returns(spy_close.values, spy_close.index, date, lookback)
+        keep = ~np.isnan(spy_returns)
+        spy_returns, spy_dates = spy_returns[keep], spy_dates[keep]
         
-        residuals_dict = {}
         min_data = int(lookback * 0.8)
+        empty = ([], np.empty((len(spy_returns), 0)), np.empty((len(spy_returns), 0), dtype=bool), spy_dates)
+        if len(spy_returns) < min_data:
+            return empty
         
+        # 1. 報酬矩陣 (對齊 SPY 報酬日期)
+        m = len(spy_returns)
+        kept, columns = [], []
         for ticker in tickers:
             df = self._get_ticker_data(ticker)
             if df is None or df.empty:
                 continue
-            
             price_col = 'Adj Close' if 'Adj Close' in df.columns else 'Close'
-            stock_mask = df.index <= date
-            stock_hist = df[stock_mask][price_col].tail(lookback + 1)
-            stock_returns = stock_hist.pct_change().dropna()
-            
-            # 取共同交易日
-            common_idx = stock_returns.index.intersection(spy_returns.index)
-            if len(common_idx) < min_data:
+            returns, dates = self._window_returns(df[price_col].values, df.index, date, lookback)
+            pos = np.searchsorted(spy_dates, dates)
+            pos_clipped = np.minimum(pos, m - 1)
+            match = (pos < m) & (spy_dates[pos_clipped] == dates) & ~np.isnan(returns)
+            if match.sum() < min_data:
                 continue
-            
-            sr = stock_returns.loc[common_idx].values
-            mr = spy_returns.loc[common_idx].values
-            
-            # 迴歸: R_stock = alpha + beta * R_spy + epsilon
-            slope, intercept, _, _, _ = stats.linregress(mr, sr)
-            residuals = sr - (intercept + slope * mr)
-            residuals_dict[ticker] = pd.Series(residuals, index=common_idx)
-        
-        return residuals_dict
+            col = np.full(m, np.nan)
+            col[pos[match]] = returns[match]
+            kept.append(ticker)
+            columns.append(col)
+        if not kept:
+            return empty
+        
+        R = np.column_stack(columns)
+        valid = ~np.isnan(R)
+        n = valid.sum(axis=0)
+        x = spy_returns[:, None]
+        
+        # 2. 遮罩迴歸 (與 scipy.stats.linregress 相同的中心化公式)
+        x_mean = np.where(valid, x, 0.0).sum(axis=0) / n
+        y_mean = np.where(valid, R, 0.0).sum(axis=0) / n
+        xc = np.where(valid, x - x_mean, 0.0)
+        yc = np.where(valid, R - y_mean, 0.0)
+        ssxm = (xc * xc).sum(axis=0) / n
+        ssxym = (xc * yc).sum(axis=0) / n
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = ssxym / ssxm
+        intercept = y_mean - slope * x_mean
+        residuals = np.where(valid, R - (intercept + slope * x), np.nan)
+        return kept, residuals, valid, spy_dates
+
+    def _compute_residuals(self, tickers, date, spy_df, lookback=60):
+        """
+        計算每檔股票相對於 SPY 的迴歸殘差
+        回傳 {ticker: pd.Series(residuals)} 字典
+        """
+        kept, residuals, valid, dates = self._residual_matrix(tickers, date, spy_df, lookback)
+        dates = pd.DatetimeIndex(dates)
+        return {t: pd.Series(residuals[valid[:, j], j], index=dates[valid[:, j]])
+                for j, t in enumerate(kept)}
+
+    @staticmethod
+    def _residual_correlation(residuals, valid):
+        """
+        所有殘差兩兩之間在共同有效日期上的相關係數 (一次矩陣運算)
+        回傳 (corr, counts)，counts 為共同有效日數
+        """
+        V = valid.astype(np.float64)
+        E = np.where(valid, residuals, 0.0)
+        counts = V.T @ V
+        s1 = E.T @ V          # s1[a, b] = Σ_common e_a
+        s2 = (E * E).T @ V    # s2[a, b] = Σ_common e_a²
+        p = E.T @ E           # p[a, b] = Σ_common e_a e_b
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = p - s1 * s1.T / counts
+            var_a = s2 - s1 * s1 / counts
+            var_b = var_a.T
+            corr = cov / np.sqrt(var_a * var_b)
+        return corr, counts
+
+    # 相關係數與門檻差距小於此值時，以 np.corrcoef 精確重算 (避免矩陣公式的浮點誤差改變選股)
+    CORR_RECHECK_TOL = 1e-9
+    # 滾動引擎由原始乘積和展開，相消誤差較大，使用較寬的重算範圍
+    ROLLING_CORR_RECHECK_TOL = 1e-6
+
+    def get_residual_engine(self, spy_df, lookback):
+        """
+        取得 lookback 對應的滾動殘差共變異數引擎 (第一次使用或 SPY 資料不同時以 data_cache 建立)
+        """
+        engine = self.residual_engines.get(lookback)
+        if engine is None or engine.source is not spy_df:
+            engine = RollingResidualCovariance.from_frames(self.data_cache, spy_df, lookback)
+            self.residual_engines[lookback] = engine
+        return engine
+
+    def _exact_pair_correlation(self, a, b, date, spy_df, lookback):
+        """兩檔股票殘差在共同有效日上的相關係數 (np.corrcoef)"""
+        kept, residuals, valid, _ = self._residual_matrix([a, b], date, spy_df, lookback)
+        if len(kept) < 2:
+            return np.nan
+        common = valid[:, 0] & valid[:, 1]
+        return np.corrcoef(residuals[common, 0], residuals[common, 1])[0, 1]
 
     def filter_by_residual_correlation(self, ranked_candidates, date, spy_df,
                                         threshold, lookback, max_candidates,
-                                        needed, existing_tickers=None):
+                                        needed, existing_tickers=None,
+                                        rolling=False, shrinkage=None):
         """
         殘差相關性過濾 - 包廂邏輯 (Box Seat Logic)
         ranked_candidates: 已排序的候選股清單 [{ticker, adj_slope, ...}, ...]
         existing_tickers: 現有持股 ticker 列表，需一併參與相關性檢查
+        rolling: 使用滾動殘差共變異數引擎 (O(k²) 查詢，不讀取價格歷史)；
+                 有股票不在引擎中 (例如不在 SPY 日曆上的交易日) 時自動改用逐檔計算
+        shrinkage: 僅滾動模式，相關係數收縮 (None / 0~1 / 'ledoit-wolf')
         回傳: 篩選後的新買入 ticker 列表
         """
         if existing_tickers is None:
@@ -292,12 +618,39 @@ class SelectionEngine:
         candidates = ranked_candidates[:max_candidates]
         candidate_tickers = [x['ticker'] for x in candidates]
         
-        # 所有需要計算殘差的 ticker (候選 + 已持有)
-        all_tickers = list(set(candidate_tickers + list(existing_tickers)))
-        residuals_dict = self._compute_residuals(all_tickers, date, spy_df, lookback)
+        # 所有需要計算殘差的 ticker (候選 + 已持有)，殘差與相關係數矩陣各只算一次
+        all_tickers = list(dict.fromkeys(candidate_tickers + list(existing_tickers)))
+        rolled = None
+        if rolling:
+            rolled = self.get_residual_engine(spy_df, lookback).correlation(all_tickers, date, shrinkage)
+        if rolled is not None:
+            kept, corr, counts = rolled
+            
+            def recheck(a, b):
+                if shrinkage is not None:
+                    return corr[a, b]
+                return self._exact_pair_correlation(kept[a], kept[b], date, spy_df, lookback)
+            tol = self.ROLLING_CORR_RECHECK_TOL
+        else:
+            kept, residuals, valid, _ = self._residual_matrix(all_tickers, date, spy_df, lookback)
+            corr, counts = self._residual_correlation(residuals, valid)
+            
+            def recheck(a, b):
+                common = valid[:, a] & valid[:, b]
+                return np.corrcoef(residuals[common, a], residuals[common, b])[0, 1]
+            tol = self.CORR_RECHECK_TOL
+        col_of = {t: j for j, t in enumerate(kept)}
+        
+        def too_correlated(a, b):
+            if counts[a, b] < 20:
+                return False
+            c = corr[a, b]
+            if abs(abs(c) - threshold) < tol:
+                c = recheck(a, b)
+            return abs(c) >= threshold
         
         # 已選集合 (先放入已持有的股票)
-        selected = [t for t in existing_tickers if t in residuals_dict]
+        selected = [col_of[t] for t in existing_tickers if t in col_of]
         result = []  # 只記錄新買入的
         
         for item in candidates:
@@ -305,52 +658,142 @@ class SelectionEngine:
             if len(result) >= needed:
                 break
             
-            if ticker not in residuals_dict:
+            if ticker not in col_of:
                 continue
             
             # 檢查與所有已選股的殘差相關係數
-            passed = True
-            for sel_ticker in selected:
-                if sel_ticker not in residuals_dict:
-                    continue
-                res_a = residuals_dict[ticker]
-                res_b = residuals_dict[sel_ticker]
-                common = res_a.index.intersection(res_b.index)
-                if len(common) < 20:
-                    continue
-                corr = np.corrcoef(res_a.loc[common].values, res_b.loc[common].values)[0, 1]
-                if abs(corr) >= threshold:
-                    passed = False
-                    break
-            
-            if passed:
-                selected.append(ticker)
+            j = col_of[ticker]
+            if not any(too_correlated(j, k) for k in selected):
+                selected.append(j)
                 result.append(ticker)
         
         return result
 
-    def scan_market(self, date, lookback=None):
-        """掃描市場並排名 (使用快取)"""
-        # Use provided lookback or default to LOOKBACK_ENTRY
-        lb = lookback if lookback is not None else config.LOOKBACK
-        
-        # Optimization: Check cache (key includes lookback now)
-        cache_key = (date, lb)
-        if cache_key in self.scan_cache:
-            return self.scan_cache[cache_key]
+    def _panel_field(self, name, ensure=None):
+        """
+        取得對齊到 panel 日曆的欄位 (例如 '_EMA50')，第一次使用時由 data_cache 建立
+        值為各股票自身資料中「該日或之前最近一筆」(與 calculate_metrics 的 <= date 一致)
+        ensure: 可選的 callback(df)，欄位不存在時先對每檔股票建立
+        特殊欄位 '_ROWS': 各股票截至該日的資料筆數
+        存放於 panel.arrays['asof:<name>'] (與原始 OHLC 欄位區隔)
+        """
+        panel = self.get_panel()
+        key = f'asof:{name}'
+        if key in panel.arrays:
+            return panel.arrays[key]
+        arr = np.full((len(panel.dates), len(panel.tickers)), np.nan, dtype=panel.dtype)
+        for j, ticker in enumerate(panel.tickers):
+            df = self.data_cache.get(ticker)
+            if df is None:
+                continue
+            pos = df.index.searchsorted(panel.dates, side='right') - 1
+            if name == '_ROWS':
+                arr[:, j] = pos + 1
+                continue
+            if ensure is not None:
+                ensure(df)
+            if name not in df.columns:
+                continue
+            valid = pos >= 0
+            arr[valid, j] = df[name].values[pos[valid]]
+        panel.arrays[key] = arr
+        return arr
+
+    def _scan_metrics_batch(self, tickers, date, lookback, params):
+        """
+        批次計算整個股票池的指標 (結果與逐檔 calculate_metrics 相同)
+        所有指標 (_ADJSLOPE / _MAXGAP / _EMA / _ATR) 皆為預計算欄位，
+        對齊到 panel 後一次取出整列，不再逐檔切片
+        date 不在日曆上時，有日曆外交易日的股票退回逐檔計算
+        回傳與 tickers 同順序的 metrics 列表 (無資料者略過)
+        """
+        exit_ema_period, atr_period = params.EXIT_EMA, params.ATR_PERIOD
+        panel = self.get_panel()
+        row = panel.row_asof(date)
+        on_calendar = panel.row(date) >= 0
+
+        indicators = self._metric_indicators(lookback, exit_ema_period, atr_period)
+        use_batch = row >= 0 and None not in indicators
+
+        metrics_by_ticker = {}
+        batch = []  # [(ticker, col)]
+        for t in tickers:
+            cached = self.metrics_cache.get((t, date, lookback, params.metrics_key))
+            if cached is not None:
+                metrics_by_ticker[t] = cached
+                continue
+            col = panel.col(t)
+            if not use_batch or col < 0 or (panel.off_calendar[col] and not on_calendar):
+                metrics_by_ticker[t] = self.calculate_metrics(t, date, lookback, params)
+            else:
+                batch.append((t, col))
+
+        if batch:
+            cols = np.array([c for _, c in batch], dtype=np.int64)
+
+            def field(indicator, period):
+                values = self._panel_field(
+                    f'_{indicator}{period}',
+                    ensure=lambda df: self._ensure_indicator(df, indicator, period))[row, cols]
+                return values.astype(np.float64, copy=False)
+
+            n_rows = self._panel_field('_ROWS')[row, cols]
+            adj_slope, max_gap, exit_ema, atr = [field(*ind) for ind in indicators]
+            current_price = self._panel_field('Close')[row, cols].astype(np.float64, copy=False)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                atr_pct = np.where(current_price > 0, atr / current_price, 0)
+
+            for k, (t, _) in enumerate(batch):
+                if n_rows[k] < lookback:
+                    metrics_by_ticker[t] = None
+                    continue
+                result_dict = {
+                    'ticker': t,
+                    'adj_slope': adj_slope[k],
+                    'max_gap': max_gap[k],
+                    'price': current_price[k],
+                    'exit_ema': exit_ema[k],
+                    'atr': atr[k],
+                    'atr_pct': atr_pct[k],
+                }
+                self.metrics_cache[(t, date, lookback, params.metrics_key)] = result_dict
+                metrics_by_ticker[t] = result_dict
+
+        return [metrics_by_ticker[t] for t in tickers if metrics_by_ticker.get(t)]
+
+    def scan_market(self, date, lookback=None, vectorized=None, params=None):
+        """
+        掃描市場並排名 (使用快取)
+        vectorized: 使用批次模式 (預設依 self.vectorized_scan)，結果與逐檔計算相同
+        params: StrategyParams (None 表示 self.params)，同一個 engine 可同時服務不同參數的回測
+        """
+        p = params if params is not None else self.params
+        # Use provided lookback or default to params.LOOKBACK
+        lb = lookback if lookback is not None else p.LOOKBACK
+        if vectorized is None:
+            vectorized = self.vectorized_scan
+        
+        # Optimization: Check cache (key includes lookback and scan parameters)
+        cache_key = (date, lb, p.scan_key)
+        cached = self.scan_cache.get(cache_key)
+        if cached is not None:
+            return cached
 
         tickers = self.get_constituents(date)
         if not tickers:
             return []
             
-        results = []
-        for t in tickers:
-            metrics = self.calculate_metrics(t, date, lb)
-            if metrics:
-                results.append(metrics)
+        if vectorized and self.get_panel() is not None:
+            results = self._scan_metrics_batch(tickers, date, lb, p)
+        else:
+            results = []
+            for t in tickers:
+                metrics = self.calculate_metrics(t, date, lb, p)
+                if metrics:
+                    results.append(metrics)
         
         # Filter Logic: 跳空缺口 > threshold 的股票不納入排名
-        filtered = [r for r in results if r['max_gap'] <= config.SKIP_MAX_GAP_PCT]
+        filtered = [r for r in results if r['max_gap'] <= p.SKIP_MAX_GAP_PCT]
         
         # Sort by Adjusted Slope (High to Low)
         sorted_list = sorted(filtered, key=lambda x: x['adj_slope'], reverse=True)
@@ -359,3 +802,33 @@ class SelectionEngine:
         self.scan_cache[cache_key] = sorted_list
         
         return sorted_list
+
+
+def compare_rankings(reference, candidate, rtol=1e-4, atol=1e-6):
+    """
+    比較兩份 scan_market 排名 (例如 float64 與 compact float32 模式)
+    - 數值欄位: 相對誤差 rtol / 絕對誤差 atol 內視為相同
+    - 排序: candidate 中相鄰兩檔在 reference 的 adj_slope 若差距超過容許誤差卻順序相反，視為違反
+    - 成員: 只出現在其中一份的 ticker 列於 missing / extra (例如 max_gap 剛好落在過濾門檻兩側)
+    回傳 dict: ok, max_abs_diff {欄位: 最大誤差}, order_violations [(ticker_a, ticker_b)], missing, extra
+    """
+    ref = {m['ticker']: m for m in reference}
+    cand = {m['ticker']: m for m in candidate}
+    report = {'max_abs_diff': {}, 'order_violations': [],
+              'missing': sorted(set(ref) - set(cand)), 'extra': sorted(set(cand) - set(ref))}
+
+    common = [t for t in cand if t in ref]
+    ok = True
+    for f in ('adj_slope', 'max_gap', 'price', 'exit_ema', 'atr', 'atr_pct'):
+        a = np.array([ref[t][f] for t in common], dtype=np.float64)
+        b = np.array([cand[t][f] for t in common], dtype=np.float64)
+        report['max_abs_diff'][f] = float(np.nanmax(np.abs(a - b))) if len(common) else 0.0
+        if not np.allclose(a, b, rtol=rtol, atol=atol, equal_nan=True):
+            ok = False
+
+    for a, b in zip(common, common[1:]):
+        sa, sb = ref[a]['adj_slope'], ref[b]['adj_slope']
+        if sa < sb and not np.isclose(sa, sb, rtol=rtol, atol=atol):
+            report['order_violations'].append((a, b))
+    report['ok'] = ok and not report['order_violations'] and not report['missing'] and not report['extra']
+    return report
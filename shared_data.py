@@ -0,0 +1,114 @@
+"""
+Shared Data
+將 SelectionEngine 已載入 (及已預算指標) 的 data_cache 與 PricePanel 寫成 memory-mapped .npy 目錄，
+其他 process 以 attach_engine() 開啟 (zero-copy)，N 個 worker 只佔用一份資料的實體記憶體
+
+目錄結構:
+  frames/meta.json       tickers、欄位、每檔股票擁有的欄位
+  frames/dates.npy       所有股票依序串接的日期
+  frames/offsets.npy     每檔股票在串接陣列中的範圍 (n + 1)
+  frames/col_<k>.npy     串接的欄位資料 (股票沒有該欄位時為 NaN，attach 時不放入其 DataFrame)
+  panel/                 PricePanel.save()
+  engine.json            SelectionEngine 設定 (compact)
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from price_panel import PricePanel
+from selection import SelectionEngine
+
+FRAMES_DIR = 'frames'
+PANEL_DIR = 'panel'
+
+
+def save_frames(frames, directory):
+    """{ticker: DataFrame} → directory 下的串接 .npy 檔"""
+    os.makedirs(directory, exist_ok=True)
+    tickers = [t for t, df in frames.items() if df is not None and not df.empty]
+    columns = []
+    for t in tickers:
+        columns.extend(c for c in frames[t].columns if c not in columns)
+
+    lengths = [len(frames[t]) for t in tickers]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    total = int(offsets[-1])
+
+    date_dtype = frames[tickers[0]].index.dtype if tickers else np.dtype('datetime64[ns]')
+    dates = np.empty(total, dtype=date_dtype)
+    for t, start, end in zip(tickers, offsets[:-1], offsets[1:]):
+        dates[start:end] = frames[t].index.values
+    np.save(os.path.join(directory, 'dates.npy'), dates)
+    np.save(os.path.join(directory, 'offsets.npy'), offsets)
+
+    ticker_ids = {t: j for j, t in enumerate(tickers)}
+    present = {}
+    for k, col in enumerate(columns):
+        owners = [t for t in tickers if col in frames[t].columns]
+        dtype = np.result_type(*[frames[t][col].dtype for t in owners])
+        values = np.lib.format.open_memmap(os.path.join(directory, f'col_{k}.npy'),
+                                           mode='w+', dtype=dtype, shape=(total,))
+        values[:] = np.nan if np.issubdtype(dtype, np.floating) else 0
+        for j, t in enumerate(tickers):
+            if col in frames[t].columns:
+                values[offsets[j]:offsets[j + 1]] = frames[t][col].values
+        values.flush()
+        del values
+        present[col] = [ticker_ids[t] for t in owners]
+
+    with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'tickers': tickers, 'columns': columns, 'present': present}, f)
+
+
+def attach_frames(directory):
+    """
+    以唯讀 memory-map 開啟 save_frames() 的結果，回傳 {ticker: DataFrame}
+    每個 DataFrame 的欄位與 index 皆為 memory-map 的切片 (不複製資料)；
+    之後新增的欄位 (例如指標) 為該 process 私有
+    """
+    with open(os.path.join(directory, 'meta.json'), encoding='utf-8') as f:
+        meta = json.load(f)
+    dates = np.load(os.path.join(directory, 'dates.npy'), mmap_mode='r')
+    offsets = np.load(os.path.join(directory, 'offsets.npy'))
+    columns = {col: np.load(os.path.join(directory, f'col_{k}.npy'), mmap_mode='r')
+               for k, col in enumerate(meta['columns'])}
+    owners = {col: set(ids) for col, ids in meta['present'].items()}
+
+    frames = {}
+    for j, t in enumerate(meta['tickers']):
+        start, end = int(offsets[j]), int(offsets[j + 1])
+        data = {col: values[start:end] for col, values in columns.items() if j in owners[col]}
+        index = pd.DatetimeIndex(dates[start:end], copy=False, name='Date')
+        frames[t] = pd.DataFrame(data, index=index, copy=False)
+    return frames
+
+
+def export_engine(selector, directory):
+    """
+    將 selector 的 data_cache 與 panel 寫入 directory (panel 尚未建立時先建立)
+    先呼叫 selector.warm_indicators(...) 可讓預算的指標欄位一併共用
+    """
+    save_frames(selector.data_cache, os.path.join(directory, FRAMES_DIR))
+    panel = selector.get_panel()
+    if panel is not None:
+        panel.save(os.path.join(directory, PANEL_DIR))
+    with open(os.path.join(directory, 'engine.json'), 'w', encoding='utf-8') as f:
+        json.dump({'compact': bool(selector.compact)}, f)
+
+
+def attach_engine(directory, **kwargs):
+    """
+    由 export_engine() 的目錄建立 SelectionEngine (資料與 panel 皆為 memory-map，不重新讀檔/計算)
+    kwargs 傳給 SelectionEngine (例如 params、persistent_cache)
+    """
+    with open(os.path.join(directory, 'engine.json'), encoding='utf-8') as f:
+        kwargs.setdefault('compact', json.load(f)['compact'])
+    selector = SelectionEngine(data_cache=attach_frames(os.path.join(directory, FRAMES_DIR)), **kwargs)
+    panel_dir = os.path.join(directory, PANEL_DIR)
+    if os.path.exists(os.path.join(panel_dir, 'meta.json')):
+        selector.panel = PricePanel.attach(panel_dir)
+    selector._all_tickers_loaded = True
+    selector.load_scan_cache()
+    return selector
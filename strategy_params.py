@@ -0,0 +1,74 @@
+"""
+Strategy Parameters
+回測/選股使用的策略參數 (不可變、可 hash)
+欄位名稱與 config_final.py 相同，讓同一個程序中可以同時執行不同參數的回測，
+不必修改模組層級的 config
+"""
+from dataclasses import dataclass, fields, replace
+
+
+@dataclass(frozen=True)
+class StrategyParams:
+    # 回測設定
+    COMMISSION: float = 0.01
+
+    # 策略設定
+    TARGET_HOLDINGS: int = 4
+    REBALANCE_WEEKS: int = 1
+    REBALANCE_WEEKDAY: int = 2
+    LOOKBACK: int = 90
+    EXIT_EMA: int = 50
+    SKIP_MAX_GAP_PCT: float = 0.20
+    GAP_EXIT_PCT: float = 0.5
+    SELL_RANK_THRESHOLD: int = 20
+    STOP_LOSS_PCT: float = 0.2
+    MAX_ADJ_SLOPE: float = 1.5
+    LIVE_MODE: bool = True
+
+    # ATR 風險再平衡設定
+    ATR_PERIOD: int = 20
+    REBALANCE_THRESHOLD: float = 0.03
+    MIN_BUY_AMOUNT_PCT: float = 0.03
+
+    # 殘差相關性過濾設定
+    CORR_FILTER_ENABLED: bool = True
+    CORR_THRESHOLD: float = 0.6
+    CORR_LOOKBACK: int = 60
+    CORR_CANDIDATE_COUNT: int = 20
+    CORR_ROLLING: bool = False
+    CORR_SHRINKAGE: object = None
+
+    @classmethod
+    def from_config(cls, cfg=None, **overrides):
+        """
+        由 config 模組 (預設 config_final) 建立參數，overrides 覆寫個別欄位
+        例: StrategyParams.from_config(LOOKBACK=60, EXIT_EMA=40)
+        """
+        if cfg is None:
+            import config_final as cfg
+        values = {}
+        for f in fields(cls):
+            if hasattr(cfg, f.name):
+                values[f.name] = getattr(cfg, f.name)
+        unknown = set(overrides) - {f.name for f in fields(cls)}
+        if unknown:
+            raise ValueError(f"Unknown strategy parameters: {sorted(unknown)}")
+        values.update(overrides)
+        return cls(**values)
+
+    @property
+    def metrics_key(self):
+        """影響 calculate_metrics 結果的欄位 (SelectionEngine 快取鍵)"""
+        return (self.EXIT_EMA, self.ATR_PERIOD)
+
+    @property
+    def scan_key(self):
+        """影響 scan_market 結果的欄位 (lookback 另外傳入)"""
+        return (self.EXIT_EMA, self.ATR_PERIOD, self.SKIP_MAX_GAP_PCT)
+
+    def with_overrides(self, **overrides):
+        """回傳覆寫部分欄位後的新參數物件"""
+        return replace(self, **overrides)
+
+    def as_dict(self):
+        return {f.name: getattr(self, f.name) for f in fields(self)}
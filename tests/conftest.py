@@ -0,0 +1,57 @@
+"""
+測試共用 fixture: 合成的價格資料目錄 (不需要真實資料或網路)
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # noqa: E402
+import selection  # noqa: E402
+from constituents import ConstituentsMembership  # noqa: E402
+
+N_TICKERS = 24
+N_DAYS = 420
+
+
+def _write_prices(path, dates, close, rng):
+    """Date/Open/High/Low/Close/Adj Close/Volume CSV (utils.load_data 可讀取的格式)"""
+    open_ = close * (1 + rng.normal(0, 0.004, len(close)))
+    high = np.maximum(open_, close) * (1 + np.abs(rng.normal(0, 0.005, len(close))))
+    low = np.minimum(open_, close) * (1 - np.abs(rng.normal(0, 0.005, len(close))))
+    pd.DataFrame({
+        'Date': dates.strftime('%Y-%m-%d'),
+        'Open': open_, 'High': high, 'Low': low, 'Close': close, 'Adj Close': close,
+        'Volume': rng.integers(1_000, 100_000, len(close)),
+    }).to_csv(path, index=False)
+
+
+@pytest.fixture
+def synthetic_market(tmp_path, monkeypatch):
+    """
+    在 tmp_path 建立 SPY、SSO (2 倍槓桿) + N_TICKERS 檔股票的日線資料 (每檔不同漂移率，排名穩定)，
+    並將 config.DATA_DIR 與成分股指向該資料
+    回傳 {'dates': 交易日, 'tickers': 股票列表, 'data_dir': 路徑}
+    """
+    rng = np.random.default_rng(7)
+    dates = pd.bdate_range('2020-01-02', periods=N_DAYS)
+    spy = 300 * np.exp(np.cumsum(rng.normal(0.0004, 0.01, N_DAYS)))
+    _write_prices(tmp_path / 'SPY.csv', dates, spy, rng)
+    sso = 50 * np.exp(np.cumsum(2 * np.diff(np.log(spy), prepend=np.log(spy[0]))))
+    _write_prices(tmp_path / 'SSO.csv', dates, sso, rng)
+
+    tickers = [f'S{k:02d}' for k in range(N_TICKERS)]
+    for k, ticker in enumerate(tickers):
+        drift = -0.001 + 0.003 * k / N_TICKERS
+        close = (20 + 10 * k) * np.exp(np.cumsum(rng.normal(drift, 0.012, N_DAYS)))
+        _write_prices(tmp_path / f'{ticker}.csv', dates, close, rng)
+
+    members = pd.DataFrame([tickers] * N_DAYS, index=dates)
+    monkeypatch.setattr(config, 'DATA_DIR', str(tmp_path))
+    monkeypatch.setattr(selection, 'load_membership',
+                        lambda path: ConstituentsMembership.from_frame(members))
+    return {'dates': dates, 'tickers': tickers, 'data_dir': str(tmp_path)}
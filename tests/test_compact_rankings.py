@@ -0,0 +1,30 @@
+"""
+compact (float32) 價格快取的排名需與 float64 模式在容許誤差內相同
+"""
+from selection import SelectionEngine, compare_rankings
+
+TOP_N = 10
+
+
+def _engine(compact):
+    engine = SelectionEngine(persistent_cache=False, compact=compact)
+    engine.preload_all_data()
+    return engine
+
+
+def test_compact_rankings_match_float64(synthetic_market):
+    full = _engine(compact=False)
+    compact = _engine(compact=True)
+    assert compact.get_panel().dtype.itemsize == 4
+
+    for date in synthetic_market['dates'][[250, 320, 419]]:
+        for vectorized in (True, False):
+            reference = full.scan_market(date, vectorized=vectorized)
+            candidate = compact.scan_market(date, vectorized=vectorized)
+            assert reference, "synthetic universe should produce a ranking"
+
+            report = compare_rankings(reference, candidate)
+            assert report['ok'], report
+            assert [m['ticker'] for m in candidate[:TOP_N]] == [m['ticker'] for m in reference[:TOP_N]]
+            full.scan_cache.clear()
+            compact.scan_cache.clear()
@@ -0,0 +1,121 @@
+"""
+update_tickers_concurrent 以假下載器測試 (不需要網路或 yfinance)
+"""
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import update_data
+from update_data import Downloader, update_tickers_concurrent
+
+LAST_DATE = pd.Timestamp('2024-01-05')
+
+
+class FakeDownloader(Downloader):
+    """
+    依設定回傳合成日線資料的下載器
+    failures: {ticker: 次數}，包含該 ticker 的批次前幾次請求丟出例外
+    empty: 回傳全 NaN (下市/未知代碼) 的 ticker
+    calls: 每次請求的 (tickers, start, end)
+    """
+
+    def __init__(self, batch_size=1, failures=None, empty=(), rows=3):
+        self.batch_size = batch_size
+        self.failures = dict(failures or {})
+        self.empty = set(empty)
+        self.rows = rows
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def fetch(self, tickers, start, end):
+        with self._lock:
+            self.calls.append((tuple(tickers), start, end))
+            failing = [t for t in tickers if self.failures.get(t, 0) > 0]
+            for t in failing:
+                self.failures[t] -= 1
+        if failing:
+            raise ConnectionError(f"simulated failure for {failing}")
+
+        dates = pd.bdate_range(start, periods=self.rows, name='Date')
+        result = {}
+        for t in tickers:
+            if t in self.empty:
+                result[t] = pd.DataFrame(np.nan, index=dates,
+                                         columns=['Open', 'High', 'Low', 'Close', 'Adj Close', 'Volume']).dropna(how='all')
+                continue
+            close = 100.0 + np.arange(self.rows)
+            result[t] = pd.DataFrame({'Open': close, 'High': close + 1, 'Low': close - 1, 'Close': close,
+                                      'Adj Close': close, 'Volume': 1000}, index=dates)
+        return result
+
+
+def _write_existing(path, ticker):
+    dates = pd.bdate_range(end=LAST_DATE, periods=5)
+    pd.DataFrame({
+        'ticker': ticker, 'date': dates.strftime('%Y/%m/%d'),
+        'o': 10.0, 'h': 11.0, 'l': 9.0, 'c': 10.5, 'adj_c': 10.5, 'vol': 100,
+    }).to_csv(path, index=False)
+
+
+@pytest.fixture
+def items(tmp_path):
+    tickers = [f'T{k}' for k in range(7)]
+    result = []
+    for t in tickers:
+        path = tmp_path / f'{t}.txt'
+        _write_existing(path, t)
+        result.append((t, str(path)))
+    return result
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """記錄重試退避的等待時間 (不實際等待)"""
+    recorded = []
+    monkeypatch.setattr(update_data.time, 'sleep', recorded.append)
+    return recorded
+
+
+def test_concurrent_batches_retries_and_progress(items, sleeps):
+    downloader = FakeDownloader(batch_size=3, failures={'T4': 2}, empty={'T6'})
+    progress = []
+    summary = update_tickers_concurrent(items, downloader, max_workers=3, rate_limit=None,
+                                        retries=3, backoff=0.5,
+                                        progress_callback=lambda *args: progress.append(args))
+
+    # 7 檔 → 3 + 3 + 1；T4 所在批次失敗兩次後成功
+    batches = sorted({c[0] for c in downloader.calls})
+    assert batches == [('T0', 'T1', 'T2'), ('T3', 'T4', 'T5'), ('T6',)]
+    assert len(downloader.calls) == 3 + 2
+    assert {c[1] for c in downloader.calls} == {'2024-01-06'}
+    assert sorted(sleeps) == [0.5, 1.0]
+
+    assert summary == {'updated': 6, 'skipped': 1, 'failed': 0, 'failed_tickers': []}
+    assert sorted(p[0] for p in progress) == list(range(1, len(items) + 1))
+    assert all(p[1] == len(items) for p in progress)
+    statuses = {p[2]: p[3] for p in progress}
+    assert statuses['T6'] == 'skipped'
+    assert all(statuses[t] == 'updated' for t in statuses if t != 'T6')
+
+    appended = update_data.load_existing_data(dict(items)['T4'])
+    assert len(appended) == 5 + downloader.rows
+    assert appended['Date'].iloc[-1] == pd.Timestamp('2024-01-10')
+
+
+def test_batch_failing_after_retries_marks_all_failed(items, sleeps):
+    downloader = FakeDownloader(batch_size=4, failures={'T1': 10})
+    summary = update_tickers_concurrent(items, downloader, max_workers=2, rate_limit=None,
+                                        retries=2, backoff=1.0)
+
+    assert sorted(summary['failed_tickers']) == ['T0', 'T1', 'T2', 'T3']
+    assert summary['failed'] == 4 and summary['updated'] == 3
+    assert sorted(sleeps) == [1.0, 2.0]
+    failed_calls = [c for c in downloader.calls if 'T1' in c[0]]
+    assert len(failed_calls) == 3
+
+
+def test_downloader_is_abstract():
+    with pytest.raises(TypeError):
+        Downloader()
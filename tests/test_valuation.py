@@ -0,0 +1,70 @@
+"""
+增量估值 (_apply_trade_to_valuation) 與完整重估的誤差，以及權益紀錄必須為完整重估
+"""
+import os
+
+import numpy as np
+import pytest
+
+import utils
+from portfolio_backtester_final import PortfolioBacktesterFinal
+from selection import SelectionEngine
+from trade_ledger import BUY
+
+REL_TOL = 1e-9
+
+
+def _full_remark(bt, holdings, date):
+    """cash 以外的部分: Σ 持股數 × date 收盤價 (與 _mark_to_market 相同順序)"""
+    value = 0.0
+    for ticker, qty in holdings.items():
+        value += float(bt._get_price(ticker, date, use_open=False)) * qty
+    return value
+
+
+@pytest.fixture
+def backtest(synthetic_market):
+    data_dir = synthetic_market['data_dir']
+    spy = utils.load_benchmark_data(os.path.join(data_dir, 'SPY.csv'))
+    sso = utils.load_benchmark_data(os.path.join(data_dir, 'SSO.csv'))
+    selector = SelectionEngine(persistent_cache=False)
+    selector.preload_all_data()
+    dates = synthetic_market['dates']
+    bt = PortfolioBacktesterFinal(start_date=dates[220], end_date=dates[-1], initial_capital=1_000_000,
+                                  compounding=True, selector=selector, spy_df=spy, sso_df=sso,
+                                  write_reports=False, params={'STOP_LOSS_PCT': 0.05})
+    bt.run()
+    return bt
+
+
+def test_incremental_valuation_matches_full_remark(backtest):
+    bt = backtest
+    data = bt.ledger.data
+    assert len(data) > 20, "synthetic run should trade"
+
+    # 重播交易，逐筆比較交易後的增量估值與完整重估
+    holdings = {}
+    worst = 0.0
+    for k in range(len(data)):
+        ticker = bt.ledger.tickers[data['ticker'][k]]
+        qty = int(data['qty'][k])
+        if data['action'][k] == BUY:
+            holdings[ticker] = holdings.get(ticker, 0) + qty
+        else:
+            holdings[ticker] -= qty
+            if holdings[ticker] <= 0:
+                del holdings[ticker]
+        date = bt.calendar[bt.calendar.get_indexer([data['date'][k]])[0]]
+        full = float(data['cash'][k]) + _full_remark(bt, holdings, date)
+        worst = max(worst, abs(float(data['total_equity'][k]) - full) / full)
+    assert worst < REL_TOL
+
+
+def test_equity_history_is_full_remark(backtest):
+    bt = backtest
+    frame = bt.equity_history.frame()
+    # 最後一列 (LIVE_MODE 結束時重新記錄) 必須與以最終持倉完整重估逐位元相同
+    last_date = frame.index[-1]
+    expected = bt.cash + _full_remark(bt, bt.holdings, last_date)
+    assert frame['Equity'].iloc[-1] == expected
+    assert np.isfinite(frame['Gross_Exposure']).all()
@@ -0,0 +1,165 @@
+"""
+Trade Ledger
+回測交易紀錄: 預先配置的 NumPy structured array (容量不足時倍增)，
+ticker 與交易原因以整數 id 儲存 (interned)，每筆只記錄原始數量、價格與金額
+交易後持倉快照 (Holdings_After) 與 backtest_trades*.csv 的內容在輸出報表時才由紀錄重建，
+write_reports=False 的回測 (例如參數掃描) 不需負擔字串格式化與重新估值
+"""
+import numpy as np
+import pandas as pd
+
+BUY, SELL = 0, 1
+ACTIONS = ('BUY', 'SELL')
+
+TRADE_DTYPE = np.dtype([
+    ('date', 'datetime64[ns]'),
+    ('ticker', np.int32),
+    ('action', np.int8),
+    ('reason', np.int32),
+    ('price', np.float64),
+    ('qty', np.int64),
+    ('cost', np.float64),           # BUY: 含手續費成本
+    ('revenue', np.float64),        # SELL: 扣手續費收入
+    ('pnl', np.float64),
+    ('pnl_pct', np.float64),
+    ('weight_before', np.float64),
+    ('weight_after', np.float64),
+    ('target_weight', np.float64),  # NaN = 無目標權重
+    ('total_equity', np.float64),   # 交易後總權益
+    ('cash', np.float64),           # 交易後現金
+])
+
+
+def format_holdings(holdings, price_of, cash, total_equity):
+    """
+    持倉快照字串 (格式: AAPL:25.0%, MSFT:30.0%, CASH:45.0%)
+    holdings: {ticker: qty}；price_of(ticker) 回傳估值價格
+    """
+    if total_equity <= 0:
+        return "CASH:100%"
+
+    holdings_parts = []
+    for ticker, qty in sorted(holdings.items()):
+        if qty <= 0:
+            continue
+        value = price_of(ticker) * qty
+        weight = (value / total_equity * 100)
+        holdings_parts.append(f"{ticker}:{weight:.1f}%")
+
+    # 添加現金比例
+    cash_weight = (cash / total_equity * 100) if total_equity > 0 else 100
+    if cash_weight > 0.1:  # 只顯示 > 0.1% 的現金
+        holdings_parts.append(f"CASH:{cash_weight:.1f}%")
+
+    return ", ".join(holdings_parts) if holdings_parts else "CASH:100%"
+
+
+class TradeLedger:
+    INITIAL_CAPACITY = 1024
+
+    def __init__(self, capacity=None):
+        self._data = np.zeros(capacity or self.INITIAL_CAPACITY, dtype=TRADE_DTYPE)
+        self._size = 0
+        self.tickers = []      # id → ticker
+        self._ticker_ids = {}  # ticker → id
+        self.reasons = []
+        self._reason_ids = {}
+
+    def __len__(self):
+        return self._size
+
+    def __bool__(self):
+        return self._size > 0
+
+    @property
+    def data(self):
+        """已記錄的交易 (structured array view)"""
+        return self._data[:self._size]
+
+    @staticmethod
+    def _intern(value, values, ids):
+        i = ids.get(value)
+        if i is None:
+            i = ids[value] = len(values)
+            values.append(value)
+        return i
+
+    def append(self, date, ticker, action, price, qty, reason, total_equity, cash,
+               weight_before=0.0, weight_after=0.0, target_weight=None,
+               cost=np.nan, revenue=np.nan, pnl=np.nan, pnl_pct=np.nan):
+        if self._size == len(self._data):
+            grown = np.zeros(2 * len(self._data), dtype=TRADE_DTYPE)
+            grown[:self._size] = self._data
+            self._data = grown
+        self._data[self._size] = (
+            np.datetime64(date, 'ns'),
+            self._intern(ticker, self.tickers, self._ticker_ids),
+            action,
+            self._intern(reason, self.reasons, self._reason_ids),
+            price, qty, cost, revenue, pnl, pnl_pct,
+            weight_before, weight_after,
+            np.nan if target_weight is None else target_weight,
+            total_equity, cash,
+        )
+        self._size += 1
+
+    def holdings_snapshots(self, price_fn):
+        """
+        依序重播交易，重建每筆交易後的持倉快照字串
+        price_fn(ticker, date) 回傳 date 的收盤估值價 (與回測當時的估值相同)
+        """
+        data = self.data
+        dates = pd.DatetimeIndex(data['date'])
+        holdings = {}
+        snapshots = []
+        for k, (ticker_id, action, qty) in enumerate(zip(data['ticker'].tolist(), data['action'].tolist(),
+                                                         data['qty'].tolist())):
+            ticker = self.tickers[ticker_id]
+            if action == BUY:
+                holdings[ticker] = holdings.get(ticker, 0) + qty
+            elif ticker in holdings:
+                holdings[ticker] -= qty
+                if holdings[ticker] <= 0:
+                    del holdings[ticker]
+            date = dates[k]
+            snapshots.append(format_holdings(holdings, lambda t: price_fn(t, date),
+                                             float(data['cash'][k]), float(data['total_equity'][k])))
+        return snapshots
+
+    def to_records(self, price_fn=None):
+        """
+        list-of-dicts 格式 (與舊版 trades 欄位相同)
+        給 price_fn 時附上 Holdings_After 快照
+        """
+        data = self.data
+        dates = pd.DatetimeIndex(data['date'])
+        cols = {name: data[name].tolist() for name in TRADE_DTYPE.names if name != 'date'}
+        snapshots = self.holdings_snapshots(price_fn) if price_fn is not None else None
+        records = []
+        for k in range(self._size):
+            is_buy = cols['action'][k] == BUY
+            target = cols['target_weight'][k]
+            record = {
+                'Date': dates[k],
+                'Ticker': self.tickers[cols['ticker'][k]],
+                'Action': ACTIONS[cols['action'][k]],
+                'Price': cols['price'][k],
+                'Quantity': cols['qty'][k],
+                'Cost': cols['cost'][k] if is_buy else '',
+                'Reason': self.reasons[cols['reason'][k]],
+                'Revenue': '' if is_buy else cols['revenue'][k],
+                'PnL': '' if is_buy else cols['pnl'][k],
+                'PnL_Pct': '' if is_buy else cols['pnl_pct'][k],
+                'Weight_Before': cols['weight_before'][k],
+                'Weight_After': cols['weight_after'][k],
+                'Target_Weight': None if np.isnan(target) else target,  # V3: ATR 目標權重 (只在再平衡時有值)
+                'Total_Equity': cols['total_equity'][k],
+            }
+            if snapshots is not None:
+                record['Holdings_After'] = snapshots[k]  # 交易後完整持倉
+            records.append(record)
+        return records
+
+    def to_frame(self, price_fn=None):
+        """報表用 DataFrame (backtest_trades*.csv)"""
+        return pd.DataFrame(self.to_records(price_fn))
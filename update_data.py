@@ -2,10 +2,20 @@
 Update All Data
 Standalone script to fetch latest data from Yahoo Finance for all stocks
 Handles both .csv and .txt formats
+
+並行模式 (預設): 依起始日分組批次下載，執行緒池 + 速率限制 + 重試退避
+下載來源透過 Downloader 介面注入 (預設 YahooDownloader)，可替換為測試用的假下載器
 """
+import abc
+import io
+import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 from datetime import datetime, timedelta
+import utils
 
 # Use the base config to get DATA_DIR
 try:
@@ -19,8 +29,166 @@ try:
     YF_AVAILABLE = True
 except ImportError:
     YF_AVAILABLE = False
-    print("ERROR: yfinance not installed. Run: pip install yfinance")
-    exit(1)
+
+STANDARD_COLS = ['Date', 'Open', 'High', 'Low', 'Close', 'Adj Close', 'Volume']
+DEFAULT_START_DATE = "2015-01-01"
+MANIFEST_FILE = '_manifest.json'
+
+
+# ======================================
+# 資料檔索引 (data/_manifest.json)
+# ======================================
+class DataManifest:
+    """
+    檔名 → {last_date, rows, size, mtime_ns}
+    size / mtime 與檔案相符時直接使用 last_date，不必讀取檔案；
+    由 updater 寫檔時更新 (rows 未知時為 None)
+    """
+    def __init__(self, data_dir):
+        self.path = os.path.join(data_dir, MANIFEST_FILE)
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except Exception:
+                self.entries = {}
+
+    def lookup(self, filepath):
+        """檔案未變動時回傳索引項目，否則回傳 None"""
+        entry = self.entries.get(os.path.basename(filepath))
+        if entry is None:
+            return None
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return None
+        if entry.get('size') != st.st_size or entry.get('mtime_ns') != st.st_mtime_ns:
+            return None
+        return entry
+
+    def record(self, filepath, last_date, rows=None):
+        st = os.stat(filepath)
+        with self._lock:
+            self.entries[os.path.basename(filepath)] = {
+                'last_date': pd.Timestamp(last_date).strftime('%Y-%m-%d'),
+                'rows': None if rows is None else int(rows),
+                'size': st.st_size,
+                'mtime_ns': st.st_mtime_ns,
+            }
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            try:
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(self.entries, f, indent=1, sort_keys=True)
+                os.replace(tmp_path, self.path)
+                self._dirty = False
+            except Exception as e:
+                print(f"Warning: could not write {self.path}: {e}")
+
+
+_manifests = {}  # {data_dir: DataManifest}
+_manifests_lock = threading.Lock()
+
+def get_manifest(filepath):
+    """取得檔案所在資料夾的 DataManifest (每個資料夾只載入一次)"""
+    data_dir = os.path.dirname(os.path.abspath(filepath))
+    with _manifests_lock:
+        if data_dir not in _manifests:
+            _manifests[data_dir] = DataManifest(data_dir)
+        return _manifests[data_dir]
+
+def save_manifests():
+    for manifest in list(_manifests.values()):
+        manifest.save()
+
+
+# ======================================
+# 下載介面
+# ======================================
+class Downloader(abc.ABC):
+    """
+    下載介面: fetch(tickers, start, end) → {ticker: DataFrame}
+    DataFrame 為 Date index (或欄位) + Open/High/Low/Close/Adj Close/Volume，
+    沒有新資料的 ticker 可省略或回傳空 DataFrame；失敗時丟出例外 (由呼叫端重試)
+    """
+    batch_size = 1  # 單次請求最多幾檔
+
+    @abc.abstractmethod
+    def fetch(self, tickers, start, end):
+        """下載 tickers 在 [start, end) 的日線資料"""
+
+
+class YahooDownloader(Downloader):
+    """Yahoo Finance 下載器 (多檔時使用 yf.download 批次請求)"""
+    batch_size = 50
+
+    def __init__(self, batch_size=None):
+        if not YF_AVAILABLE:
+            raise ImportError("yfinance not installed. Run: pip install yfinance")
+        if batch_size:
+            self.batch_size = batch_size
+
+    def fetch(self, tickers, start, end):
+        if len(tickers) == 1:
+            ticker = tickers[0]
+            return {ticker: yf.Ticker(ticker).history(start=start, end=end, auto_adjust=False)}
+
+        raw = yf.download(list(tickers), start=start, end=end, auto_adjust=False,
+                          group_by='ticker', threads=False, progress=False)
+        result = {}
+        if raw is None or raw.empty:
+            return result
+        for ticker in tickers:
+            if isinstance(raw.columns, pd.MultiIndex):
+                if ticker not in raw.columns.get_level_values(0):
+                    continue
+                df = raw[ticker]
+            else:
+                df = raw
+            result[ticker] = df.dropna(how='all')
+        return result
+
+
+class RateLimiter:
+    """所有執行緒共用的請求速率限制 (每秒最多 rate 次)"""
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._lock = threading.Lock()
+        self._next_time = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+def standardize_history(df):
+    """下載結果 → Date 欄位 (無時區) + 標準欄位"""
+    if df is None or df.empty:
+        return None
+    df = df.reset_index()
+    if 'Date' not in df.columns:
+        df = df.rename(columns={df.columns[0]: 'Date'})
+    df['Date'] = pd.to_datetime(df['Date'])
+    if df['Date'].dt.tz is not None:
+        df['Date'] = df['Date'].dt.tz_localize(None)
+    df = df[[c for c in STANDARD_COLS if c in df.columns]]
+    if 'Close' in df.columns:
+        df = df.dropna(subset=['Close'])
+    return df if not df.empty else None
 
 def load_existing_data(filepath):
     """Load existing data file, handling both .csv and .txt formats"""
@@ -61,92 +229,303 @@ def load_existing_data(filepath):
         return None
 
 def get_last_date(filepath):
-    """Get last date in file"""
-    df = load_existing_data(filepath)
-    if df is not None and 'Date' in df.columns:
-        return df['Date'].max()
-    return None
+    """
+    Get last date in file
+    依序使用: manifest (檔案未變動) → 只讀檔尾最後一行 → 完整解析
+    """
+    if not os.path.exists(filepath):
+        return None
+    manifest = get_manifest(filepath)
+    entry = manifest.lookup(filepath)
+    if entry is not None:
+        return pd.Timestamp(entry['last_date'])
+    
+    rows = None
+    info = read_tail_info(filepath)
+    if info is not None:
+        last_date = info['last_date']
+    else:
+        df = load_existing_data(filepath)
+        if df is None or 'Date' not in df.columns or df.empty:
+            return None
+        last_date = df['Date'].max()
+        rows = len(df)
+    manifest.record(filepath, last_date, rows)
+    return last_date
 
-def save_data(df, filepath):
-    """Save data in appropriate format"""
+def format_output(df, filepath):
+    """將標準欄位的 DataFrame 轉為檔案格式 (.txt 為 ticker,date,o,h,l,c,adj_c,vol)"""
     ext = os.path.splitext(filepath)[1].lower()
     
     if ext == '.txt':
         # Convert to .txt format
         ticker = os.path.splitext(os.path.basename(filepath))[0]
-        out_df = pd.DataFrame()
-        out_df['ticker'] = ticker
-        out_df['date'] = df['Date'].dt.strftime('%Y/%m/%d')
+        out_df = pd.DataFrame({'date': df['Date'].dt.strftime('%Y/%m/%d')})
+        out_df.insert(0, 'ticker', ticker)
         out_df['o'] = df['Open']
         out_df['h'] = df['High']
         out_df['l'] = df['Low']
         out_df['c'] = df['Close']
         out_df['adj_c'] = df.get('Adj Close', df['Close'])
         out_df['vol'] = df['Volume'].astype(int)
-        out_df.to_csv(filepath, index=False)
-    else:
-        # Standard CSV format
-        standard_cols = ['Date', 'Open', 'High', 'Low', 'Close', 'Adj Close', 'Volume']
-        out_cols = [c for c in standard_cols if c in df.columns]
-        df[out_cols].to_csv(filepath, index=False)
+        return out_df
+    
+    # Standard CSV format
+    out_cols = [c for c in STANDARD_COLS if c in df.columns]
+    return df[out_cols]
 
-def update_ticker(ticker, filepath):
-    """Update a single ticker from Yahoo Finance"""
+def save_data(df, filepath):
+    """Save data in appropriate format"""
+    out_df = format_output(df, filepath)
+    text = out_df.to_csv(index=False)
+    with open(filepath, 'w', newline='') as f:
+        f.write(text)
+    if not df.empty:
+        get_manifest(filepath).record(filepath, df['Date'].max(), len(out_df))
+
+    # Keep the binary store in sync with what was just written
+    # (解析寫出的文字，與 load_data 讀取原始檔的結果逐位元相同)
+    store_df = utils.normalize_price_frame(pd.read_csv(io.StringIO(text)))
+    if store_df is not None:
+        utils.write_store(store_df, filepath)
+
+def read_tail_info(filepath, block_size=4096):
+    """
+    只讀取檔頭與檔尾 (不解析整個檔案)
+    回傳 {'columns', 'last_date', 'ends_with_newline'}，
+    無資料列或最後一行無法解析 (可能損毀) 時回傳 None
+    """
+    try:
+        size = os.path.getsize(filepath)
+        with open(filepath, 'rb') as f:
+            header = f.readline().decode('utf-8').strip()
+            f.seek(max(0, size - block_size))
+            tail = f.read()
+        
+        columns = [c.strip() for c in header.split(',')]
+        date_idx = [c.lower() for c in columns].index('date')
+        lines = [line for line in tail.decode('utf-8', errors='replace').splitlines() if line.strip()]
+        if not lines or lines[-1].strip() == header:
+            return None
+        
+        fields = lines[-1].split(',')
+        if len(fields) != len(columns):
+            return None
+        return {
+            'columns': columns,
+            'last_date': pd.to_datetime(fields[date_idx].strip()),
+            'ends_with_newline': tail.endswith(b'\n'),
+        }
+    except Exception:
+        return None
+
+def append_data(df, filepath, tail_info):
+    """
+    將新資料 (日期皆晚於檔案最後一日) 以原格式附加到檔尾，並同步 NPZ 快取
+    欄位與既有檔頭不符時回傳 False (由呼叫端改為完整重寫)
+    """
+    out_df = format_output(df, filepath)
+    if list(out_df.columns) != tail_info['columns']:
+        return False
+    
+    text = out_df.to_csv(index=False, header=False)
+    prev_stat = os.stat(filepath)
+    manifest = get_manifest(filepath)
+    prev_entry = manifest.lookup(filepath)
+    with open(filepath, 'a', newline='') as f:
+        if not tail_info['ends_with_newline']:
+            f.write(os.linesep)
+        f.write(text)
+    prev_rows = prev_entry.get('rows') if prev_entry else None
+    manifest.record(filepath, df['Date'].iloc[-1],
+                    None if prev_rows is None else prev_rows + len(out_df))
+    
+    # 以與 load_data 相同的解析方式處理新增的列，接到既有快取之後
+    new_rows = pd.read_csv(io.StringIO(text), header=None, names=tail_info['columns'])
+    utils.append_store(utils.normalize_price_frame(new_rows), filepath, prev_stat)
+    return True
+
+def _is_up_to_date(last_date):
+    return last_date.date() >= (datetime.now() - timedelta(days=1)).date()
+
+
+def plan_update(ticker, filepath):
+    """
+    決定下載起始日
+    回傳 'skip' (已是最新)、None (既有檔案無法讀取) 或起始日字串
+    """
     last_date = get_last_date(filepath)
     
     if last_date is None:
         if os.path.exists(filepath):
             print(f"  {ticker}: Could not read existing file")
+            return None
+        return DEFAULT_START_DATE
+    
+    # Check if already up to date
+    if _is_up_to_date(last_date):
+        return 'skip'
+    return (last_date + timedelta(days=1)).strftime('%Y-%m-%d')
+
+
+def merge_and_save(ticker, filepath, new_data):
+    """將新資料 (standardize_history 結果) 合併進既有檔案"""
+    if new_data is None:
+        return True  # No new data, but not an error
+    
+    if os.path.exists(filepath):
+        # [OPTIMIZATION] 新資料全部晚於檔案最後一日 → 只附加新列 (I/O 與歷史長度無關)
+        new_data = new_data.drop_duplicates(subset=['Date'], keep='last').sort_values('Date')
+        tail_info = read_tail_info(filepath)
+        if tail_info is not None and new_data['Date'].iloc[0] > tail_info['last_date']:
+            if append_data(new_data, filepath, tail_info):
+                print(f"  {ticker}: +{len(new_data)} rows (appended, last: {new_data['Date'].iloc[-1].date()})")
+                return True
+        
+        # 日期重疊或檔案損毀 → 完整讀取、合併後重寫
+        existing_df = load_existing_data(filepath)
+        if existing_df is None:
             return False
-        start_date = "2015-01-01"
-        print(f"  {ticker}: No existing data, fetching from {start_date}...")
+        combined = pd.concat([existing_df, new_data], ignore_index=True)
+        combined = combined.drop_duplicates(subset=['Date'], keep='last')
+        combined = combined.sort_values('Date')
+        save_data(combined, filepath)
+        print(f"  {ticker}: +{len(new_data)} rows (total: {len(combined)})")
     else:
-        # Check if already up to date
-        if last_date.date() >= (datetime.now() - timedelta(days=1)).date():
-            # Already up to date, skip
-            return True
-        start_date = (last_date + timedelta(days=1)).strftime('%Y-%m-%d')
+        save_data(new_data, filepath)
+        print(f"  {ticker}: Created with {len(new_data)} rows")
+    return True
+
+
+def _report_error(ticker, e):
+    error_msg = str(e)
+    if "404" not in error_msg and "delisted" not in error_msg:
+        print(f"  {ticker}: ERROR - {error_msg[:50]}")
+
+
+def update_ticker(ticker, filepath, downloader=None):
+    """Update a single ticker from Yahoo Finance"""
+    start_date = plan_update(ticker, filepath)
+    if start_date is None:
+        return False
+    if start_date == 'skip':
+        return True
+    if start_date == DEFAULT_START_DATE and not os.path.exists(filepath):
+        print(f"  {ticker}: No existing data, fetching from {start_date}...")
     
     end_date = datetime.now().strftime('%Y-%m-%d')
     
     try:
-        stock = yf.Ticker(ticker)
-        new_data = stock.history(start=start_date, end=end_date, auto_adjust=False)
-        
-        if new_data.empty:
-            return True  # No new data, but not an error
-        
-        # Process new data
-        new_data = new_data.reset_index()
-        new_data['Date'] = pd.to_datetime(new_data['Date']).dt.tz_localize(None)
-        
-        # Keep standard columns
-        standard_cols = ['Date', 'Open', 'High', 'Low', 'Close', 'Adj Close', 'Volume']
-        new_data = new_data[[c for c in standard_cols if c in new_data.columns]]
-        
-        if os.path.exists(filepath):
-            existing_df = load_existing_data(filepath)
-            if existing_df is not None:
-                combined = pd.concat([existing_df, new_data], ignore_index=True)
-                combined = combined.drop_duplicates(subset=['Date'], keep='last')
-                combined = combined.sort_values('Date')
-                save_data(combined, filepath)
-                print(f"  {ticker}: +{len(new_data)} rows (total: {len(combined)})")
-            else:
-                return False
-        else:
-            save_data(new_data, filepath)
-            print(f"  {ticker}: Created with {len(new_data)} rows")
-        
-        return True
-        
+        downloader = downloader or YahooDownloader()
+        new_data = downloader.fetch([ticker], start_date, end_date).get(ticker)
+        return merge_and_save(ticker, filepath, standardize_history(new_data))
     except Exception as e:
-        error_msg = str(e)
-        if "404" not in error_msg and "delisted" not in error_msg:
-            print(f"  {ticker}: ERROR - {error_msg[:50]}")
+        _report_error(ticker, e)
         return False
 
-def main():
+
+def _fetch_with_retry(downloader, tickers, start, end, limiter, retries, backoff):
+    """批次下載，失敗時指數退避重試，仍失敗則丟出最後一次的例外"""
+    for attempt in range(retries + 1):
+        limiter.wait()
+        try:
+            return downloader.fetch(tickers, start, end)
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * (2 ** attempt))
+
+
+def update_tickers_concurrent(items, downloader=None, max_workers=8, rate_limit=4.0,
+                              retries=3, backoff=1.0, progress_callback=None):
+    """
+    並行更新多檔股票
+    items: [(ticker, filepath)]
+    downloader: Downloader 實作 (預設 YahooDownloader)
+    rate_limit: 每秒最多請求數 (所有執行緒合計)
+    progress_callback: 選用，callback(done, total, ticker, status)，status 為 updated/skipped/failed
+                       (沒有取得任何新資料的 ticker 為 skipped，例如下市或代碼錯誤時批次結果為全 NaN)
+    回傳 {'updated': n, 'skipped': n, 'failed': n, 'failed_tickers': [...]}
+    """
+    downloader = downloader or YahooDownloader()
+    limiter = RateLimiter(rate_limit)
+    end_date = datetime.now().strftime('%Y-%m-%d')
+    
+    summary = {'updated': 0, 'skipped': 0, 'failed': 0, 'failed_tickers': []}
+    total = len(items)
+    done = [0]
+    lock = threading.Lock()
+    
+    def record(ticker, status):
+        with lock:
+            summary[status] += 1
+            if status == 'failed':
+                summary['failed_tickers'].append(ticker)
+            done[0] += 1
+            n_done = done[0]
+        if progress_callback:
+            progress_callback(n_done, total, ticker, status)
+    
+    # 1. 依起始日分組 (同一批次請求需相同起始日)
+    groups = {}
+    paths = {}
+    for ticker, filepath in items:
+        start_date = plan_update(ticker, filepath)
+        if start_date is None:
+            record(ticker, 'failed')
+        elif start_date == 'skip':
+            record(ticker, 'skipped')
+        else:
+            groups.setdefault(start_date, []).append(ticker)
+            paths[ticker] = filepath
+    
+    batch_size = max(1, getattr(downloader, 'batch_size', 1))
+    batches = [(start, tickers[i:i + batch_size])
+               for start, tickers in groups.items()
+               for i in range(0, len(tickers), batch_size)]
+    
+    def run_batch(start_date, tickers):
+        try:
+            fetched = _fetch_with_retry(downloader, tickers, start_date, end_date,
+                                        limiter, retries, backoff)
+        except Exception as e:
+            for ticker in tickers:
+                _report_error(ticker, e)
+                record(ticker, 'failed')
+            return
+        for ticker in tickers:
+            try:
+                new_data = standardize_history(fetched.get(ticker))
+                if new_data is None:
+                    # 沒有新資料 (yf.download 對下市/未知代碼回傳全 NaN 欄位，dropna 後為空)
+                    record(ticker, 'skipped')
+                    continue
+                ok = merge_and_save(ticker, paths[ticker], new_data)
+            except Exception as e:
+                _report_error(ticker, e)
+                ok = False
+            record(ticker, 'updated' if ok else 'failed')
+    
+    # 2. 執行緒池下載 (不同 ticker 寫入不同檔案，可安全並行)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        futures = [pool.submit(run_batch, start, tickers) for start, tickers in batches]
+        for future in as_completed(futures):
+            future.result()
+    
+    return summary
+
+def main(concurrent=True, downloader=None, max_workers=8, progress_callback=None):
+    """
+    concurrent: 使用並行批次下載 (False 為逐檔下載)
+    downloader: Downloader 實作 (預設 YahooDownloader)
+    progress_callback: 個股更新進度 callback(done, total, ticker, status)
+    """
+    if downloader is None:
+        if not YF_AVAILABLE:
+            print("ERROR: yfinance not installed. Run: pip install yfinance")
+            raise ImportError("yfinance not installed")
+        downloader = YahooDownloader()
+    
     print("\n" + "="*60)
     print("DATA UPDATER - Fetch Latest from Yahoo Finance")
     print("="*60)
@@ -157,10 +536,10 @@ def main():
     for ticker in ['SPY', 'SSO', 'QQQ']:
         filepath = os.path.join(DATA_DIR, f'{ticker}.csv')
         last = get_last_date(filepath)
-        if last and last.date() >= (datetime.now() - timedelta(days=1)).date():
+        if last and _is_up_to_date(last):
             print(f"  {ticker}: Already up to date ({last.date()})")
         else:
-            update_ticker(ticker, filepath)
+            update_ticker(ticker, filepath, downloader)
     
     # 2. Update all .txt stock files
     print("\n[2/3] Updating individual stocks (.txt files)...")
@@ -172,20 +551,32 @@ def main():
         skipped = 0
         failed = 0
         
-        for i, filename in enumerate(txt_files):
-            ticker = filename.replace('.txt', '')
-            filepath = os.path.join(DATA_DIR, filename)
+        if concurrent:
+            items = [(f.replace('.txt', ''), os.path.join(DATA_DIR, f)) for f in txt_files]
+            summary = update_tickers_concurrent(items, downloader, max_workers=max_workers,
+                                                progress_callback=progress_callback)
+            updated, skipped, failed = summary['updated'], summary['skipped'], summary['failed']
+        else:
+            for i, filename in enumerate(txt_files):
+                ticker = filename.replace('.txt', '')
+                filepath = os.path.join(DATA_DIR, filename)
             
-            last = get_last_date(filepath)
-            if last and last.date() >= (datetime.now() - timedelta(days=1)).date():
-                skipped += 1
-                continue
+                last = get_last_date(filepath)
+                if last and _is_up_to_date(last):
+                    skipped += 1
+                    if progress_callback:
+                        progress_callback(i + 1, total, ticker, 'skipped')
+                    continue
             
-            print(f"  [{i+1}/{total}] {ticker}: Fetching...")
-            if update_ticker(ticker, filepath):
-                updated += 1
-            else:
-                failed += 1
+                print(f"  [{i+1}/{total}] {ticker}: Fetching...")
+                if update_ticker(ticker, filepath, downloader):
+                    updated += 1
+                    status = 'updated'
+                else:
+                    failed += 1
+                    status = 'failed'
+                if progress_callback:
+                    progress_callback(i + 1, total, ticker, status)
         
         print(f"\n  Summary: {updated} updated, {skipped} skipped (up-to-date), {failed} failed")
     
@@ -200,6 +591,9 @@ def main():
         aapl_last = get_last_date(sample_txt)
         print(f"  AAPL last date: {aapl_last.date() if aapl_last else 'N/A'}")
     
+    # 保存資料檔索引 (下次執行可直接判斷是否需要更新)
+    save_manifests()
+    
     print("\n" + "="*60)
     print("UPDATE COMPLETE!")
     print("="*60)
@@ -207,4 +601,7 @@ def main():
     print("  python run_strategy_final.py")
 
 if __name__ == "__main__":
+    if not YF_AVAILABLE:
+        print("ERROR: yfinance not installed. Run: pip install yfinance")
+        exit(1)
     main()
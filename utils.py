@@ -2,7 +2,85 @@ import pandas as pd
 import numpy as np
 import os
 
-def load_data(file_path):
+# 二進位價格快取 (Packed Store)
+# 每個原始檔對應一個 NPZ，存放已正規化的 OHLCV 與已解析的日期，
+# 並記錄原始檔的 size / mtime，原始檔變動後自動失效
+STORE_DIR_NAME = '_store'
+
+
+def get_store_path(file_path):
+    """原始資料檔對應的 NPZ 快取路徑 (data/_store/AAPL.txt.npz)"""
+    directory, name = os.path.split(file_path)
+    return os.path.join(directory, STORE_DIR_NAME, name + '.npz')
+
+
+def write_store(df, file_path, src_stat=None):
+    """
+    將已正規化的 DataFrame 寫入 NPZ 快取
+    src_stat: 原始檔的 os.stat 結果 (None 則即時讀取)
+    """
+    try:
+        if src_stat is None:
+            src_stat = os.stat(file_path)
+        store_path = get_store_path(file_path)
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+
+        arrays = {
+            'dates': df.index.values,
+            'columns': np.array([str(c) for c in df.columns]),
+            'src_stat': np.array([src_stat.st_size, src_stat.st_mtime_ns], dtype=np.int64),
+        }
+        for i, col in enumerate(df.columns):
+            arrays[f'c{i}'] = df[col].values
+
+        # 先寫暫存檔再替換，避免中斷時留下損毀的快取
+        tmp_path = store_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, store_path)
+    except Exception as e:
+        print(f"Warning: could not write store for {file_path}: {e}")
+
+
+def append_store(new_rows, file_path, prev_stat):
+    """
+    原始檔尾端附加資料後同步 NPZ 快取
+    prev_stat: 附加前原始檔的 os.stat；舊快取與其不符 (已過期) 或欄位型別不一致時略過，
+    下次 load_data 會自動重建
+    """
+    if new_rows is None:
+        return
+    old = read_store(file_path, prev_stat)
+    if old is None or list(old.columns) != list(new_rows.columns):
+        return
+    if any(old[c].dtype != new_rows[c].dtype for c in old.columns):
+        return
+    write_store(pd.concat([old, new_rows]), file_path)
+
+
+def read_store(file_path, src_stat=None):
+    """
+    讀取 NPZ 快取，若不存在或已過期 (原始檔 size/mtime 不符) 回傳 None
+    """
+    store_path = get_store_path(file_path)
+    if not os.path.exists(store_path):
+        return None
+    try:
+        if src_stat is None:
+            src_stat = os.stat(file_path)
+        with np.load(store_path, allow_pickle=False) as npz:
+            size, mtime_ns = npz['src_stat']
+            if size != src_stat.st_size or mtime_ns != src_stat.st_mtime_ns:
+                return None
+            columns = [str(c) for c in npz['columns']]
+            data = {col: npz[f'c{i}'] for i, col in enumerate(columns)}
+            index = pd.DatetimeIndex(npz['dates'], name='Date')
+        return pd.DataFrame(data, index=index, columns=columns)
+    except Exception:
+        return None
+
+
+def load_data(file_path, use_store=True):
     """
     通用資料讀取函數
     支援:
@@ -10,10 +88,17 @@ def load_data(file_path):
     2. CSV without header (names provided)
     3. Ticker column removal
     4. Mapping 'o', 'c' etc to 'Open', 'Close'
+    5. NPZ 二進位快取 (use_store=True 時優先讀取，失效則解析原始檔並回寫)
     """
     if not os.path.exists(file_path):
         print(f"File not found: {file_path}")
         return None
+
+    src_stat = os.stat(file_path)
+    if use_store:
+        df = read_store(file_path, src_stat)
+        if df is not None:
+            return df
         
     try:
         # 預讀前幾行判斷格式
@@ -28,59 +113,97 @@ def load_data(file_path):
         else:
             # 假設無 header，且格式為 Ticker, Date, Open, High, Low, Close, Volume
             df = pd.read_csv(file_path, header=None, names=['Ticker', 'Date', 'Open', 'High', 'Low', 'Close', 'Volume'])
-            
-        # 標準化欄位名稱
-        # 移除前後空白
-        df.rename(columns=lambda x: x.strip(), inplace=True)
-        
-        # 確保欄位名稱符合 backtesting 要求 (首字母大寫)
-        rename_map = {
-            'open': 'Open', 'high': 'High', 'low': 'Low', 'close': 'Close', 'volume': 'Volume',
-            'Open': 'Open', 'High': 'High', 'Low': 'Low', 'Close': 'Close', 'Volume': 'Volume',
-            'o': 'Open', 'h': 'High', 'l': 'Low', 'c': 'Close', 'vol': 'Volume', 'adj_c': 'Adj Close'
-        }
-        df.rename(columns=rename_map, inplace=True)
-        
-        # 移除不需要的 Ticker 欄位 (如果有)
-        if 'Ticker' in df.columns:
-            df.drop(columns=['Ticker'], inplace=True)
-        if 'ticker' in df.columns:
-            df.drop(columns=['ticker'], inplace=True)
-
-        # 簡單檢查必要欄位
-        required = ['Open', 'High', 'Low', 'Close']
-        if not all(col in df.columns for col in required):
-            raise ValueError(f"Missing required columns: {set(required) - set(df.columns)}")
-            
-        # 日期處理
-        if 'Date' in df.columns:
-            df['Date'] = pd.to_datetime(df['Date'])
-            df.set_index('Date', inplace=True)
-        elif 'date' in df.columns:
-            df['date'] = pd.to_datetime(df['date'])
-            df.set_index('date', inplace=True)
-            df.index.name = 'Date'
-        else:
-            # 嘗試使用 index
-            try:
-                df.index = pd.to_datetime(df.index)
-                df.index.name = 'Date'
-            except:
-                pass
-                
-        # 排序
-        df.sort_index(inplace=True)
-        
-        # 檢查是否為空
-        if df.empty:
+
+        df = normalize_price_frame(df)
+        if df is None:
             return None
-            
-        return df.dropna()
+
+        if use_store:
+            write_store(df, file_path, src_stat)
+        return df
         
     except Exception as e:
         print(f"Error loading {file_path}: {e}")
         return None
 
+def normalize_price_frame(df):
+    """
+    將原始讀入的 DataFrame 標準化為 Open/High/Low/Close/(Adj Close)/Volume + DatetimeIndex
+    (load_data 與 update_data.save_data 共用，確保快取與原始檔內容一致)
+    """
+    # 標準化欄位名稱
+    # 移除前後空白
+    df.rename(columns=lambda x: x.strip(), inplace=True)
+    
+    # 確保欄位名稱符合 backtesting 要求 (首字母大寫)
+    rename_map = {
+        'open': 'Open', 'high': 'High', 'low': 'Low', 'close': 'Close', 'volume': 'Volume',
+        'Open': 'Open', 'High': 'High', 'Low': 'Low', 'Close': 'Close', 'Volume': 'Volume',
+        'o': 'Open', 'h': 'High', 'l': 'Low', 'c': 'Close', 'vol': 'Volume', 'adj_c': 'Adj Close'
+    }
+    df.rename(columns=rename_map, inplace=True)
+    
+    # 移除不需要的 Ticker 欄位 (如果有)
+    if 'Ticker' in df.columns:
+        df.drop(columns=['Ticker'], inplace=True)
+    if 'ticker' in df.columns:
+        df.drop(columns=['ticker'], inplace=True)
+
+    # 簡單檢查必要欄位
+    required = ['Open', 'High', 'Low', 'Close']
+    if not all(col in df.columns for col in required):
+        raise ValueError(f"Missing required columns: {set(required) - set(df.columns)}")
+        
+    # 日期處理
+    if 'Date' in df.columns:
+        df['Date'] = pd.to_datetime(df['Date'])
+        df.set_index('Date', inplace=True)
+    elif 'date' in df.columns:
+        df['date'] = pd.to_datetime(df['date'])
+        df.set_index('date', inplace=True)
+        df.index.name = 'Date'
+    else:
+        # 嘗試使用 index
+        try:
+            df.index = pd.to_datetime(df.index)
+            df.index.name = 'Date'
+        except:
+            pass
+            
+    # 排序
+    df.sort_index(inplace=True)
+    
+    # 檢查是否為空
+    if df.empty:
+        return None
+        
+    return df.dropna()
+
+# compact 模式保留的價格欄位
+PRICE_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Adj Close']
+
+
+def compact_price_frame(df, calendar=None):
+    """
+    [OPTIMIZATION] 精簡記憶體的價格 DataFrame (SelectionEngine compact 模式)
+    - 只保留價格欄位並轉為 float32 (不保留 Volume)
+    - Adj Close 與 Close 完全相同時移除 (各處在沒有 Adj Close 時皆退回使用 Close)
+    - 日期與 calendar 的某個連續區段相同時，index 改用 calendar 的切片 (共用同一塊記憶體)
+    """
+    cols = [c for c in PRICE_COLUMNS if c in df.columns]
+    if 'Adj Close' in cols and np.array_equal(df['Adj Close'].values, df['Close'].values, equal_nan=True):
+        cols.remove('Adj Close')
+
+    index = df.index
+    if calendar is not None and len(index) and len(index) <= len(calendar):
+        start = int(calendar.searchsorted(index[0]))
+        end = start + len(index)
+        if end <= len(calendar) and np.array_equal(calendar.values[start:end], index.values):
+            index = calendar[start:end]
+
+    return pd.DataFrame({c: df[c].values.astype(np.float32) for c in cols}, index=index)
+
+
 def load_benchmark_data(file_path):
     """
     專門讀取 Benchmark (SPY, SSO) 資料，只需要 Date 和 Close
@@ -0,0 +1,180 @@
+"""
+Walk-Forward Optimization
+滾動的訓練 / 測試視窗: 每個訓練視窗做參數搜尋 (選出 metric 最佳的一組)，
+再以該組參數跑緊接其後的測試視窗 (樣本外)；所有視窗的回測以 param_sweep 的 process pool 平行執行，
+共用同一份預載的 SelectionEngine
+輸出: 串接的樣本外權益曲線 + 每個視窗選用參數與績效的表格
+
+用法:
+    space = {'LOOKBACK': [60, 90, 120], 'EXIT_EMA': [40, 50]}
+    equity, windows = walk_forward(grid(space), start_date='2020-01-01', train_months=24, test_months=6)
+"""
+import pandas as pd
+
+import config_final as config
+from param_sweep import grid, performance_metrics, run_jobs, shared_context
+from strategy_params import StrategyParams
+
+
+def make_windows(start_date, end_date, train_months=24, test_months=6, step_months=None, calendar=None):
+    """
+    滾動視窗: [(train_start, train_end, test_start, test_end), ...]
+    第一個測試視窗從 start_date + train_months 開始，之後每次前進 step_months (預設 = test_months)
+    最後一個測試視窗截至 end_date
+    calendar: 交易日曆 (SPY index)；給定時視窗結束日調整為當日或之前最近的交易日
+    (LIVE_MODE 會在 end_date 再估值一次，非交易日會取不到收盤價)
+    """
+    step_months = step_months or test_months
+    start = pd.Timestamp(start_date)
+    end = pd.Timestamp(end_date)
+    one_day = pd.Timedelta(days=1)
+
+    windows = []
+    train_start = start
+    while True:
+        test_start = train_start + pd.DateOffset(months=train_months)
+        if test_start > end:
+            break
+        test_end = min(test_start + pd.DateOffset(months=test_months) - one_day, end)
+        windows.append((train_start, test_start - one_day, test_start, test_end))
+        train_start = train_start + pd.DateOffset(months=step_months)
+
+    if calendar is not None:
+        def snap(date):
+            pos = calendar.searchsorted(date, side='right') - 1
+            return calendar[pos] if pos >= 0 else date
+        windows = [(train_start, snap(train_end), test_start, snap(test_end))
+                   for train_start, train_end, test_start, test_end in windows]
+    return windows
+
+
+def stitch_curves(curves, initial_capital):
+    """
+    串接各測試視窗的權益曲線: 以日報酬連乘，每段第一日視為持平 (新視窗以現金開始)
+    視窗重疊時 (step_months < test_months) 只取前一段最後日期之後的部分
+    """
+    returns = []
+    last_date = None
+    for curve in curves:
+        if curve is None or curve.empty:
+            continue
+        # LIVE_MODE 結束時會對最後一日再記錄一次
+        curve = curve[~curve.index.duplicated(keep='last')]
+        if last_date is not None:
+            curve = curve[curve.index > last_date]
+            if curve.empty:
+                continue
+        r = curve.pct_change()
+        r.iloc[0] = 0.0
+        returns.append(r)
+        last_date = curve.index[-1]
+    if not returns:
+        return pd.Series(dtype=float, name='Equity')
+    stitched = initial_capital * (1 + pd.concat(returns)).cumprod()
+    stitched.index.name = 'Date'
+    return stitched.rename('Equity')
+
+
+def _best(rows, metric):
+    """訓練結果中 metric 最大且沒有錯誤的列號 (都失敗時回傳 None)"""
+    valid = [k for k, r in enumerate(rows) if not r.get('Error') and pd.notna(r.get(metric))]
+    if not valid:
+        return None
+    return max(valid, key=lambda k: rows[k][metric])
+
+
+def walk_forward(param_sets, start_date=None, end_date=None, train_months=24, test_months=6,
+                 step_months=None, metric='Sharpe', initial_capital=None, compounding=True,
+                 processes=None, start_method=None, progress_callback=None):
+    """
+    執行 walk-forward 最佳化
+    param_sets: 每個訓練視窗的候選 overrides dict 列表 (grid / random_samples 產生)
+    metric: 訓練視窗選參依據 (performance_metrics 的欄位，越大越好)
+    processes / start_method: 同 param_sweep.run_sweep
+    progress_callback: 選用，callback(phase, done, total)，phase 為 'train' / 'test'
+    回傳 (樣本外權益曲線 Series, 每個視窗一列的 DataFrame)
+    """
+    start_date = start_date if start_date is not None else config.START_DATE
+    initial_capital = initial_capital if initial_capital is not None else config.INITIAL_CASH
+    if end_date is None:
+        end_date = config.END_DATE
+    calendar = shared_context()['spy_df'].index
+    if end_date is None:
+        end_date = calendar[-1]
+
+    param_sets = list(param_sets) or [{}]  # 沒有候選時使用 config_final 預設參數
+    # 先驗證參數名稱，避免在 worker 中才失敗
+    for overrides in param_sets:
+        StrategyParams.from_config(config, **overrides)
+
+    windows = make_windows(start_date, end_date, train_months, test_months, step_months, calendar)
+    if not windows:
+        print(f"Warning: no walk-forward window fits between {start_date} and {end_date}")
+        return stitch_curves([], initial_capital), pd.DataFrame()
+
+    def progress(phase):
+        if progress_callback is None:
+            return None
+        return lambda done, total: progress_callback(phase, done, total)
+
+    # 1. 所有視窗的訓練回測一次送入 pool (視窗間平行)
+    train_jobs = [(dict(o), train_start, train_end, initial_capital, compounding, False)
+                  for train_start, train_end, _, _ in windows for o in param_sets]
+    train_rows = run_jobs(train_jobs, processes=processes, progress_callback=progress('train'),
+                          start_method=start_method)
+
+    n = len(param_sets)
+    chosen = [_best(train_rows[w * n:(w + 1) * n], metric) for w in range(len(windows))]
+
+    # 2. 以各視窗選出的參數跑測試視窗
+    test_index = [w for w, best in enumerate(chosen) if best is not None]
+    test_jobs = [(dict(param_sets[chosen[w]]), windows[w][2], windows[w][3],
+                  initial_capital, compounding, True) for w in test_index]
+    test_rows = dict(zip(test_index, run_jobs(test_jobs, processes=processes,
+                                              progress_callback=progress('test'),
+                                              start_method=start_method)))
+
+    table = []
+    curves = []
+    for w, (train_start, train_end, test_start, test_end) in enumerate(windows):
+        row = {
+            'Window': w + 1,
+            'Train Start': train_start.date(),
+            'Train End': train_end.date(),
+            'Test Start': test_start.date(),
+            'Test End': test_end.date(),
+        }
+        if chosen[w] is None:
+            row['Error'] = 'no valid parameter set in train window'
+            table.append(row)
+            continue
+        row.update(param_sets[chosen[w]])
+        row[f'Train {metric}'] = train_rows[w * n + chosen[w]][metric]
+        test = test_rows[w]
+        for key in ('CAGR %', 'Sharpe', 'MDD %', 'Trades'):
+            if key in test:
+                row[f'Test {key}'] = test[key]
+        row['Error'] = test.get('Error', '')
+        table.append(row)
+        curves.append(test.get('Equity Curve'))
+
+    equity = stitch_curves(curves, initial_capital)
+    return equity, pd.DataFrame(table)
+
+
+if __name__ == "__main__":
+    space = {
+        'LOOKBACK': [60, 90, 120],
+        'EXIT_EMA': [40, 50],
+        'TARGET_HOLDINGS': [4, 6],
+    }
+    param_sets = grid(space)
+    print(f"Walk-forward with {len(param_sets)} parameter sets per train window...")
+    equity, windows = walk_forward(
+        param_sets,
+        progress_callback=lambda phase, d, t: print(f"  [{phase}] {d}/{t} done"))
+    equity.to_csv('walk_forward_equity.csv')
+    windows.to_csv('walk_forward_windows.csv', index=False)
+    print(windows.to_string())
+    print("Out-of-sample:", {k: round(v, 2) for k, v in performance_metrics(equity).items()})
+    print("Saved to walk_forward_equity.csv / walk_forward_windows.csv")